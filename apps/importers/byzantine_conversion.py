@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# Conversion of Robinson & Pierpont's Byzantine/Majority Text from its BP5 and
+# CCT files into the Unbound Bible format which load_byzantine imports.
+#
+# This module does not use Django, so that
+# greek_byzantine_2005_parsed.prepare_data.py can run it in a plain checkout.
+#
+# From greek_byzantine_2005_parsed.prepare_data.py
+# Developed by Tom Brazier
+
+import cPickle
+import multiprocessing
+import os
+import re
+import StringIO
+import unicodedata
+import urllib
+import zipfile
+
+
+class ConversionError(ValueError):
+    "Raised for text in the BP5 or CCT files which cannot be converted"
+
+
+BP5_FILE = "BP05FNL.ZIP"
+CCT_FILE = "BYZ05CCT.ZIP"
+
+################################################################################
+# Notes:
+# 1. BYZ05CCT.ZIP contains AC24.CCT which is a variant of Acts 24:6-8.  The text in
+#    AC.CCT, however is the same as the physical book (1st edition) so we prefer it.
+# 2. BYZ05CCT.ZIP contains PA.CCT which is a variant form of the Pericope Adulterae.
+#    Once again, the text in JOH.CCT is the main text in the book (the variant is
+#    in the apparatus).  So we prefer JOH.CCT.
+# 3. Rev 17:8 starts in different places in the BP5 text and the CCT text, although
+#    the BP5 text lists the alternative starting point with parentheses.  The text
+#    in the CCT file matches the physical book, so there's a tweak below to prefer it.
+################################################################################
+
+# we know about all of these character translations - anything else is an error
+BP5_TABLE = u' ' * 65 + u'ΑΒΧΔΕΦΓΗΙ ΚΛΜΝΟΠΨΡΣΤΥΣΩΞΘΖ' + u' ' * 6 + u'αβχδεφγηι κλμνοπψρστυςωξθζ' + ' ' * 133
+
+# The start of a BP5 line which begins a verse
+BP5_VERSE = re.compile(r" +([0-9]+):([0-9]+)")
+
+# Everything that can follow in a BP5 line, tried as one set of alternatives
+BP5_TOKEN = re.compile(r"""
+    \s*
+    (?:
+            (?P<word>[a-zA-Z]+)
+        |   (?P<strongs>[0-9]+)
+        |   \{(?P<parsing>[A-Z123\-]+)\}
+        |   \((?P<verse_number>[0-9]+:[0-9]+)\)  # alternative verse number
+        |   (?P<variant>\|)                      # marginal apparatus delimiter
+        |   (?P<error>\S)
+    )
+    """, re.VERBOSE)
+
+def bp5_to_unicode(bp5_word):
+    "Convert a word from Robinson & Pierpont's ASCII format to unicode"
+    res = bp5_word.translate(BP5_TABLE)
+    assert(u' ' not in res)
+    return res
+
+def scan_bp5_file(book):
+    """Read a book in BP5 format from BP5_FILE, yielding a (chapter, verse, word)
+    tuple for each word, where word is a tuple starting with the unicode word and
+    followed by one or more strongs numbers and parsings, in the order they appear.
+
+    BP5 files contain the data for one book.  Each verse starts on a new line with
+    some spaces followed by chapter and verse.  There are also other line breaks.
+    Words are in a "preformatted ASCII" format, followed by strong number and then
+    parsing.  More info from here: http://www.byztxt.com/downloads.html
+
+    The file is read from the ZIP file a line at a time and each line is
+    scanned once with BP5_TOKEN."""
+
+    print("Coverting book %s from BP5" % book)
+
+    bp5_zip_file = zipfile.ZipFile(BP5_FILE)
+    bp5_file = bp5_zip_file.open(book + ".BP5")
+
+    chap = verse = 0
+    verse_started = False
+    word = None
+    # marginal apparatus notes are delimited by pipe characters: | reading | variant |
+    # the reading is kept and the variant skipped
+    variant_pipes = 0
+    for line in bp5_file:
+        # look for verse breaks
+        match = BP5_VERSE.match(line)
+        if match:
+            if word is not None:
+                yield (chap, verse, tuple(word))
+                word = None
+            if int(match.group(1)) != chap:
+                chap, verse = chap + 1, 0
+            assert(int(match.group(1)) == chap)
+            if not verse_started:
+                verse += 1
+            verse_started = False
+            assert(int(match.group(2)) == verse)
+            start = match.end()
+        else:
+            start = 0
+
+        for token in BP5_TOKEN.finditer(line, start):
+            kind = token.lastgroup
+            assert(kind != "error")
+            if kind == "variant":
+                variant_pipes = (variant_pipes + 1) % 3
+            elif variant_pipes == 2:
+                continue
+            elif kind == "word":
+                if word is not None:
+                    yield (chap, verse, tuple(word))
+                word = [bp5_to_unicode(token.group(kind))]
+            elif kind == "strongs":
+                word.append("G" + token.group(kind))
+            elif kind == "parsing":
+                word.append(token.group(kind))
+            elif book == "RE" and (chap, verse) == (17, 7) and token.group(kind) == "17:8":
+                # work around for different starting points of Rev 17:8 (see notes at the top)
+                if word is not None:
+                    yield (chap, verse, tuple(word))
+                    word = None
+                verse = 8
+                verse_started = True
+            # occasionally (eg. Matt 23:13) an alternative verse number is inserted in brackets, ignore it
+
+    if word is not None:
+        yield (chap, verse, tuple(word))
+    assert(variant_pipes == 0)
+    bp5_file.close()
+
+def read_bp5_file(book):
+    """Read a book in BP5 format from BP5_FILE and turn it into a list of chapters,
+    each of which is a list of verses, each of which is a list of words, each of
+    which is a tuple starting with the unicode word and followed by one or more strongs
+    numbers and parsings."""
+    chapters = []
+    for chap, verse, word in scan_bp5_file(book):
+        while len(chapters) < chap:
+            chapters.append([])
+        while len(chapters[chap - 1]) < verse:
+            chapters[chap - 1].append([])
+        chapters[chap - 1][verse - 1].append(word)
+    return chapters
+
+# we know about all of these character translations - anything else is an error
+CCT_TABLE = u' ' * 39 + u"'() +, ./          :;     ΑΒΞΔΕΦΓΗΙ ΚΛΜΝΟΠΘΡΣΤΥ ΩΧΨΖ \ ^  αβξδεφγηι κλμνοπθρστυ ωχψζ |   " + u' ' * 128
+
+# The letters of the CCT files which take breathings, accents, diaeresis and iota
+# subscript, and the betacode annotations for those along with the combining
+# characters they stand for
+CCT_ANNOTATED_LETTERS = u'ΑΕΗΙΟΡΥΩαεηιορυω'
+CCT_BREATHINGS = {u"": u"", u")": u"\u0313", u"(": u"\u0314"}
+CCT_ACCENTS = {u"": u"", u"/": u"\u0301", u"\\": u"\u0300", u"^": u"\u0342"}
+CCT_ANNOTATIONS = ")(/\\^+|"
+
+# A letter of a CCT word followed by its annotations
+CCT_SYLLABLE = re.compile(r"[^)(/\\^+|][)(/\\^+|]*")
+
+# The characters which are left out of the plain, lowercase version of CCT words
+CCT_NOT_PLAIN = "".join(chr(c) for c in range(256) if chr(c) not in "abcdefghijklmnopqrstuvwxyz,.:;")
+
+def compose_cct_letter(letter, breathing, accent, diaeresis, iota_subscript):
+    """A letter with its betacode annotations in Normalization Form C: the
+    precomposed character if Unicode has one, or else the letter followed by
+    combining characters"""
+    # the combining characters in canonical order
+    decomposed = letter + u"\u0308" * diaeresis + CCT_BREATHINGS[breathing] + CCT_ACCENTS[accent] + u"\u0345" * iota_subscript
+    return unicodedata.normalize("NFC", decomposed)
+
+def compose_cct_letters():
+    """Map each (letter, breathing, accent, diaeresis, iota subscript) combination
+    which Unicode has a precomposed character for to that character"""
+    letters = {}
+    for letter in CCT_ANNOTATED_LETTERS:
+        for breathing in CCT_BREATHINGS:
+            for accent in CCT_ACCENTS:
+                for diaeresis in (False, True):
+                    for iota_subscript in (False, True):
+                        composed = compose_cct_letter(letter, breathing, accent, diaeresis, iota_subscript)
+                        if len(composed) == 1:
+                            letters[(letter, breathing, accent, diaeresis, iota_subscript)] = composed
+    return letters
+
+CCT_LETTERS = compose_cct_letters()
+
+# Maximum number of distinct words cct_to_unicode remembers; the whole New
+# Testament has only tens of thousands of them
+CCT_CACHE_SIZE = 100000
+converted_cct_words = {}
+
+# Each letter of the CCT files with its annotations (after initial annotations
+# have been moved behind the first letter), mapped to its unicode character;
+# seeded with the plain letters and filled in by cct_syllable as annotated
+# letters turn up
+cct_syllables = dict(
+    (chr(c), CCT_TABLE[c]) for c in range(256)
+    if CCT_TABLE[c] != u' ' and chr(c) not in CCT_ANNOTATIONS
+)
+
+def cct_syllable(syllable):
+    """Convert a letter and its betacode annotations to the precomposed character,
+    or to the letter and combining characters when Unicode has no precomposed
+    character for the combination (such as a capital with an accent and iota
+    subscript); raises ValueError for a character which is not in CCT_TABLE or
+    annotations which contradict each other"""
+    letter, annotations = CCT_TABLE[ord(syllable[0])], syllable[1:]
+    if letter == u' ':
+        raise ValueError("Unexpected character %r" % syllable[0])
+    breathings = set(annotation for annotation in annotations if annotation in ")(")
+    accents = set(annotation for annotation in annotations if annotation in "/\\^")
+    if len(breathings) > 1 or len(accents) > 1 or (annotations and letter not in CCT_ANNOTATED_LETTERS):
+        raise ValueError("Unexpected annotations on the letter %s" % syllable)
+    key = (letter, "".join(breathings), "".join(accents), "+" in annotations, "|" in annotations)
+    composed = CCT_LETTERS.get(key) or compose_cct_letter(*key)
+    cct_syllables[syllable] = composed
+    return composed
+
+def cct_to_unicode(bp5_word):
+    """Convert a word from Robinson & Pierpont's modified betacode format to unicode, and
+    return it along with a plain old un-accented, lowercase version for later comparison with BP5"""
+
+    converted = converted_cct_words.get(bp5_word)
+    if converted is not None:
+        return converted
+
+    # move initial accents to after the first letter so they're positioned like all other accents
+    word = bp5_word.lstrip(CCT_ANNOTATIONS)
+    if len(word) < len(bp5_word):
+        word = word[0] + bp5_word[:len(bp5_word) - len(word)] + word[1:]
+
+    # look up each letter along with its accents
+    res1 = u"".join([cct_syllables.get(syllable) or cct_syllable(syllable) for syllable in CCT_SYLLABLE.findall(word)])
+    res2 = bp5_word.lower().translate(None, CCT_NOT_PLAIN).translate(CCT_TABLE)
+
+    # convert final sigmas
+    if res1[-1] == u'σ': res1 = res1[0:-1] + u'ς'
+    if res2[-1] == u'σ': res2 = res2[0:-1] + u'ς'
+
+    if len(converted_cct_words) >= CCT_CACHE_SIZE:
+        converted_cct_words.clear()
+    converted_cct_words[bp5_word] = (res1, res2)
+    return (res1, res2)
+
+def read_cct_file(book):
+    """Read a book in CCT format from CCT_FILE and turn it into a list of chapters,
+    each of which is a list of verses, each of which is a list of accented words and
+    punctuation marks.
+
+    CCT files contain the data for one book.  There is exactly one line per verse.
+    Words are in a a modified betacode format.  More info from here:
+    http://www.byztxt.com/downloads.html"""
+
+    print("Coverting book %s from CCT" % book)
+
+    cct_zip_file = zipfile.ZipFile(CCT_FILE)
+
+    # run through the lines, building chapters
+    chapters = []
+    for line in StringIO.StringIO(cct_zip_file.read(book + ".CCT")):
+        # ignore comment lines
+        if line[0] == "#": continue
+
+        # strip the variant readings and paragraph breaks
+        line = re.sub(r" *\{[^\}]*} *", ' ', line)
+
+        # strip hyphens from the text
+        line = re.sub(r" *- *", ' ', line)
+
+        # every line is a new verse, so get the chapter and verse numbers
+        match = re.match(r" +([0-9]+):([0-9]+)(.*)", line)
+        assert(match)
+        chap, verse, line = (int(match.group(1)), int(match.group(2)), match.group(3))
+
+        # build the verse
+        line = re.sub(r"([,.:;])", r" \1", line)
+        curr_verse = []
+        for word in line.strip().split():
+            try:
+                curr_verse.append(cct_to_unicode(word))
+            except ValueError as (e):
+                raise ConversionError("%s %d:%d: %s in the word %s" % (book, chap, verse, e, word))
+
+        # append chapters and verses
+        if chap != len(chapters):
+            chapters.append([])
+        assert(chap == len(chapters))
+        chapters[-1].append(curr_verse)
+        assert(verse == len(chapters[-1]))
+
+    return chapters
+
+# Default directory, relative to the working directory, in which the books
+# converted from BP5_FILE and CCT_FILE are cached
+CACHE_DIR = "byzantine_cache"
+
+# Bumped whenever the conversion changes, so that books cached by an older
+# version are converted again
+CACHE_VERSION = 2
+
+BOOK_NAMES = (
+    "MT", "MR", "LU", "JOH", "AC", "RO", "1CO", "2CO", "GA", "EPH", "PHP", "COL", "1TH", "2TH",
+    "1TI", "2TI", "TIT", "PHM", "HEB", "JAS", "1PE", "2PE", "1JO", "2JO", "3JO", "JUDE", "RE",
+)
+
+def book_checksum(bp5_zip_file, cct_zip_file, book):
+    """Checksum of a book's BP5 and CCT files, made from the CRC-32s and sizes
+    recorded for them in the directories of the ZIP files, so that it can be
+    had without decompressing anything"""
+    checksum = "v%d" % CACHE_VERSION
+    for info in (bp5_zip_file.getinfo(book + ".BP5"), cct_zip_file.getinfo(book + ".CCT")):
+        checksum += "-%08x-%d" % (info.CRC & 0xffffffff, info.file_size)
+    return checksum
+
+def cache_path(cache_dir, book, checksum):
+    return os.path.join(cache_dir, "%s-%s.pickle" % (book, checksum))
+
+def convert_book(task):
+    """Convert a book from BP5 and CCT and store the result in the cache; run in
+    a worker process by convert_books"""
+    book, path = task
+    converted = (read_bp5_file(book), read_cct_file(book))
+    assert(len(converted[0]) == len(converted[1]))
+
+    # stale conversions of the book are removed, and the new one is written under
+    # a temporary name first so that an interrupted run cannot leave a partial file
+    cache_dir = os.path.dirname(path)
+    for name in os.listdir(cache_dir):
+        if name.startswith(book + "-"):
+            os.remove(os.path.join(cache_dir, name))
+    cache_file = open(path + ".tmp", "wb")
+    cPickle.dump(converted, cache_file, cPickle.HIGHEST_PROTOCOL)
+    cache_file.close()
+    os.rename(path + ".tmp", path)
+    return book, converted
+
+def convert_books(book_names, workers=1, cache_dir=CACHE_DIR):
+    """Return the (BP5 chapters, CCT chapters) of each of the books, as returned
+    by read_bp5_file and read_cct_file.
+
+    Converted books are cached in cache_dir under the checksum of their source
+    files, so only the books which are new or changed since the last run are
+    converted again. Those are converted in a pool of worker processes."""
+    if not os.path.exists(cache_dir):
+        os.mkdir(cache_dir)
+    bp5_zip_file = zipfile.ZipFile(BP5_FILE)
+    cct_zip_file = zipfile.ZipFile(CCT_FILE)
+
+    books = {}
+    tasks = []
+    for book in book_names:
+        path = cache_path(cache_dir, book, book_checksum(bp5_zip_file, cct_zip_file, book))
+        if os.path.exists(path):
+            cache_file = open(path, "rb")
+            books[book] = cPickle.load(cache_file)
+            cache_file.close()
+        else:
+            tasks.append((book, path))
+
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            books.update(pool.imap_unordered(convert_book, tasks))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        pool.join()
+    else:
+        books.update(convert_book(task) for task in tasks)
+
+    return [books[book] for book in book_names]
+
+def prepare_text(workers=1, cache_dir=CACHE_DIR):
+    """Download BP5_FILE and CCT_FILE unless they are in the working directory,
+    and convert them into the Unbound Bible files greek_byzantine_2005_parsed_utf8.txt
+    and greek_byzantine_2005_parsed_punc_utf8.txt"""
+    book_names = BOOK_NAMES
+
+    if(not os.path.exists('BP05FNL.ZIP')):
+        print("Downloading BP05FNL.ZIP")
+        urllib.urlretrieve("http://koti.24.fi/jusalak/GreekNT/BP05FNL.ZIP", "BP05FNL.ZIP")
+
+    if(not os.path.exists('BYZ05CCT.ZIP')):
+        print("Downloading BYZ05CCT.ZIP")
+        urllib.urlretrieve("http://koti.24.fi/jusalak/GreekNT/BYZ05CCT.ZIP", "BYZ05CCT.ZIP")
+
+    books = convert_books(book_names, workers, cache_dir)
+
+    # generate output
+    print("Generating output files")
+    outfile_plain = file("greek_byzantine_2005_parsed_utf8.txt", "wb")
+    outfile_plain.write(
+    """#name\tGreek NT: Byzantine/Majority Text (2005) [Parsed]
+#filetype\tUnmapped-BCVS
+#copyright\tSee http://www.byztxt.com/
+#abbreviation\t
+#language\tgko
+#note\t
+#columns\torig_book_index\torig_chapter\torig_verse\torder_by\ttext
+""")
+    
+    outfile_punc = file("greek_byzantine_2005_parsed_punc_utf8.txt", "wb")
+    outfile_punc.write(
+    """#name\tGreek NT: Byzantine/Majority Text (2005) [Parsed with punctuation, accents and breathings]
+#filetype\tUnmapped-BCVS
+#copyright\tSee http://www.byztxt.com/
+#abbreviation\t
+#language\tgko
+#note\t
+#columns\torig_book_index\torig_chapter\torig_verse\torder_by\ttext
+""")
+    
+    ordering = 0
+    for i_book in range(len(books)):
+        print("Book: %s" % book_names[i_book])
+        bp5_chapters, cct_chapters = books[i_book]
+        for i_chap in range(len(bp5_chapters)):
+            bp5_chapter = bp5_chapters[i_chap]
+            cct_chapter = cct_chapters[i_chap]
+            assert(len(bp5_chapter) == len(cct_chapter))
+            for i_verse in range(len(bp5_chapter)):
+                bp5_verse = bp5_chapter[i_verse]
+                cct_verse = cct_chapter[i_verse]
+    
+                # run through the verse building the output line
+                out_words_punc = []
+                out_words_plain = []
+                i_bp5_word = i_cct_word = 0
+                while i_bp5_word < len(bp5_verse) or i_cct_word < len(cct_verse):
+                    if i_bp5_word < len(bp5_verse): bp5_word = bp5_verse[i_bp5_word]
+                    if not i_cct_word < len(cct_verse): print i_chap, i_verse, i_cct_word, i_bp5_word, len(cct_verse), len(bp5_verse)
+                    cct_word = cct_verse[i_cct_word]
+                    if cct_word[0] in ",.:;":
+                        out_words_punc.append(cct_word[0])
+                        i_cct_word += 1
+                    else:
+                        # ensure that we're in sync, i.e. that the unadorned CCT word is the same as the BP5 word
+                        assert(cct_word[1] == bp5_word[0])
+                        out_words_punc.append(cct_word[0])
+                        out_words_punc += bp5_word[1:]
+                        out_words_plain.append(cct_word[1])
+                        out_words_plain += bp5_word[1:]
+                        i_bp5_word += 1
+                        i_cct_word += 1
+                ordering += 10
+                out_line = u"%dN\t%d\t%d\t\t%d\t" % (i_book + 40, i_chap + 1, i_verse + 1, ordering)
+                out_line += u"%s\n" % u' '.join(out_words_plain)
+                outfile_plain.write(out_line.encode('utf8'))
+    
+                out_line = u"%dN\t%d\t%d\t\t%d\t" % (i_book + 40, i_chap + 1, i_verse + 1, ordering)
+                out_line += u"%s\n" % u' '.join(out_words_punc)
+                outfile_punc.write(out_line.encode('utf8'))
+    
+    del(outfile_plain)
+    del(outfile_punc)
@@ -3,33 +3,167 @@
 
 # standard library imports
 import datetime
+import difflib
+import gzip
+import hashlib
 from optparse import make_option
 import os
+import re
+import StringIO
 import sys
-from uuid import uuid4
+import time
 import urllib
 import unicodedata
+import xml.sax
 
 # django imports
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import AutoField, F, Max, get_model
 from django.utils.encoding import smart_str
 
 # openscriptures imports
 from apps.core.models import Language, License, Server
-from apps.texts.models import Token, Work, Structure, WorkServer
+from apps.texts.models import LexiconEntry, Token, TokenRecord, Work, Structure, StructureAttribute, VerseIndex, WorkServer
+from apps.texts.token_store import token_store_path, write_token_store
+from apps.importers.models import ImportCheckpoint
+from apps.importers.pipeline import Pipeline, PIPELINE_MODES
 from apps.core import osis
 
+# Number of Token rows collected in memory before they are written out with
+# a single executemany() call
+TOKEN_BATCH_SIZE = 5000
+
+# Number of preceding tokens whose data is hashed into a token's ID; this is
+# doubled for as long as the resulting ID collides with one already in the book,
+# up to TOKEN_ID_MAX_LOOKBEHIND
+TOKEN_ID_LOOKBEHIND = 4
+TOKEN_ID_MAX_LOOKBEHIND = 64
+
+# Translation table for normalize_token which deletes apostrophes and every
+# nonspacing combining mark in the Basic Multilingual Plane (Greek accents and
+# breathings, Hebrew points and cantillation, Latin diacritics, ...)
+NORMALIZE_TABLE = dict.fromkeys(
+    [c for c in xrange(0x10000) if unicodedata.category(unichr(c)) == 'Mn'] +
+    [ord(u"'"), ord(u"’")]
+)
+
+# Number of new lexicon entries whose IDs are read back with one query once
+# they have been inserted (SQLite allows at most 999 parameters per query)
+LEXICON_QUERY_SIZE = 500
+
+# Maximum number of distinct token forms normalize_token remembers; a whole
+# Bible has only tens of thousands of them
+NORMALIZE_CACHE_SIZE = 100000
+normalized_forms = {}
+
+# Number of bytes of XML fed to a SAX parser at a time by parse_xml; the same
+# as the buffer xml.sax parsers read files with, so that handlers receive the
+# same character events either way
+XML_CHUNK_SIZE = 2 ** 16
+
+# The Structure fields which store the positions of the tokens referred to by
+# its foreign keys, along with those foreign keys
+STRUCTURE_POSITION_FIELDS = (
+    ("start_position", "start_token"),
+    ("end_position", "end_token"),
+    ("start_marker_position", "start_marker"),
+    ("end_marker_position", "end_marker"),
+)
+
+# Seconds between the progress lines printed at verbosity 1
+PROGRESS_INTERVAL = 5
+
+# First field of the header line of the intermediate files written by
+# --parse-to, followed by the format version and the work's slug
+INTERMEDIATE_FORMAT = "openscriptures-import"
+INTERMEDIATE_VERSION = "1"
+
+# Escapes for the characters which cannot appear in an intermediate file field
+INTERMEDIATE_ESCAPES = {u"\\": u"\\\\", u"\t": u"\\t", u"\n": u"\\n", u"\r": u"\\r"}
+INTERMEDIATE_UNESCAPES = {u"\\": u"\\", u"t": u"\t", u"n": u"\n", u"r": u"\r"}
+INTERMEDIATE_ESCAPED = re.compile(ur"[\\\t\n\r]")
+INTERMEDIATE_UNESCAPED = re.compile(ur"\\(.)")
+
+# Tables holding a work's data, in the order delete_work empties them so that no
+# row is left referring to one already deleted: (app label, model, chain of
+# foreign keys leading to the work). Models of apps which are not installed
+# are skipped.
+WORK_DEPENDENTS = (
+    ("texts", "VerseIndex", ("work",)),
+    ("texts", "StructureAttribute", ("structure", "work")),
+    ("texts", "Structure", ("work",)),
+    ("morphs", "TokenParsing_grc", ("tokenmeta", "token", "work")),
+    ("morphs", "TokenParsing_hbo", ("tokenmeta", "token", "work")),
+    ("morphs", "TokenMeta", ("token", "work")),
+    ("texts", "Token", ("work",)),
+    ("texts", "TokenLinkageItem", ("token_work",)),
+    ("importers", "ImportCheckpoint", ("work",)),
+    ("texts", "WorkServer", ("work",)),
+    ("texts", "Work", ("id",)),
+)
+
+# Command line options shared by all of the load_* management commands
+IMPORT_OPTIONS = (
+    make_option('--batch-size',
+        action='store',
+        type='int',
+        dest='batch_size',
+        default=TOKEN_BATCH_SIZE,
+        help='Number of tokens to buffer before writing them to the database'),
+    make_option('--resume',
+        action='store_true',
+        dest='resume',
+        default=False,
+        help='Continue an interrupted import after the last committed book'),
+    make_option('--delta',
+        action='store_true',
+        dest='delta',
+        default=False,
+        help='Update an existing work in place, writing only the tokens and structures which changed'),
+    make_option('--parse-to',
+        action='store',
+        dest='parse_to',
+        default=None,
+        help='Only parse the source, writing the tokens and structures to an intermediate file (gzipped if it ends in .gz)'),
+    make_option('--load-from',
+        action='store',
+        dest='load_from',
+        default=None,
+        help='Load the tokens and structures from an intermediate file written by --parse-to instead of parsing the source'),
+    make_option('--pipeline',
+        action='store',
+        type='choice',
+        choices=PIPELINE_MODES,
+        dest='pipeline',
+        default=None,
+        help='Parse the source on the calling thread (inline), on worker threads or on worker processes; by default processes if there is more than one worker, otherwise a thread'),
+    make_option('--copy',
+        action='store_true',
+        dest='copy',
+        default=False,
+        help='Write the rows with COPY rather than batched INSERTs (PostgreSQL only)'),
+    )
+
 class OpenScripturesImport():
     """Class to facilitate the import of data into OpenScriptures models.
 
     OpenScripturesImport handles the creation of various OpenScriptures data model objects
     (works, tokens, structures) and provides the necessary functions to process the data."""
 
-    def __init__(self):
+    def __init__(self, batch_size=TOKEN_BATCH_SIZE, parse_only=False, verbosity=1, copy=False):
         self.work1 = None
         self.tokenCount = 0
         self.bookTokens = []
+        # Tokens created but not yet written to the database
+        self.pendingTokens = []
+        self.batch_size = batch_size
+        # Whether rows are written with PostgreSQL's COPY (see insert_rows)
+        self.copy = copy
         self.structs = {}
+        # Closed structures waiting to be written at the end of the book
+        self.bookStructs = []
         self.structCount = 0
         self.book_codes = None        
         self.current_book = None
@@ -37,199 +171,1058 @@ class OpenScripturesImport():
         self.current_verse = None
         # For the paragraph token object, not the struct
         self.current_paragraph = None
+        # State for generating deterministic token IDs within a book
+        self.tokenIdBook = None
+        self.tokenIdContext = []
+        self.tokenIds = set()
+        # The IDs of the lexicon entries by their data, once read (see add_forms)
+        self.lexicon = None
+        # Last book committed by a previous run when resuming
+        self.resume_book = None
+        # Whether books are compared against an existing import of the work
+        # rather than written out afresh (see apply_book_delta)
+        self.delta = False
+        # When parsing books in a worker process nothing is written to the
+        # database; close_book() collects each book here instead
+        self.parsedBooks = None
+        if parse_only:
+            self.parsedBooks = []
+        # When parsing to an intermediate file, the books are written to it
+        # rather than collected in parsedBooks
+        self.intermediateFile = None
+        # 0 prints nothing but errors, 1 periodic progress lines and a
+        # summary, and 2 every book, chapter, verse and paragraph
+        self.verbosity = verbosity
+        # Number of books to be imported by this run, if known, for the ETA
+        self.bookTotal = None
+        self.booksDone = 0
+        self.runTokens = 0
+        self.startTime = time.time()
+        self.lastProgress = self.startTime
+        # Seconds spent in each phase of the import (see summarize)
+        self.timings = {}
 
-    def create_book_struct(self):
-        self.structs["book"] = Structure(
+    def create_structure(self, element, **kwargs):
+        """
+        Create a Structure for the current work at the next structure position.
+
+        Structures are held in memory until the end of the book. Their bounds
+        are tracked as token positions (start_position, end_position,
+        start_marker_position and end_marker_position) which are written out
+        along with the Token foreign keys they are resolved to.
+        """
+        struct = Structure(
             work = self.work1,
-            element = "book",
-            osis_id = self.current_book,
+            element = element,
             position = self.structCount,
+            **kwargs
+        )
+        struct.start_position = None
+        struct.end_position = None
+        struct.start_marker_position = None
+        struct.end_marker_position = None
+        self.structCount += 1
+        return struct
+
+    def create_book_struct(self):
+        self.structs["book"] = self.create_structure("book",
+            osis_id = self.current_book,
             numerical_start = self.book_codes.index(self.current_book),
             )
-        self.structCount += 1
-        print self.current_book
+        self.log(2, self.current_book)
         
     def create_title_struct(self):
-        self.structs["title"] = Structure(
-            work = self.work1,
-            element = "title",
-            position = self.structCount,
-            )
-        self.structCount += 1
+        self.structs["title"] = self.create_structure("title")
      
     def create_chapter_struct(self):       
-        self.structs["chapter"] = Structure(
-            work = self.work1,
-            element = "chapter",
-            position = self.structCount,
+        self.structs["chapter"] = self.create_structure("chapter",
             osis_id = self.current_book + "." + self.current_chapter,
             numerical_start = self.current_chapter,
         )
-        print self.structs["chapter"].osis_id
-        self.structCount += 1
+        self.log(2, self.structs["chapter"].osis_id)
     
     def create_colophon_struct(self):
-        self.structs["colophon"] = Structure(
-            work = self.work1,
-            element = "colophon",
-            position = self.structCount,
+        self.structs["colophon"] = self.create_structure("colophon",
             osis_id = self.current_book + ".c"
         )
-        self.structCount += 1
 
     def create_verse_struct(self):
-        self.structs["verse"] = Structure(
-            work = self.work1,
-            element = "verse",
-            position = self.structCount,
+        self.structs["verse"] = self.create_structure("verse",
             osis_id = self.current_book + "." + self.current_chapter + "." + self.current_verse,
             numerical_start = self.current_verse,
         )
-        print self.structs["verse"].osis_id
-        self.structCount += 1
+        self.log(2, self.structs["verse"].osis_id)
 
     def create_uncertain(self):
         assert(not self.structs.has_key('doubted'))
-        print("### OPEN BRACKET")
+        self.log(2, "### OPEN BRACKET")
         
         open_bracket_token = Token(
-            id       = uuid4(),
             data     = '[',
             type     = Token.PUNCTUATION,
             work     = self.work1,
             position = self.tokenCount
         )
         self.tokenCount += 1
-        open_bracket_token.save()
-        self.bookTokens.append(open_bracket_token)
+        self.add_token(open_bracket_token)
 
-        self.structs['doubted'] = Structure(
-            work = self.work1,
-            element = 'doubted',
-            position = self.structCount,
-            start_marker = open_bracket_token
-            )
-        self.structCount += 1
+        self.structs['doubted'] = self.create_structure('doubted')
+        self.structs['doubted'].start_marker_position = open_bracket_token.position
 
 
     def create_paragraph(self):
         current_paragraph = None
         if len(self.bookTokens) > 0 and self.structs.has_key("p"):
             current_paragraph = Token(
-                id       = uuid4(),
                 data     = u"\u2029", #¶ "\n\n"
                 type     = Token.WHITESPACE, #i.e. PARAGRAPH
                 work     = self.work1,
                 position = self.tokenCount,
             )
             self.tokenCount += 1
-            current_paragraph.save()
-            self.structs["p"].end_marker = current_paragraph
-            self.close_structure("p")            
-            self.bookTokens.append(current_paragraph)
+            self.structs["p"].end_marker_position = current_paragraph.position
+            # The paragraph token is the end_marker, not the end_token, so it
+            # is only added to bookTokens once the structure is closed
+            self.close_structure("p")
+            self.add_token(current_paragraph)
 
         assert(not self.structs.has_key("p"))
-        print("¶")
-        self.structs["p"] = Structure(
-            work = self.work1,
-            element = "p",
-            position = self.structCount,
-        )
+        self.log(2, "¶")
+        self.structs["p"] = self.create_structure("p")
         if current_paragraph:
-            self.structs["p"].start_marker = current_paragraph
-        self.structCount += 1
+            self.structs["p"].start_marker_position = current_paragraph.position
 
 
     def create_token(self, token_data):
         word_token = Token(
-            id       = uuid4(),
             data     = token_data,
             type     = Token.WORD,
             work     = self.work1,
             position = self.tokenCount,
         )
         self.tokenCount += 1
-        word_token.save()
-        self.bookTokens.append(word_token)
+        self.add_token(word_token)
 
 
     def create_whitespace_token(self):
         ws_token = Token(
-            id       = uuid4(),
             data     = " ",
             type     = Token.WHITESPACE,
             work     = self.work1,
             position = self.tokenCount,
             )
         self.tokenCount += 1
-        ws_token.save()
-        self.bookTokens.append(ws_token)
+        self.add_token(ws_token)
 
 
     def create_punct_token(self, punct_data):
         punc_token = Token(
-            id       = uuid4(),
             data     = punct_data,
             type     = Token.PUNCTUATION,
             work     = self.work1,
             position = self.tokenCount,
         )
         self.tokenCount += 1
-        punc_token.save()
-        self.bookTokens.append(punc_token)
+        self.add_token(punc_token)
+
+
+    def add_token(self, token):
+        "Queue a token to be written with the next batch"
+        if self.parsedBooks is not None:
+            self.bookTokens.append(token)
+            return
+        self.identify_token(token)
+        self.bookTokens.append(token)
+        if self.tokenCount % 1000 == 0:
+            self.report_progress()
+        if self.delta:
+            # Compared with the stored tokens once the book is complete
+            return
+        self.pendingTokens.append(token)
+        if len(self.pendingTokens) >= self.batch_size:
+            self.flush_tokens()
+
+
+    def identify_token(self, token):
+        """
+        Assign a token its ID: a hash of the work's osisID, the book, the
+        token's data and the data of the tokens preceding it in the book.
+
+        The ID does not depend on the token's position, so re-importing a
+        work yields the same IDs, and an edit to the text only changes the
+        IDs of the tokens within the look-behind window that follows it. If
+        the ID is already used in the book, the look-behind is doubled until
+        it is unique (as a last resort, when the look-behind reaches the start
+        of the book or TOKEN_ID_MAX_LOOKBEHIND, the token's index within the
+        book is included). Tokens must be identified in order.
+        """
+        if self.tokenIdBook != self.current_book:
+            self.tokenIdBook = self.current_book
+            self.tokenIdContext = []
+            self.tokenIds = set()
+            self.tokenIdPrefix = [self.work1.osis_id, self.current_book]
+
+        lookbehind = TOKEN_ID_LOOKBEHIND
+        while True:
+            key = self.tokenIdPrefix + self.tokenIdContext[-lookbehind:] + [token.data]
+            token_id = hashlib.sha1(u"\x00".join(key).encode('utf-8')).hexdigest()
+            if token_id not in self.tokenIds:
+                break
+            if lookbehind >= len(self.tokenIdContext) or lookbehind >= TOKEN_ID_MAX_LOOKBEHIND:
+                # Already looking back to the start of the book, or far
+                # enough that the text must be repeating itself
+                key.append(unicode(len(self.tokenIdContext)))
+                token_id = hashlib.sha1(u"\x00".join(key).encode('utf-8')).hexdigest()
+                break
+            lookbehind *= 2
+
+        token.id = token_id
+        self.tokenIds.add(token_id)
+        self.tokenIdContext.append(token.data)
+
+
+    def insert_rows(self, model, objs):
+        """
+        Write unsaved model instances to the database with one executemany(),
+        or with PostgreSQL's COPY if the importer was asked to (--copy).
+
+        This bypasses Model.save() so that no per-row queries are made. The
+        primary key is omitted when the database generates it; such objects
+        do not get their id assigned.
+        """
+        if not objs:
+            return
+        fields = [f for f in model._meta.local_fields if not isinstance(f, AutoField)]
+        qn = connection.ops.quote_name
+        sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+            qn(model._meta.db_table),
+            ", ".join([qn(f.column) for f in fields]),
+            ", ".join(["%s"] * len(fields)),
+        )
+        rows = []
+        for obj in objs:
+            rows.append([f.get_db_prep_save(f.pre_save(obj, True), connection=connection) for f in fields])
+        cursor = connection.cursor()
+        if self.copy:
+            # psycopg2 can stream the rows with PostgreSQL's COPY instead
+            if not hasattr(cursor, "copy_from"):
+                raise CommandError("--copy needs a PostgreSQL database (psycopg2)")
+            cursor.copy_from(self.copy_file(rows), model._meta.db_table, columns=[f.column for f in fields])
+        else:
+            cursor.executemany(sql, rows)
+        transaction.commit_unless_managed()
+
+
+    def copy_file(self, rows):
+        "A file of rows in the text format of PostgreSQL's COPY"
+        copy = StringIO.StringIO()
+        for row in rows:
+            values = []
+            for value in row:
+                if value is None:
+                    values.append("\\N")
+                elif isinstance(value, bool):
+                    values.append(value and "t" or "f")
+                else:
+                    values.append(smart_str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r"))
+            copy.write("\t".join(values) + "\n")
+        copy.seek(0)
+        return copy
+
+
+    def flush_tokens(self):
+        """
+        Write all pending tokens to the database in batches.
+
+        Token IDs are assigned when the tokens are created rather than by the
+        database, so the rows can be inserted with a single executemany()
+        instead of a save() per token.
+        """
+        start = time.time()
+        self.add_forms(self.pendingTokens)
+        for i in range(0, len(self.pendingTokens), self.batch_size):
+            self.insert_rows(Token, self.pendingTokens[i:i + self.batch_size])
+        self.pendingTokens = []
+        self.add_timing("write tokens", start)
+
+
+    def add_forms(self, tokens):
+        """
+        Set the form of each of the tokens to its entry in the lexicon, adding
+        the entries for new forms with one executemany() and reading their IDs
+        back. The lexicon is read into memory when it is first needed.
+        """
+        if self.lexicon is None:
+            self.lexicon = dict(LexiconEntry.objects.values_list("data", "id"))
+        new_forms = list(set([token.data for token in tokens if token.data not in self.lexicon]))
+        if new_forms:
+            self.insert_rows(LexiconEntry, [LexiconEntry(data = data) for data in new_forms])
+            for i in range(0, len(new_forms), LEXICON_QUERY_SIZE):
+                self.lexicon.update(LexiconEntry.objects.filter(data__in = new_forms[i:i + LEXICON_QUERY_SIZE]).values_list("data", "id"))
+        for token in tokens:
+            token.form_id = self.lexicon[token.data]
+
+
+    def resolve_structures(self):
+        "Resolve the token positions of the book's closed structures to their Token foreign keys"
+        token_ids = dict((token.position, token.id) for token in self.bookTokens)
+        for struct in self.bookStructs:
+            if struct.start_position is not None:
+                struct.start_token_id = token_ids[struct.start_position]
+            if struct.end_position is not None:
+                struct.end_token_id = token_ids[struct.end_position]
+            if struct.start_marker_position is not None:
+                struct.start_marker_id = token_ids[struct.start_marker_position]
+            if struct.end_marker_position is not None:
+                struct.end_marker_id = token_ids[struct.end_marker_position]
+
+
+    def flush_structures(self):
+        "Write out the book's closed structures in one batch"
+        start = time.time()
+        self.resolve_structures()
+        self.insert_rows(Structure, self.bookStructs)
+        self.bookStructs = []
+        self.add_timing("write structures", start)
+
+
+    def update_rows(self, model, objs):
+        """
+        Write changed model instances over their rows with one executemany().
+
+        The rows are first moved past the end of the work (see park_rows) so
+        that rows trading positions do not trip the unique constraints while
+        they are being updated.
+        """
+        if not objs:
+            return
+        self.park_rows(model, [obj.pk for obj in objs])
+        fields = [f for f in model._meta.local_fields if not f.primary_key]
+        qn = connection.ops.quote_name
+        sql = "UPDATE %s SET %s WHERE %s = %%s" % (
+            qn(model._meta.db_table),
+            ", ".join(["%s = %%s" % qn(f.column) for f in fields]),
+            qn(model._meta.pk.column),
+        )
+        rows = []
+        for obj in objs:
+            rows.append([f.get_db_prep_save(f.pre_save(obj, False), connection=connection) for f in fields] + [obj.pk])
+        cursor = connection.cursor()
+        cursor.executemany(sql, rows)
+        transaction.commit_unless_managed()
+
+
+    def park_rows(self, model, ids):
+        "Move the rows with the provided IDs past the last position used in the work"
+        if not ids:
+            return
+        park = self.max_position(model) + 1
+        qn = connection.ops.quote_name
+        sql = "UPDATE %s SET position = position + %%s WHERE %s = %%s" % (
+            qn(model._meta.db_table),
+            qn(model._meta.pk.column),
+        )
+        cursor = connection.cursor()
+        cursor.executemany(sql, [(park, pk) for pk in ids])
+        transaction.commit_unless_managed()
+
+
+    def delete_rows(self, model, ids):
+        "Delete the rows with the provided IDs with one executemany(), along with any StructureAttributes and VerseIndex entries of deleted structures"
+        if not ids:
+            return
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        if model is Structure:
+            for dependent in (StructureAttribute, VerseIndex):
+                cursor.executemany("DELETE FROM %s WHERE %s = %%s" % (
+                    qn(dependent._meta.db_table),
+                    qn(dependent._meta.get_field("structure").column),
+                ), [(pk,) for pk in ids])
+        cursor.executemany("DELETE FROM %s WHERE %s = %%s" % (
+            qn(model._meta.db_table),
+            qn(model._meta.pk.column),
+        ), [(pk,) for pk in ids])
+        transaction.commit_unless_managed()
+
+
+    def max_position(self, model):
+        "The last position used by the work's tokens or structures, or -1 if there are none"
+        position = model.objects.filter(work = self.work1).aggregate(Max("position"))["position__max"]
+        if position is None:
+            return -1
+        return position
+
+
+    def shift_rows(self, model, after, offset):
+        """
+        Add offset to the positions of all of the work's rows after the
+        provided position, with two set-based UPDATEs (via a position past
+        the end of the work, so that no row collides with one yet to move).
+        """
+        if offset == 0:
+            return
+        park = self.max_position(model) + 1
+        if park <= after + 1:
+            return
+        model.objects.filter(work = self.work1, position__gt = after).update(position = F("position") + park)
+        model.objects.filter(work = self.work1, position__gte = park).update(position = F("position") - (park - offset))
+
+
+    def shift_structure_positions(self, after, offset):
+        "Add offset to the token positions stored on the work's structures which are after the provided token position"
+        if offset == 0:
+            return
+        for field, fk in STRUCTURE_POSITION_FIELDS:
+            Structure.objects.filter(**{"work": self.work1, field + "__gt": after}).update(**{field: F(field) + offset})
+
+
+    def fill_structure_positions(self):
+        """
+        Set the token positions stored on the work's structures from the
+        tokens their foreign keys refer to, e.g. for works imported before
+        the positions were stored, with one set-based UPDATE.
+        """
+        start = time.time()
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute("UPDATE %s SET %s WHERE %s = %%s" % (
+            qn(Structure._meta.db_table),
+            ", ".join(["%s = (SELECT %s FROM %s WHERE %s = %s.%s)" % (
+                qn(Structure._meta.get_field(field).column),
+                qn(Token._meta.get_field("position").column),
+                qn(Token._meta.db_table),
+                qn(Token._meta.pk.column),
+                qn(Structure._meta.db_table),
+                qn(Structure._meta.get_field(fk).column),
+            ) for field, fk in STRUCTURE_POSITION_FIELDS]),
+            qn(Structure._meta.get_field("work").column),
+        ), [self.work1.id])
+        transaction.commit_unless_managed()
+        self.add_timing("fill positions", start)
+
+
+    def row_values(self, model, obj):
+        "The values of an instance's non-primary-key fields, comparable with a values_list() row"
+        return tuple([f.to_python(getattr(obj, f.attname)) for f in model._meta.local_fields if not f.primary_key])
+
+
+    def stored_rows(self, model, start, end):
+        "The IDs and field values of the work's rows between two positions (inclusive), in order"
+        fields = [f for f in model._meta.local_fields if not f.primary_key]
+        rows = model.objects.filter(
+            work = self.work1,
+            position__gte = start,
+            position__lte = end,
+        ).order_by("position").values_list("pk", *[f.name for f in fields])
+        return [(row[0], tuple([f.to_python(value) for f, value in zip(fields, row[1:])])) for row in rows]
+
+
+    def apply_book_delta(self):
+        """
+        Bring the stored rows of the current book in line with the tokens and
+        structures just parsed for it, rather than writing them afresh.
+
+        Tokens are aligned by their IDs (see identify_token), so a changed
+        word only results in the tokens within its look-behind window being
+        deleted and inserted; the other tokens are updated only if they
+        moved. Structures are aligned by element and osisID. Stored rows of
+        books no longer in the work are deleted, and the rows of the books
+        which follow are shifted in bulk so that they start after this one.
+        """
+        start = time.time()
+        self.add_forms(self.bookTokens)
+        self.resolve_structures()
+        token_start = self.tokenCount - len(self.bookTokens)
+        struct_start = self.structCount - len(self.bookStructs)
+
+        # Find the stored rows of the book: these run up to the next book
+        token_end = token_start - 1
+        struct_end = struct_start - 1
+        stored_books = list(Structure.objects.filter(
+            work = self.work1,
+            element = "book",
+            position__gte = struct_start,
+        ).order_by("position").values_list("osis_id", "position", "start_position"))
+        for i in range(len(stored_books)):
+            if stored_books[i][0] == self.current_book:
+                if i + 1 < len(stored_books):
+                    struct_end = stored_books[i + 1][1] - 1
+                    token_end = stored_books[i + 1][2] - 1
+                else:
+                    struct_end = self.max_position(Structure)
+                    token_end = self.max_position(Token)
+                break
+
+        # Make room for the book if it grew; if it shrank the following
+        # books are moved up once its rows are out of the way
+        token_offset = self.tokenCount - 1 - token_end
+        struct_offset = self.structCount - 1 - struct_end
+        if token_offset > 0:
+            self.shift_rows(Token, token_end, token_offset)
+            self.shift_structure_positions(token_end, token_offset)
+        if struct_offset > 0:
+            self.shift_rows(Structure, struct_end, struct_offset)
+
+        # Align the tokens by ID
+        stored_tokens = dict(self.stored_rows(Token, token_start, token_end))
+        new_tokens = []
+        changed_tokens = []
+        for token in self.bookTokens:
+            values = stored_tokens.pop(token.id, None)
+            if values is None:
+                new_tokens.append(token)
+            elif values != self.row_values(Token, token):
+                changed_tokens.append(token)
+        deleted_tokens = stored_tokens.keys()
+
+        # Align the structures by element and osisID
+        stored_structs = self.stored_rows(Structure, struct_start, struct_end)
+        structs = sorted(self.bookStructs, key = lambda struct: struct.position)
+        matcher = difflib.SequenceMatcher(None,
+            [(values[0], values[1]) for pk, values in stored_structs],
+            [(struct.element, struct.osis_id) for struct in structs],
+            autojunk = False)
+        matched = set()
+        changed_structs = []
+        for i, j, size in matcher.get_matching_blocks():
+            for k in range(size):
+                pk, values = stored_structs[i + k]
+                struct = structs[j + k]
+                struct.id = pk
+                matched.add(pk)
+                if values != self.row_values(Structure, struct):
+                    changed_structs.append(struct)
+        new_structs = [struct for struct in structs if struct.id is None]
+        deleted_structs = [pk for pk, values in stored_structs if pk not in matched]
+
+        # Structures are written after the tokens they refer to are in place,
+        # and tokens are deleted after the structures which referred to them
+        self.delete_rows(Structure, deleted_structs)
+        self.park_rows(Token, deleted_tokens)
+        self.update_rows(Token, changed_tokens)
+        for i in range(0, len(new_tokens), self.batch_size):
+            self.insert_rows(Token, new_tokens[i:i + self.batch_size])
+        self.update_rows(Structure, changed_structs)
+        self.insert_rows(Structure, new_structs)
+        self.delete_rows(Token, deleted_tokens)
+
+        if token_offset < 0:
+            self.shift_rows(Token, token_end, token_offset)
+            self.shift_structure_positions(token_end, token_offset)
+        if struct_offset < 0:
+            self.shift_rows(Structure, struct_end, struct_offset)
+
+        self.log(1, " %s: %d tokens inserted, %d updated, %d deleted; %d structures inserted, %d updated, %d deleted" % (
+            self.current_book,
+            len(new_tokens), len(changed_tokens), len(deleted_tokens),
+            len(new_structs), len(changed_structs), len(deleted_structs),
+        ))
+        self.bookStructs = []
+        self.add_timing("write delta", start)
+
+
+    def truncate_work(self):
+        "Delete the rows left after the last book of a delta import, i.e. those of books no longer in the work"
+        structs = Structure.objects.filter(work = self.work1, position__gte = self.structCount)
+        self.delete_rows(Structure, list(structs.values_list("pk", flat = True)))
+        tokens = Token.objects.filter(work = self.work1, position__gte = self.tokenCount)
+        self.delete_rows(Token, list(tokens.values_list("pk", flat = True)))
+
+
+    def close_book(self):
+        "Close all open structures at the end of a book and write out its tokens and structures"
+        self.link_start_tokens()
+        for structElement in self.structs.keys():
+            self.close_structure(structElement)
+        if self.parsedBooks is not None:
+            parsed_book = (self.current_book, self.bookTokens, self.bookStructs, self.tokenCount, self.structCount)
+            # Positions start from zero in each book; write_parsed_book
+            # shifts them to follow the books already written
+            self.tokenCount = 0
+            self.structCount = 0
+            self.bookTokens = []
+            self.bookStructs = []
+            if self.intermediateFile is not None:
+                self.write_intermediate_book(*parsed_book)
+            else:
+                self.parsedBooks.append(parsed_book)
+            return
+        self.write_book()
+
+
+    def write_book(self):
+        "Write out the tokens and structures of the book just closed and commit them"
+        if self.delta:
+            self.apply_book_delta()
+        else:
+            self.flush_tokens()
+            self.flush_structures()
+        self.runTokens += len(self.bookTokens)
+        self.booksDone += 1
+        # Re-initialize the bookTokens array
+        self.bookTokens = []
+        self.commit_book()
+        self.report_progress()
+
+
+    def write_parsed_book(self, book_code, tokens, structs, token_count, struct_count):
+        """
+        Write out a book which was parsed separately by a parse_only importer.
+
+        The book's token and structure positions start from zero, so they are
+        shifted to follow the books already written before being saved.
+        """
+        self.current_book = book_code
+        for token in tokens:
+            token.position += self.tokenCount
+            self.identify_token(token)
+        for struct in structs:
+            struct.position += self.structCount
+            if struct.start_position is not None:
+                struct.start_position += self.tokenCount
+            if struct.end_position is not None:
+                struct.end_position += self.tokenCount
+            if struct.start_marker_position is not None:
+                struct.start_marker_position += self.tokenCount
+            if struct.end_marker_position is not None:
+                struct.end_marker_position += self.tokenCount
+        self.tokenCount += token_count
+        self.structCount += struct_count
+        self.bookTokens = tokens
+        if not self.delta:
+            self.pendingTokens = list(tokens)
+        self.bookStructs = structs
+        self.write_book()
+
+
+    def import_pipeline(self, source, stages, workers=1, mode=None):
+        """
+        Parse the items of the source with a Pipeline of stages and write out
+        the books which come out of it, in order, while the following items
+        are still being parsed.
+
+        The last stage yields books as collected in parsedBooks by a
+        parse_only importer (see parse_xml). Books committed by the import
+        being resumed are skipped. The mode defaults to processes for more
+        than one worker, and otherwise to a thread.
+        """
+        if mode is None:
+            mode = workers > 1 and "process" or "thread"
+        for parsed_book in Pipeline(source, stages, workers, mode):
+            if self.intermediateFile is not None:
+                self.write_intermediate_book(*parsed_book)
+            elif not self.is_book_imported(parsed_book[0]):
+                self.write_parsed_book(*parsed_book)
+
+
+    def parse_xml(self, data, handler):
+        """
+        Parse an XML document with a SAX handler which drives this
+        (parse_only) importer, yielding the books collected in parsedBooks as
+        soon as they are closed rather than once the whole document is parsed.
+        """
+        assert(self.parsedBooks is not None)
+        parser = xml.sax.make_parser()
+        parser.setContentHandler(handler)
+        for i in range(0, len(data), XML_CHUNK_SIZE):
+            parser.feed(data[i:i + XML_CHUNK_SIZE])
+            while self.parsedBooks:
+                yield self.parsedBooks.pop(0)
+        parser.close()
+        while self.parsedBooks:
+            yield self.parsedBooks.pop(0)
+
+
+    def open_intermediate(self, path, slug):
+        """
+        Have the books parsed by this (parse_only) importer written to an
+        intermediate file instead of the database, so that they can be
+        loaded later, elsewhere or many times over with load_intermediate.
+
+        The file has a header line and then, for each book, a "book" line
+        followed by a "t" line per token and an "s" line per structure, with
+        tab-separated fields. Token positions are implied by their order;
+        structure positions, and the token positions which structures start
+        and end at, are relative to the start of the book.
+        """
+        assert(self.parsedBooks is not None)
+        if path.endswith(".gz"):
+            self.intermediateFile = gzip.open(path, "wb")
+        else:
+            self.intermediateFile = open(path, "wb")
+        self.write_intermediate_line([INTERMEDIATE_FORMAT, INTERMEDIATE_VERSION, slug])
+
+
+    def write_intermediate_line(self, fields):
+        "Write a record to the intermediate file, escaping its fields"
+        line = []
+        for field in fields:
+            if field is None:
+                field = u""
+            line.append(INTERMEDIATE_ESCAPED.sub(lambda match: INTERMEDIATE_ESCAPES[match.group(0)], unicode(field)))
+        self.intermediateFile.write((u"\t".join(line) + u"\n").encode("utf-8"))
+
+
+    def write_intermediate_book(self, book_code, tokens, structs, token_count, struct_count):
+        "Write a book parsed by this importer or by a worker to the intermediate file"
+        start = time.time()
+        self.write_intermediate_line(["book", book_code, token_count, struct_count])
+        for token in tokens:
+            self.write_intermediate_line(["t", token.type, token.data, token.relative_source_url])
+        for struct in structs:
+            self.write_intermediate_line(["s", struct.position, struct.element, struct.osis_id,
+                struct.numerical_start, struct.numerical_end, struct.source_url,
+                struct.start_position, struct.end_position,
+                struct.start_marker_position, struct.end_marker_position])
+        self.runTokens += token_count
+        self.booksDone += 1
+        self.add_timing("write intermediate", start)
+
+
+    def close_intermediate(self):
+        self.intermediateFile.close()
+        self.intermediateFile = None
+        self.summarize()
+
+
+    def load_intermediate(self, path):
+        """
+        Write out the books in an intermediate file written by --parse-to
+        (see open_intermediate) as if they had just been parsed. Books which
+        were committed by the import being resumed are skipped.
+        """
+        if path.endswith(".gz"):
+            intermediate = gzip.open(path, "rb")
+        else:
+            intermediate = open(path, "rb")
+        header = intermediate.readline().rstrip("\n").split("\t")
+        if header[:2] != [INTERMEDIATE_FORMAT, INTERMEDIATE_VERSION]:
+            raise CommandError("%s is not an intermediate file of this version" % path)
+        if header[2] != self.work1.osis_slug:
+            raise CommandError("%s holds %s rather than %s" % (path, header[2], self.work1.osis_slug))
+
+        def int_or_none(value):
+            if value == u"":
+                return None
+            return int(value)
+
+        book = None
+        for line in intermediate:
+            fields = [
+                INTERMEDIATE_UNESCAPED.sub(lambda match: INTERMEDIATE_UNESCAPES[match.group(1)], field)
+                for field in line.decode("utf-8").rstrip(u"\n").split(u"\t")
+            ]
+            if fields[0] == u"book":
+                if book is not None and not self.is_book_imported(book[0]):
+                    self.write_parsed_book(*book)
+                book = (fields[1], [], [], int(fields[2]), int(fields[3]))
+            elif fields[0] == u"t":
+                book[1].append(Token(
+                    type     = int(fields[1]),
+                    data     = fields[2],
+                    work     = self.work1,
+                    position = len(book[1]),
+                    relative_source_url = fields[3],
+                ))
+            elif fields[0] == u"s":
+                struct = Structure(
+                    work            = self.work1,
+                    position        = int(fields[1]),
+                    element         = fields[2],
+                    osis_id         = fields[3],
+                    numerical_start = int_or_none(fields[4]),
+                    numerical_end   = int_or_none(fields[5]),
+                    source_url      = fields[6],
+                )
+                struct.start_position = int_or_none(fields[7])
+                struct.end_position = int_or_none(fields[8])
+                struct.start_marker_position = int_or_none(fields[9])
+                struct.end_marker_position = int_or_none(fields[10])
+                book[2].append(struct)
+        if book is not None and not self.is_book_imported(book[0]):
+            self.write_parsed_book(*book)
+        intermediate.close()
+
+
+    def begin_import(self):
+        """
+        Run the import inside a managed transaction which is committed once
+        per book (see commit_book) rather than once per row. If the import
+        fails, the partially-imported book is rolled back.
+        """
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        self.startTime = time.time()
+        self.lastProgress = self.startTime
+
+
+    def commit_book(self):
+        "Record a checkpoint for the book just completed and commit it along with the book's data"
+        start = time.time()
+        try:
+            checkpoint = ImportCheckpoint.objects.get(work = self.work1)
+        except ImportCheckpoint.DoesNotExist:
+            checkpoint = ImportCheckpoint(work = self.work1)
+        checkpoint.book = self.current_book
+        checkpoint.token_count = self.tokenCount
+        checkpoint.struct_count = self.structCount
+        checkpoint.save()
+        transaction.commit()
+        self.add_timing("commit", start)
+
+
+    def index_work(self):
+        """
+        Rebuild the work's VerseIndex from its book, chapter and verse
+        structures, once all of them have been written. Where several
+        structures share an osisID, the first one is indexed.
+        """
+        start = time.time()
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM %s WHERE %s = %%s" % (
+            qn(VerseIndex._meta.db_table),
+            qn(VerseIndex._meta.get_field("work").column),
+        ), [self.work1.id])
+        structs = Structure.objects.filter(
+            work = self.work1,
+            element__in = VerseIndex.ELEMENTS,
+            start_position__isnull = False,
+            end_position__isnull = False,
+        ).exclude(osis_id = "").order_by("position").values_list("pk", "osis_id", "start_position", "end_position")
+        entries = []
+        indexed = set()
+        for pk, osis_id, start_position, end_position in structs:
+            if osis_id in indexed:
+                continue
+            indexed.add(osis_id)
+            entries.append(VerseIndex(
+                work = self.work1,
+                osis_id = osis_id,
+                structure_id = pk,
+                start_position = start_position,
+                end_position = end_position,
+            ))
+        for i in range(0, len(entries), self.batch_size):
+            self.insert_rows(VerseIndex, entries[i:i + self.batch_size])
+        self.add_timing("write index", start)
+
+
+    def write_token_store(self):
+        """
+        Write the memory-mapped store of the work's tokens to TOKEN_STORE_DIR
+        at the work's current import_generation, if the setting is set.
+        """
+        directory = getattr(settings, "TOKEN_STORE_DIR", None)
+        if not directory:
+            return
+        start = time.time()
+        generation = Work.objects.filter(pk = self.work1.pk).values_list("import_generation", flat = True)[0]
+        rows = Token.objects.filter(work = self.work1).order_by("position").values_list(*TokenRecord.FIELDS).iterator()
+        write_token_store(token_store_path(directory, self.work1.pk), generation, rows)
+        self.add_timing("write token store", start)
+
+
+    def end_import(self):
+        if self.delta:
+            self.truncate_work()
+        if self.work1 is not None:
+            self.index_work()
+            Work.objects.filter(pk = self.work1.pk).update(import_generation = F("import_generation") + 1)
+        transaction.commit()
+        if self.work1 is not None:
+            self.write_token_store()
+        transaction.leave_transaction_management()
+        self.summarize()
+
+
+    def log(self, level, message):
+        "Print the message if the verbosity is at least the provided level"
+        if self.verbosity >= level:
+            print message
+
+
+    def add_timing(self, phase, start):
+        "Add the time since start to the total for the phase"
+        self.timings[phase] = self.timings.get(phase, 0) + time.time() - start
+
+
+    def report_progress(self):
+        """
+        Print the current book, the import rate and, if the number of books
+        is known, an estimate of the time remaining; at most once every
+        PROGRESS_INTERVAL seconds.
+        """
+        now = time.time()
+        if self.verbosity < 1 or now - self.lastProgress < PROGRESS_INTERVAL:
+            return
+        self.lastProgress = now
+        elapsed = now - self.startTime
+        tokens = self.runTokens + len(self.bookTokens)
+        line = "%s: %d tokens, %d tokens/sec" % (self.current_book, tokens, tokens / elapsed)
+        if self.bookTotal and self.booksDone:
+            remaining = elapsed / self.booksDone * max(self.bookTotal - self.booksDone, 0)
+            line += ", ETA %s" % datetime.timedelta(seconds = int(remaining))
+        print line
+
+
+    def summarize(self):
+        "Print the totals and rate of the import and the time spent in each phase"
+        elapsed = time.time() - self.startTime
+        self.log(1, "Imported %d books (%d tokens) in %.1fs, %d tokens/sec" % (
+            self.booksDone, self.runTokens, elapsed, self.runTokens / max(elapsed, 0.001)))
+        # Whatever time is not spent writing is spent parsing
+        timings = sorted(self.timings.items())
+        timings.insert(0, ("parse", elapsed - sum(self.timings.values())))
+        for phase, seconds in timings:
+            self.log(1, "  %-20s %8.2fs" % (phase, seconds))
+
+
+    def resume_work(self, slug):
+        """
+        Pick up the work with the provided slug where its last import left off.
+
+        Returns False if there is no checkpoint to resume from, in which case
+        the import should start from the beginning.
+        """
+        try:
+            checkpoint = ImportCheckpoint.objects.select_related().get(work__osis_slug = slug)
+        except ImportCheckpoint.DoesNotExist:
+            self.log(1, " (no checkpoint found for %s; starting from the beginning)" % slug)
+            return False
+        self.work1 = checkpoint.work
+        self.tokenCount = checkpoint.token_count
+        self.structCount = checkpoint.struct_count
+        self.resume_book = checkpoint.book
+        self.log(1, "Resuming %s after %s" % (slug, checkpoint.book))
+        return True
+
+
+    def delta_work(self, slug):
+        """
+        Update the existing work with the provided slug in place (see
+        apply_book_delta) rather than deleting and re-importing it.
+
+        Returns False if the work has not been imported yet, in which case it
+        should be imported from scratch.
+        """
+        if self.work1 is None:
+            try:
+                self.work1 = Work.objects.get(osis_slug = slug)
+            except Work.DoesNotExist:
+                self.log(1, " (%s not imported yet; importing it in full)" % slug)
+                return False
+        self.delta = True
+        return True
+
+
+    def is_book_imported(self, book_code):
+        "Whether the book was already committed by the import being resumed"
+        if self.resume_book not in self.book_codes or book_code not in self.book_codes:
+            return False
+        return self.book_codes.index(book_code) <= self.book_codes.index(self.resume_book)
 
 
     def link_start_tokens(self):
         """
-        Links structure.start_token to the most recent token.
+        Links structure.start_position to the most recent token.
 
         Structure objects require a start_token. However, that token is
         not typically present when the structure is created. Find each 
-        open Structure which lacks a start_token and link it to the most
+        open Structure which lacks a start_position and link it to the most
         recently created token. This should be run after tokens are created.
         """
         
         # Only attmpt a link if there is a token. Only a concern for first paragraph token in book
         if len(self.bookTokens) > 0:
             for struct in self.structs.values():
-                if struct.start_token is None:
-                    struct.start_token = self.bookTokens[-1]
-                    struct.save()
+                if struct.start_position is None:
+                    struct.start_position = self.bookTokens[-1].position
 
 
     def delete_work(self, work):
-        "Deletes a work without a greedy cascade"
+        """
+        Deletes a work without a greedy cascade.
+
+        Instead of having the ORM collect every related object in memory to
+        emulate ON DELETE CASCADE, each table in WORK_DEPENDENTS is emptied
+        of the work's rows with a single DELETE statement. Returns a list of
+        (table name, number of rows deleted) pairs.
+        """
      
         #if work.variants_for_work is not None:
             #delete_work(work.variants_for_work)
-    
-        # Clear all links to unified text
-        Token.objects.filter(work = work).delete() #Does this need to be two linces?
-    
+
         # Delete all variant works
         #Work.objects.filter(variants_for_work = work).delete()
-    
-        # Delete work
-        #Work.objects.filter(id=workID).update(unified_token=None)        
-        work.delete()
-        return True
+
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        counts = []
+        for app_label, model_name, path in WORK_DEPENDENTS:
+            model = get_model(app_label, model_name)
+            if model is None:
+                continue
+            cursor.execute("DELETE FROM %s WHERE %s" % (
+                qn(model._meta.db_table),
+                self.work_condition(model, path),
+            ), [work.id])
+            counts.append((model._meta.db_table, cursor.rowcount))
+            self.log(1, " %s: %d rows deleted" % counts[-1])
+        transaction.commit_unless_managed()
+        return counts
+
+
+    def work_condition(self, model, path):
+        """
+        SQL condition for the rows of model which belong to a work, following
+        the chain of foreign keys in path through nested sub-selects. The
+        work's ID is the one parameter.
+        """
+        qn = connection.ops.quote_name
+        field = model._meta.get_field(path[0])
+        if len(path) == 1:
+            return "%s = %%s" % qn(field.column)
+        related = field.rel.to
+        return "%s IN (SELECT %s FROM %s WHERE %s)" % (
+            qn(field.column),
+            qn(related._meta.pk.column),
+            qn(related._meta.db_table),
+            self.work_condition(related, path[1:]),
+        )
 
 
     def normalize_token(self, data):
         "Normalize to Unicode NFC, strip out all diacritics, apostrophies, and make lower-case."
+        try:
+            return normalized_forms[data]
+        except KeyError:
+            pass
         # credit: http://stackoverflow.com/questions/517923/what-is-the-best-way-to-remove-accents-in-a-python-unicode-string
-        data = unicodedata.normalize('NFC', ''.join((c for c in unicodedata.normalize('NFD', data) if unicodedata.category(c) != 'Mn')).lower())
-        data = data.replace(r'\s+', ' ')
-        #data = re.sub(ur"['’]", '', data)
-        data = data.replace(u"'", '')
-        data = data.replace(u"’", '')
-        return data
+        normalized = unicodedata.normalize('NFC', unicodedata.normalize('NFD', data).translate(NORMALIZE_TABLE).lower())
+        if len(normalized_forms) >= NORMALIZE_CACHE_SIZE:
+            normalized_forms.clear()
+        normalized_forms[data] = normalized
+        return normalized
+
+    def normalize_tokens(self, data_list):
+        "Normalize the data of a whole verse, chapter or book of tokens at once (see normalize_token)"
+        normalize_token = self.normalize_token
+        get = normalized_forms.get
+        normalized = []
+        for data in data_list:
+            form = get(data)
+            if form is None:
+                form = normalize_token(data)
+            normalized.append(form)
+        return normalized
 
     def download_resource(self, source_url):
         "Download the file in the provided URL if it does not already exist in the working directory."
         if(not os.path.exists(os.path.basename(source_url))):
             if(not os.path.exists(os.path.basename(source_url))):
-                print "Downloading " + source_url
+                self.log(1, "Downloading " + source_url)
                 urllib.urlretrieve(source_url, os.path.basename(source_url))
 
     def abort_if_imported(self, slug, force=False):
@@ -248,14 +1241,14 @@ class OpenScripturesImport():
     def close_structure(self, element):
         if self.structs.has_key(element):
             # Ensure the structure has a start_token
-            assert(self.structs[element].start_token is not None)
-            if self.structs[element].end_token is None:
+            assert(self.structs[element].start_position is not None)
+            if self.structs[element].end_position is None:
             # Exclude whitespace tokens from the end of verses and chapters
                 if self.bookTokens[-1].data == " " and (element == "chapter" or element == "verse"):
-                    self.structs[element].end_token = self.bookTokens[-2]
+                    self.structs[element].end_position = self.bookTokens[-2].position
                 else:
-                    self.structs[element].end_token = self.bookTokens[-1]
-            self.structs[element].save()
+                    self.structs[element].end_position = self.bookTokens[-1].position
+            self.bookStructs.append(self.structs[element])
             del self.structs[element]
 
 # TODO
@@ -0,0 +1,316 @@
+# encoding: utf-8
+#
+# Measures the throughput of the load_* importers on synthetic corpora which
+# mimic the structure of the real source files, so that the importers can be
+# compared between releases without downloading anything.
+
+# Standard library imports
+import datetime
+from optparse import make_option
+import os
+import resource
+import shutil
+import tempfile
+import time
+import traceback
+import zipfile
+
+# Django imports
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from django.utils import simplejson
+
+# Openscriptures imports
+from apps.core import osis
+from apps.importers.import_helpers import TOKEN_BATCH_SIZE
+from apps.importers.pipeline import PIPELINE_MODES
+from apps.importers.management.commands import load_kjv, load_sblgnt, load_tischendorf
+from apps.texts.models import Work, Token, Structure
+
+
+ENGLISH_WORDS = [u"In", u"the", u"beginning", u"God", u"created", u"heaven", u"and", u"earth"]
+GREEK_WORDS = [u"Ἰούδας", u"Ἰησοῦ", u"Χριστοῦ", u"δοῦλος", u"ἀδελφὸς", u"δὲ", u"Ἰακώβου", u"τοῖς"]
+
+
+def verse_words(vocabulary, n, count):
+    "The words of the nth verse: count words cycling through the vocabulary"
+    return [vocabulary[(n + i) % len(vocabulary)] for i in range(count)]
+
+
+def write_kjv(book_codes, chapters, verses, words):
+    "Write a kjvxml.zip in the style of the Crosswire KJV 2006 OSIS text"
+    xml = [u'<?xml version="1.0" encoding="utf-8"?><osis><osisText><header/>']
+    n = 0
+    for book_code in book_codes:
+        xml.append(u'<div type="book" osisID="%s" canonical="true">' % book_code)
+        for chapter in range(1, chapters + 1):
+            xml.append(u'<chapter osisID="%s.%d" n="%d">' % (book_code, chapter, chapter))
+            for verse in range(1, verses + 1):
+                if verse % 5 == 1:
+                    xml.append(u'<milestone type="x-p" marker="¶"/>')
+                osis_id = u"%s.%d.%d" % (book_code, chapter, verse)
+                xml.append(u'<verse osisID="%s" sID="%s"/>' % (osis_id, osis_id))
+                xml.append(u", ".join(verse_words(ENGLISH_WORDS, n, words)) + u".")
+                xml.append(u'<verse eID="%s"/>' % osis_id)
+                n += 1
+            xml.append(u'</chapter>')
+        xml.append(u'</div>')
+    xml.append(u'</osisText></osis>')
+    _zip = zipfile.ZipFile(os.path.basename(load_kjv.SOURCE_URL), "w")
+    _zip.writestr("kjvlite.xml", u"".join(xml).encode("utf-8"))
+    _zip.close()
+
+
+def write_sblgnt(book_codes, chapters, verses, words):
+    "Write an SBLGNTxml.zip in the style of the SBLGNT XML edition"
+    xml = [u'<?xml version="1.0" encoding="utf-8"?><sblgnt><title>SBLGNT</title>']
+    n = 0
+    for book_code in book_codes:
+        book_id = load_sblgnt.BOOK_ID_LOOKUP[book_code]
+        xml.append(u'<book id="%s"><title>%s</title>' % (book_id, book_code))
+        for chapter in range(1, chapters + 1):
+            for verse in range(1, verses + 1):
+                if verse % 5 == 1:
+                    if n:
+                        xml.append(u'</p>')
+                    xml.append(u'<p>')
+                label = unicode(verse)
+                if verse == 1:
+                    label = u"%d:%d" % (chapter, verse)
+                xml.append(u'<verse-number id="%s %d:%d">%s</verse-number>' % (book_id, chapter, verse, label))
+                for i, word in enumerate(verse_words(GREEK_WORDS, n, words)):
+                    suffix = u" "
+                    if i == words - 1:
+                        suffix = u", "
+                    xml.append(u'<w>%s</w><suffix>%s</suffix>' % (word, suffix))
+                n += 1
+        xml.append(u'</p></book>')
+        n = 0
+    xml.append(u'</sblgnt>')
+    _zip = zipfile.ZipFile(os.path.basename(load_sblgnt.SOURCE_URL), "w")
+    _zip.writestr("sblgnt.xml", u"".join(xml).encode("utf-8"))
+    _zip.close()
+
+
+def write_tischendorf(book_codes, chapters, verses, words):
+    "Write a Tischendorf-2.6.zip in the style of the MorphGNT one-word-per-line files"
+    _zip = zipfile.ZipFile(os.path.basename(load_tischendorf.SOURCE_URL), "w")
+    for book_code in book_codes:
+        filename = load_tischendorf.BOOK_FILENAME_LOOKUP[book_code]
+        lines = []
+        n = 0
+        for chapter in range(1, chapters + 1):
+            for verse in range(1, verses + 1):
+                for i, word in enumerate(verse_words(GREEK_WORDS, n, words)):
+                    # Paragraph and chapter breaks, punctuation and doubted words
+                    brk = u"."
+                    if i == 0 and verse == 1 and chapter > 1:
+                        brk = u"C"
+                    elif i == 0 and verse % 5 == 1 and (chapter, verse) != (1, 1):
+                        brk = u"P"
+                    text = word
+                    if i == words - 1:
+                        text += u","
+                    if verse % 7 == 3 and words > 2:
+                        if i == 1:
+                            text = u"[" + text
+                        elif i == 2:
+                            text += u"]"
+                    lines.append(u"%s %d:%d.%d %s %s %s N-NSM 2455 %s ! %s" % (
+                        filename[:-4], chapter, verse, i + 1, brk, text, text, word, word))
+                n += 1
+        _zip.writestr("Tischendorf-2.6/Unicode/" + filename, (u"\n".join(lines) + u"\n").encode("utf-8"))
+    _zip.close()
+
+
+def peak_rss():
+    """
+    Peak resident set size in kilobytes of this process or any of its (worker)
+    children so far; this is a high-water mark for the lifetime of the process,
+    which is why each stage is run in a process of its own (see run_stage)
+    """
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+class Command(BaseCommand):
+    help = 'Runs the load_* importers on synthetic corpora in a scratch SQLite database and reports their throughput as JSON. Each importer runs in a child process, so its peak_rss_kb is its own.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--books',
+            action='store',
+            type='int',
+            dest='books',
+            default=3,
+            help='Number of books in each corpus'),
+        make_option('--chapters',
+            action='store',
+            type='int',
+            dest='chapters',
+            default=10,
+            help='Number of chapters in each book'),
+        make_option('--verses',
+            action='store',
+            type='int',
+            dest='verses',
+            default=20,
+            help='Number of verses in each chapter'),
+        make_option('--words',
+            action='store',
+            type='int',
+            dest='words',
+            default=12,
+            help='Number of words in each verse'),
+        make_option('--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=1,
+            help='Number of threads or processes the SBLGNT and Tischendorf importers parse books with'),
+        make_option('--pipeline',
+            action='store',
+            type='choice',
+            choices=PIPELINE_MODES,
+            dest='pipeline',
+            default=None,
+            help='How the importers run their parsing: inline, in threads or in processes (see load_* --pipeline)'),
+        make_option('--batch-size',
+            action='store',
+            type='int',
+            dest='batch_size',
+            default=TOKEN_BATCH_SIZE,
+            help='Number of tokens the importers buffer before writing them to the database'),
+        make_option('--output',
+            action='store',
+            dest='output',
+            default=None,
+            help='File to write the JSON report to instead of standard output'),
+        )
+
+
+    def run_stage(self, command, slug, args, options):
+        """
+        Run one of the load_* commands in a child process and return its
+        statistics, so that the peak resident set size of each stage is not
+        that of the stages before it.
+        """
+        # The child opens its own connection to the scratch database
+        connection.close()
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+            status = 0
+            try:
+                try:
+                    stats = self.measure_stage(command, slug, args, options)
+                except BaseException:
+                    stats = {"error": traceback.format_exc()}
+                    status = 1
+                output = os.fdopen(write_end, "w")
+                output.write(simplejson.dumps(stats))
+                output.close()
+            finally:
+                # Skip the parent's clean-up of the scratch database
+                os._exit(status)
+
+        os.close(write_end)
+        _input = os.fdopen(read_end)
+        stats = _input.read()
+        _input.close()
+        pid, status = os.waitpid(pid, 0)
+        if not stats:
+            raise CommandError("%s exited with status %d" % (command, status))
+        stats = simplejson.loads(stats)
+        if "error" in stats:
+            raise CommandError("%s failed:\n%s" % (command, stats["error"]))
+        return stats
+
+
+    def measure_stage(self, command, slug, args, options):
+        """
+        Run one of the load_* commands with its output suppressed and return
+        its statistics. Queries are counted by running with DEBUG on.
+        """
+        reset_queries()
+        start = time.time()
+        call_command(command, verbosity=0, *args, **options)
+        seconds = time.time() - start
+        queries = len(connection.queries)
+
+        work = Work.objects.get(osis_slug = slug)
+        tokens = Token.objects.filter(work = work).count()
+        structures = Structure.objects.filter(work = work).count()
+        return {
+            "command": command,
+            "seconds": round(seconds, 3),
+            "tokens": tokens,
+            "structures": structures,
+            "tokens_per_second": round(tokens / seconds, 1),
+            "structures_per_second": round(structures / seconds, 1),
+            "queries": queries,
+            "peak_rss_kb": peak_rss(),
+        }
+
+
+    def handle(self, *args, **options):
+        if connection.settings_dict["ENGINE"] != "django.db.backends.sqlite3":
+            raise CommandError("The benchmark needs the sqlite3 database backend")
+
+        ot_books = osis.BOOK_ORDERS["Bible"]["KJV"][:options["books"]]
+        nt_books = [book_code for book_code in osis.BOOK_ORDERS["Bible"]["KJV"] if book_code in load_tischendorf.BOOK_FILENAME_LOOKUP][:options["books"]]
+        size = (options["chapters"], options["verses"], options["words"])
+
+        # The importers read their source files from the working directory
+        directory = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(directory)
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        database_name = connection.settings_dict["NAME"]
+        connection.settings_dict["TEST_NAME"] = os.path.join(directory, "benchmark.db")
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            write_kjv(ot_books, *size)
+            write_sblgnt(nt_books, *size)
+            write_tischendorf(nt_books, *size)
+            import_options = {
+                "force": True,
+                "batch_size": options["batch_size"],
+                "workers": options["workers"],
+                "pipeline": options["pipeline"],
+            }
+            stages = [
+                self.run_stage("load_kjv", "KJV", [], import_options),
+                self.run_stage("load_sblgnt", "SBLGNT", [], import_options),
+                self.run_stage("load_tischendorf", "Tischendorf", nt_books, import_options),
+            ]
+        finally:
+            connection.creation.destroy_test_db(database_name, verbosity=0)
+            settings.DEBUG = debug
+            os.chdir(cwd)
+            shutil.rmtree(directory)
+
+        report = simplejson.dumps({
+            "date": datetime.datetime.now().isoformat(),
+            "corpus": {
+                "books": options["books"],
+                "chapters": options["chapters"],
+                "verses": options["verses"],
+                "words": options["words"],
+            },
+            "workers": options["workers"],
+            "pipeline": options["pipeline"],
+            "batch_size": options["batch_size"],
+            "stages": stages,
+        }, indent=2, sort_keys=True)
+        if options["output"]:
+            output = open(options["output"], "w")
+            output.write(report)
+            output.close()
+        else:
+            print report
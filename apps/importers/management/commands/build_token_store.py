@@ -0,0 +1,34 @@
+# encoding: utf-8
+
+# Django imports
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Openscriptures imports
+from apps.importers.import_helpers import OpenScripturesImport
+from apps.texts.models import Work
+
+
+class Command(BaseCommand):
+    args = '<KJV SBLGNT ...>'
+    help = 'Writes the memory-mapped token stores of the works with the provided slugs to TOKEN_STORE_DIR, e.g. of works imported before it was set.'
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("Provide the osis_slug of each work to write the token store of")
+        if not getattr(settings, "TOKEN_STORE_DIR", None):
+            raise CommandError("Set TOKEN_STORE_DIR to the directory to write the token stores to")
+
+        works = []
+        for slug in args:
+            try:
+                works.append(Work.objects.get(osis_slug=slug))
+            except Work.DoesNotExist:
+                raise CommandError("There is no work with the slug %s" % slug)
+
+        importer = OpenScripturesImport(verbosity=int(options["verbosity"]))
+        for work in works:
+            importer.log(1, work.osis_slug)
+            importer.work1 = work
+            importer.write_token_store()
+        importer.summarize()
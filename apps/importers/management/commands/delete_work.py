@@ -0,0 +1,32 @@
+# encoding: utf-8
+
+# Django imports
+from django.core.management.base import BaseCommand, CommandError
+
+# Openscriptures imports
+from apps.importers.import_helpers import OpenScripturesImport
+from apps.texts.models import Work
+
+
+class Command(BaseCommand):
+    args = '<KJV SBLGNT ...>'
+    help = 'Deletes the works with the provided slugs along with their tokens and structures.'
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("Provide the osis_slug of each work to delete")
+
+        works = []
+        for slug in args:
+            try:
+                works.append(Work.objects.get(osis_slug=slug))
+            except Work.DoesNotExist:
+                raise CommandError("There is no work with the slug %s" % slug)
+
+        # Delete all of the works in one transaction
+        importer = OpenScripturesImport(verbosity=int(options["verbosity"]))
+        importer.begin_import()
+        for work in works:
+            importer.log(1, work.osis_slug)
+            importer.delete_work(work)
+        importer.end_import()
@@ -0,0 +1,33 @@
+# encoding: utf-8
+
+# Django imports
+from django.core.management.base import BaseCommand, CommandError
+
+# Openscriptures imports
+from apps.importers.import_helpers import OpenScripturesImport
+from apps.texts.models import Work
+
+
+class Command(BaseCommand):
+    args = '<KJV SBLGNT ...>'
+    help = 'Fills in the token positions stored on the structures of the works with the provided slugs and rebuilds their verse index, e.g. for works imported before these existed.'
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("Provide the osis_slug of each work to index")
+
+        works = []
+        for slug in args:
+            try:
+                works.append(Work.objects.get(osis_slug=slug))
+            except Work.DoesNotExist:
+                raise CommandError("There is no work with the slug %s" % slug)
+
+        importer = OpenScripturesImport(verbosity=int(options["verbosity"]))
+        importer.begin_import()
+        for work in works:
+            importer.log(1, work.osis_slug)
+            importer.work1 = work
+            importer.fill_structure_positions()
+            importer.index_work()
+        importer.end_import()
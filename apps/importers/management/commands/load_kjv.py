@@ -13,14 +13,13 @@ import re
 import unicodedata
 import xml.sax
 import zipfile
-import StringIO
 
 # Django imports
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 # Open Scriptures imports
 from apps.core import osis
-from apps.importers.import_helpers import OpenScripturesImport
+from apps.importers.import_helpers import OpenScripturesImport, IMPORT_OPTIONS
 from apps.texts.models import Work, Token, Structure, WorkServer
 from apps.core.models import Language, License, Server
 
@@ -42,11 +41,16 @@ class KJVParser(xml.sax.handler.ContentHandler):
         self.in_note = 0
         self.in_milestone = 0
         self.in_colophon = 0
+        # Set while passing over a book committed by a previous run
+        self.skipping_book = 0
         self.importer = importer
 
     def startElement(self, name, attrs):
         """Actions for encountering opening tags"""
-        
+
+        if self.skipping_book:
+            return
+
         if name == "div":
             # Once we are in the book tag, the real text has begun
             self.in_text = 1            
@@ -61,13 +65,18 @@ class KJVParser(xml.sax.handler.ContentHandler):
                 (name, value) = each
                 names.append(name)
                 values.append(value)
+            if "colophon" not in values:
+                (name, value) = attrs.items()[2]
+                self.importer.current_book = value
+            # Colophons belong to the preceding book
+            if self.importer.is_book_imported(self.importer.current_book):
+                self.skipping_book = 1
+                return
             # Avoid problems with the colophon tag
             if "colophon" in values:
                 self.in_colophon = 1
                 self.importer.create_colophon_struct()
             else:
-                (name, value) = attrs.items()[2]
-                self.importer.current_book = value
                 self.importer.create_book_struct()
 
         elif name == "chapter":
@@ -114,6 +123,8 @@ class KJVParser(xml.sax.handler.ContentHandler):
 
     def characters(self, data):
         """Handle the tags which enclose data needed for import"""
+        if self.skipping_book:
+            return
         # Only import inside of verses, avoiding new lines
         if self.in_text and (self.in_colophon or self.in_title or self.in_verse) and (not self.in_note):
             # REGEX to the rescue!
@@ -147,16 +158,17 @@ class KJVParser(xml.sax.handler.ContentHandler):
     def endElement(self, name):
         """Actions for encountering closing tags"""
 
+        if self.skipping_book:
+            if name == "div":
+                self.skipping_book = 0
+            return
+
         if name == "div":
             self.in_book = 0
             if self.in_colophon:
                 self.in_colophon = 0
                 self.importer.close_structure("colophon")
-            self.importer.link_start_tokens()
-            for structElement in self.importer.structs.keys():               
-                self.importer.close_structure(structElement)
-            # Re-initialize the bookTokens array 
-            self.importer.bookTokens = []
+            self.importer.close_book()
 
         elif name == "chapter":
             self.in_chapter = 0
@@ -176,6 +188,24 @@ class KJVParser(xml.sax.handler.ContentHandler):
         elif name == "milestone":
             self.in_milestone = 0
 
+# The stages of the import pipeline (see OpenScripturesImport.import_pipeline),
+# run on a task of (work ID, book codes, verbosity)
+
+def read_document(task):
+    "Read the KJV lite XML document out of the ZIP"
+    _zip = zipfile.ZipFile(os.path.basename(SOURCE_URL))
+    yield task, _zip.read("kjvlite.xml")
+
+def parse_xml(item):
+    "Tokenize the document with a parse_only importer, yielding each book once it is closed"
+    (work_id, book_codes, verbosity), document = item
+    importer = OpenScripturesImport(parse_only=True, verbosity=verbosity)
+    importer.work1 = Work(id = work_id)
+    importer.book_codes = book_codes
+    return importer.parse_xml(document, KJVParser(importer))
+
+IMPORT_STAGES = (read_document, parse_xml)
+
 class Command(BaseCommand):
     #args = '<Jude John ...>'
     #help = 'Limits the scope of the load to just to the books specified.'
@@ -186,24 +216,13 @@ class Command(BaseCommand):
             dest='force',
             default=False,
             help='Force load despite it already being loaded'),
-        )
+        ) + IMPORT_OPTIONS
 
 
 ### Main command handle below
 
-    def handle(self, *args, **options):
-        self.importer = OpenScripturesImport()
-
-        # Abort if MS has already been added (or --force not supplied)
-        self.importer.abort_if_imported("KJV", options["force"])
-
-        # Download the source file
-        self.importer.download_resource(SOURCE_URL)
-
-        # Create Works
-        if len(Work.objects.filter(osis_slug="KJV")) > 0:        
-            self.importer.delete_work(Work.objects.get(osis_slug="KJV"))
-        self.importer.work1 = Work(
+    def create_work(self):
+        work = Work(
             #id           = WORK1_ID,
             title        = "King James Version (1769)",
             language     = Language('eng'),
@@ -216,12 +235,60 @@ class Command(BaseCommand):
             source_url   = SOURCE_URL,
             license      = License.objects.get(url="http://creativecommons.org/licenses/publicdomain/")
         )
-        self.importer.work1.save()
+        work.save()
         
         WorkServer.objects.create(
-            work = self.importer.work1,
+            work = work,
             server = Server.objects.get(is_self = True)
         )
+        return work
+
+    def import_books(self, options):
+        "Parse the books of the KJV"
+        self.importer.bookTotal = len([book_code for book_code in self.importer.book_codes if not self.importer.is_book_imported(book_code)])
+
+        # The document is parsed by one worker as it is, and each book is
+        # written out as soon as it has been parsed
+        task = (self.importer.work1.id, self.importer.book_codes, self.importer.verbosity)
+        self.importer.import_pipeline([task], IMPORT_STAGES, 1, options["pipeline"])
+
+    def handle(self, *args, **options):
+        if options["parse_to"] and options["load_from"]:
+            raise CommandError("--parse-to and --load-from cannot be combined")
+
+        self.importer = OpenScripturesImport(batch_size=options["batch_size"], verbosity=int(options["verbosity"]), parse_only=bool(options["parse_to"]), copy=options["copy"])
+        self.importer.book_codes = osis.BOOK_ORDERS["Bible"]["KJV"]
+
+        # Only parse the source, for loading later with --load-from
+        if options["parse_to"]:
+            self.importer.work1 = Work(osis_slug="KJV")
+            self.importer.open_intermediate(options["parse_to"], "KJV")
+            self.importer.download_resource(SOURCE_URL)
+            self.import_books(options)
+            self.importer.close_intermediate()
+            return
+
+        self.importer.begin_import()
+
+        # Continue from the last committed book of an interrupted import
+        resuming = options["resume"] and self.importer.resume_work("KJV")
+
+        # Update the existing work with only the rows which changed
+        updating = options["delta"] and self.importer.delta_work("KJV")
+
+        # Abort if MS has already been added (or --force not supplied)
+        if not resuming and not updating:
+            self.importer.abort_if_imported("KJV", options["force"])
+
+        # Download the source file
+        if not options["load_from"]:
+            self.importer.download_resource(SOURCE_URL)
+
+        # Create Works
+        if not resuming and not updating:
+            if len(Work.objects.filter(osis_slug="KJV")) > 0:        
+                self.importer.delete_work(Work.objects.get(osis_slug="KJV"))
+            self.importer.work1 = self.create_work()
 
         # Get the subset of OSIS book codes provided on command line
         #limited_book_codes = []
@@ -232,15 +299,14 @@ class Command(BaseCommand):
         #book_codes = osis.BOOK_ORDERS["Bible"]["KJV"]
         #if len(limited_book_codes) > 0:
             #book_codes = limited_book_codes
-        self.importer.book_codes = osis.BOOK_ORDERS["Bible"]["KJV"]
 
-        # Initialize the parser and set it up
-        self.parser = xml.sax.make_parser()        
-        self.parser.setContentHandler(KJVParser(self.importer))
-        _zip = zipfile.ZipFile(os.path.basename(SOURCE_URL))
-        self.parser.parse(StringIO.StringIO(_zip.read("kjvlite.xml")))
-        print "Total tokens %d" % self.importer.tokenCount
-        print "Total structures: %d" % self.importer.structCount
+        if options["load_from"]:
+            self.importer.load_intermediate(options["load_from"])
+        else:
+            self.import_books(options)
+        self.importer.end_import()
+        self.importer.log(1, "Total tokens %d" % self.importer.tokenCount)
+        self.importer.log(1, "Total structures: %d" % self.importer.structCount)
 
 
 # TODO
@@ -7,17 +7,17 @@
 import datetime
 from optparse import make_option
 import os
+import re
 import unicodedata
 import xml.sax
 import zipfile
-import StringIO
 
 # Django imports
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 # Open Scriptures imports
 from apps.core import osis
-from apps.importers.import_helpers import OpenScripturesImport
+from apps.importers.import_helpers import OpenScripturesImport, IMPORT_OPTIONS
 from apps.texts.models import Work, Token, Structure, WorkServer
 from apps.core.models import Language, License, Server
 
@@ -54,6 +54,9 @@ BOOK_ID_LOOKUP = {
 	'Rev'    : "Re"   ,
 }
 
+# Used to split the document into its books for parsing them in parallel
+BOOK_ELEMENT = re.compile(r'<book\b[^>]*\bid="([^"]+)".*?</book>', re.DOTALL)
+
 class SBLGNTParser(xml.sax.handler.ContentHandler):
     """Class to parse the SBL GNT XML file"""
 
@@ -66,11 +69,16 @@ class SBLGNTParser(xml.sax.handler.ContentHandler):
         self.in_word = 0
         self.in_suffix = 0
         self.children_in_p = -1
+        # Set while passing over a book committed by a previous run
+        self.skipping_book = 0
         self.importer = importer
 
     def startElement(self, name, attrs):
         """Actions for encountering opening tags"""
-        
+
+        if self.skipping_book:
+            return
+
         if name == "book":
             # Once we are in the book tag, the real text has begun
             self.in_text = 1            
@@ -82,6 +90,10 @@ class SBLGNTParser(xml.sax.handler.ContentHandler):
             for key in BOOK_ID_LOOKUP:
                 if BOOK_ID_LOOKUP[key] == value:
                     self.importer.current_book = key
+            if self.importer.is_book_imported(self.importer.current_book):
+                self.importer.log(2, "%s (already imported)" % self.importer.current_book)
+                self.skipping_book = 1
+                return
             self.importer.create_book_struct()
 
         elif name == "verse-number":
@@ -110,6 +122,9 @@ class SBLGNTParser(xml.sax.handler.ContentHandler):
     def characters(self, data):
         """Handle the tags which enclose data needed for import"""
 
+        if self.skipping_book:
+            return
+
         if self.in_word:
             # Here handle word tokens
             self.importer.create_token(data)
@@ -143,16 +158,17 @@ class SBLGNTParser(xml.sax.handler.ContentHandler):
     def endElement(self, name):
         """Actions for encountering closing tags"""
 
+        if self.skipping_book:
+            if name == "book":
+                self.skipping_book = 0
+            return
+
         if name == "book":
 	        # Close struct for book
             # Attribute is "id"
             self.in_book = 0
             #self.importer.close_structure(Structure.BOOK)
-            self.importer.link_start_tokens()            
-            for structElement in self.importer.structs.keys():               
-                self.importer.close_structure(structElement)
-            # Re-initialize the bookTokens array 
-            self.importer.bookTokens = []
+            self.importer.close_book()
 
         elif name == "verse-number":
             # Verse number tag is self-closing
@@ -162,7 +178,7 @@ class SBLGNTParser(xml.sax.handler.ContentHandler):
             # If this is a self-closing tag, link start-token to paragraph token
             self.in_paragraph = 0
             if self.children_in_p == 0 and self.in_text:
-                print "<p />"
+                self.importer.log(2, "<p />")
                 self.importer.link_start_tokens()
 
         elif name == "w":
@@ -173,6 +189,22 @@ class SBLGNTParser(xml.sax.handler.ContentHandler):
             # Have already tokenized data, nothing more to do
             self.in_suffix = 0
 
+# The stages of the import pipeline (see OpenScripturesImport.import_pipeline),
+# run on a task of (work ID, book codes, verbosity)
+
+def read_document(task):
+    "Read the whole SBLGNT XML document out of the ZIP"
+    _zip = zipfile.ZipFile(os.path.basename(SOURCE_URL))
+    yield task, _zip.read("sblgnt.xml")
+
+def parse_xml(item):
+    "Tokenize the document or a book element of it with a parse_only importer, yielding each book once it is closed"
+    (work_id, book_codes, verbosity), book_xml = item
+    importer = OpenScripturesImport(parse_only=True, verbosity=verbosity)
+    importer.work1 = Work(id = work_id)
+    importer.book_codes = book_codes
+    return importer.parse_xml(book_xml, SBLGNTParser(importer))
+
 class Command(BaseCommand):
     # Not implementing selecting books right now
     #args = '<Jude John ...>'
@@ -184,32 +216,19 @@ class Command(BaseCommand):
             dest='force',
             default=False,
             help='Force load despite it already being loaded'),
-        )
+        make_option('--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=1,
+            help='Number of threads or processes to parse books with (see --pipeline)'),
+        ) + IMPORT_OPTIONS
 
 
 ### Main command handle below
 
-    def handle(self, *args, **options):
-        self.importer = OpenScripturesImport()
-
-        # Abort if MS has already been added (or --force not supplied)
-        self.importer.abort_if_imported("SBLGNT", options["force"])
-
-        # Download the source file
-        self.importer.download_resource(SOURCE_URL)
-
-		# Create license
-        if len(License.objects.filter(url="http://www.sblgnt.com/license/")) == 0:
-            License.objects.create(
-                name        = "SBLGNT License",
-                abbreviation    = "SBLGNT",
-                url             = "http://www.sblgnt.com/license/",
-            )
-
-        # Create Works
-        if len(Work.objects.filter(osis_slug="SBLGNT")) > 0:        
-            self.importer.delete_work(Work.objects.get(osis_slug="SBLGNT"))
-        self.importer.work1 = Work(
+    def create_work(self):
+        work = Work(
             #id           = WORK1_ID,
             title        = "SBL Greek New Testament",
             language     = Language('grc'),
@@ -222,12 +241,80 @@ class Command(BaseCommand):
             source_url   = SOURCE_URL,
             license      = License.objects.get(url="http://www.sblgnt.com/license/")
         )
-        self.importer.work1.save()
+        work.save()
         
         WorkServer.objects.create(
-            work = self.importer.work1,
+            work = work,
             server = Server.objects.get(is_self = True)
         )
+        return work
+
+    def book_elements(self, task):
+        "Split the document into the book elements still to be imported, which can each be parsed on their own"
+        book_codes = dict((value, key) for (key, value) in BOOK_ID_LOOKUP.items())
+        for item in read_document(task):
+            for match in BOOK_ELEMENT.finditer(item[1]):
+                if self.importer.is_book_imported(book_codes.get(match.group(1))):
+                    continue
+                yield task, match.group(0)
+
+    def import_books(self, options):
+        "Parse the books of the SBLGNT"
+        self.importer.bookTotal = len([book_code for book_code in BOOK_ID_LOOKUP if not self.importer.is_book_imported(book_code)])
+        task = (self.importer.work1.id, self.importer.book_codes, self.importer.verbosity)
+        if options["workers"] > 1:
+            # Each book element is parsed by whichever worker is free
+            self.importer.import_pipeline(self.book_elements(task), [parse_xml], options["workers"], options["pipeline"])
+        else:
+            # The document is parsed by one worker as it is, and each book is
+            # written out as soon as it has been parsed
+            self.importer.import_pipeline([task], [read_document, parse_xml], 1, options["pipeline"])
+
+    def handle(self, *args, **options):
+        if options["parse_to"] and options["load_from"]:
+            raise CommandError("--parse-to and --load-from cannot be combined")
+
+        self.importer = OpenScripturesImport(batch_size=options["batch_size"], verbosity=int(options["verbosity"]), parse_only=bool(options["parse_to"]), copy=options["copy"])
+        self.importer.book_codes = osis.BOOK_ORDERS["Bible"]["KJV"]
+
+        # Only parse the source, for loading later with --load-from
+        if options["parse_to"]:
+            self.importer.work1 = Work(osis_slug="SBLGNT")
+            self.importer.open_intermediate(options["parse_to"], "SBLGNT")
+            self.importer.download_resource(SOURCE_URL)
+            self.import_books(options)
+            self.importer.close_intermediate()
+            return
+
+        self.importer.begin_import()
+
+        # Continue from the last committed book of an interrupted import
+        resuming = options["resume"] and self.importer.resume_work("SBLGNT")
+
+        # Update the existing work with only the rows which changed
+        updating = options["delta"] and self.importer.delta_work("SBLGNT")
+
+        # Abort if MS has already been added (or --force not supplied)
+        if not resuming and not updating:
+            self.importer.abort_if_imported("SBLGNT", options["force"])
+
+        # Download the source file
+        if not options["load_from"]:
+            self.importer.download_resource(SOURCE_URL)
+
+		# Create license
+        if len(License.objects.filter(url="http://www.sblgnt.com/license/")) == 0:
+            License.objects.create(
+                name        = "SBLGNT License",
+                abbreviation    = "SBLGNT",
+                url             = "http://www.sblgnt.com/license/",
+            )
+
+        # Create Works
+        if not resuming and not updating:
+            if len(Work.objects.filter(osis_slug="SBLGNT")) > 0:        
+                self.importer.delete_work(Work.objects.get(osis_slug="SBLGNT"))
+            self.importer.work1 = self.create_work()
 
         # Get the subset of OSIS book codes provided on command line
         #limited_book_codes = []
@@ -239,15 +326,14 @@ class Command(BaseCommand):
         #if len(limited_book_codes) > 0:
             #book_codes = limited_book_codes
         #self.importer.book_codes = book_codes
-        self.importer.book_codes = osis.BOOK_ORDERS["Bible"]["KJV"]
 
-		# Initialize the parser and set it up
-        self.parser = xml.sax.make_parser()        
-        self.parser.setContentHandler(SBLGNTParser(self.importer))
-        _zip = zipfile.ZipFile(os.path.basename(SOURCE_URL))
-        self.parser.parse(StringIO.StringIO(_zip.read("sblgnt.xml")))
-        print "Total tokens %d" % self.importer.tokenCount
-        print "Total structures: %d" % self.importer.structCount
+        if options["load_from"]:
+            self.importer.load_intermediate(options["load_from"])
+        else:
+            self.import_books(options)
+        self.importer.end_import()
+        self.importer.log(1, "Total tokens %d" % self.importer.tokenCount)
+        self.importer.log(1, "Total structures: %d" % self.importer.structCount)
 
 
 # TODO
@@ -61,11 +61,11 @@ import unicodedata
 import zipfile
 
 # Django imports
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 # Opensccriptures imports
 from core import osis
-from apps.importers.import_helpers import OpenScripturesImport
+from apps.importers.import_helpers import OpenScripturesImport, IMPORT_OPTIONS
 from apps.texts.models import Work, Token, Structure, WorkServer
 from apps.core.models import Language, License, Server
 
@@ -132,7 +132,223 @@ LINE_PARSER = re.compile(ur"""^
     re.VERBOSE
 )
 
-tempId = 0
+# Indexes of the LINE_PARSER groups used in a parsed line
+CHAPTER, VERSE, BREAK, QERE_START_BRACKET, QERE, QERE_PUNC, QERE_END_BRACKET = [
+    LINE_PARSER.groupindex[name] - 1
+    for name in ("chapter", "verse", "break", "qereStartBracket", "qere", "qerePunc", "qereEndBracket")
+]
+
+# The punctuation which may end a word, as a string for the fast line parser
+PUNC = u'.·,;:!?"\''
+DIGITS = u"0123456789"
+WHITESPACE = u" \t\n\r\x0b\x0c"
+# Lines containing any of these are left to LINE_PARSER: doubted words are
+# bracketed, and whitespace other than single spaces shifts the columns
+FAST_PARSER_EXCLUDED = re.compile(ur"[\[\]\t\n\r\x0b\x0c]")
+
+
+def parse_line_fast(line):
+    """
+    Parse a line by splitting it on spaces, giving the same groups as
+    LINE_PARSER. Returns None for lines which the split cannot parse the same
+    way, so that they can be given to LINE_PARSER instead.
+    """
+    text = line.rstrip(WHITESPACE)
+    if u"  " in text or FAST_PARSER_EXCLUDED.search(text):
+        return None
+    fields = text.split(u" ", 7)
+    if len(fields) != 8:
+        return None
+    book, reference, brk, kethiv, qere, morph, strongsNumber, lemmas = fields
+    strongsLemma, separator, anlexLemma = lemmas.partition(u" ! ")
+    chapter, separator2, verse = reference.partition(u":")
+    verse, separator3, position = verse.partition(u".")
+    if (not book or len(brk) != 1 or not separator or not anlexLemma
+            or not chapter or not verse or not position or not strongsNumber
+            or (chapter + verse + position + strongsNumber).strip(DIGITS)):
+        return None
+
+    rawParsing = text[len(book) + len(reference) + len(brk) + len(kethiv) + 4:]
+    kethivPunc = qerePunc = None
+    if len(kethiv) > 1 and kethiv[-1] in PUNC:
+        kethiv, kethivPunc = kethiv[:-1], kethiv[-1]
+    if len(qere) > 1 and qere[-1] in PUNC:
+        qere, qerePunc = qere[:-1], qere[-1]
+    return (book, chapter, verse, position, brk, None, kethiv, kethivPunc, None,
+        rawParsing, None, qere, qerePunc, None, morph, strongsNumber, strongsLemma, anlexLemma)
+
+
+def parse_line_regex(line):
+    "Parse a line with LINE_PARSER, returning its groups or None"
+    lineMatches = LINE_PARSER.match(line)
+    if lineMatches is None:
+        return None
+    return lineMatches.groups()
+
+
+def parse_line(line, check_parser=False):
+    """
+    Parse a line of a book file into a tuple of the LINE_PARSER groups, or
+    None if it cannot be parsed. Most lines are split by parse_line_fast;
+    the rest fall back to LINE_PARSER. With check_parser, every line is
+    parsed both ways and a CommandError is raised if the results differ.
+    """
+    fields = parse_line_fast(line)
+    if check_parser:
+        regex_fields = parse_line_regex(line)
+        if fields is not None and fields != regex_fields:
+            raise CommandError("The fast line parser disagrees with LINE_PARSER on line: %s" % line.encode("utf-8"))
+        return regex_fields
+    if fields is None:
+        return parse_line_regex(line)
+    return fields
+
+
+def import_book(importer, lines, book_code, check_parser=False):
+    "Tokenize the (decoded and normalized) lines of one book file from the Tischendorf ZIP"
+    importer.current_book = book_code
+    # Chapters and verses are numbered afresh in each book
+    importer.current_chapter = None
+    importer.current_verse = None
+    importer.create_book_struct()
+    
+    lineNumber = -1
+
+    importer.create_paragraph()
+
+    for line in lines:
+        in_paragraph = 0
+        lineNumber += 1
+        lineMatches = parse_line(line, check_parser)
+        if lineMatches is None:
+            importer.log(1, " -- Warning: Unable to parse line: %s" % line)
+            continue
+
+        # Skip verses we're not importing right now
+        #verse_osisid = book_code + "." + lineMatches.group('chapter') + "." + lineMatches.group('verse')
+        #if len(limited_osis_ids) and len(grep(verse_osisid, limited_osis_ids)) != 0:
+        #    continue
+
+        # New Chapter start
+        if lineMatches[CHAPTER] != importer.current_chapter:
+            # End the previous chapter
+            importer.close_structure('chapter')
+
+            # Start the next chapter
+            importer.current_chapter = lineMatches[CHAPTER]
+            importer.create_chapter_struct()
+            
+        # New Verse start
+        if lineMatches[VERSE] != importer.current_verse:
+            # End the previous verse
+            importer.close_structure('verse')
+
+            # Start the next verse
+            importer.current_verse = lineMatches[VERSE]
+            importer.create_verse_struct()
+
+        # End paragraph
+        if lineMatches[BREAK] == 'P':
+            importer.create_paragraph()
+            in_paragraph = 1
+
+        if not in_paragraph and len(importer.bookTokens) > 0:
+            importer.create_whitespace_token()
+
+
+        #assert(lineMatches.group('kethivPunc') == lineMatches.group('qerePunc'))
+        #assert(lineMatches.group('kethivStartBracket') == lineMatches.group('qereStartBracket'))
+        #assert(lineMatches.group('kethivEndBracket') == lineMatches.group('qereEndBracket'))
+
+        #if string.find(line, '[') != -1 or string.find(line, ']') != -1 or lineMatches.group('kethiv') != lineMatches.group('qere'):
+        #    print line
+        #continue
+
+
+        # Open UNCERTAIN1 bracket
+        if lineMatches[QERE_START_BRACKET]:
+            importer.create_uncertain()
+
+        importer.create_token(lineMatches[QERE])
+        # Make sure that structures only start on words
+        importer.link_start_tokens()
+
+
+
+        # Make this token the start of the UNCERTAIN structure
+        if lineMatches[QERE_START_BRACKET]:
+            importer.structs['doubted'].start_position = importer.bookTokens[-1].position
+
+        # Qere token
+        #if lineMatches.group('kethiv') != lineMatches.group('qere'):
+        #    print("%s != %s" % (lineMatches.group('kethiv'), lineMatches.group('qere')))
+        #    token_work2 = Token(
+        #        id       = str(tokenCount),
+        #        data     = lineMatches.group('qere'),
+        #        type     = Token.WORD,
+        #        work     = work,
+        #        position = tokenCount,   #token_work1.position #should this be the same!?
+        #        variant_bits = WORK2_VARIANT_BIT,
+        #        relative_source_url = "#line(%d)" % lineNumber
+        #        # What will happen with range?? end_token = work1, but then work2?
+        #        # Having two tokens at the same position could mean that they are
+        #        #  co-variants at that one spot. But then we can't reliably get
+        #        #  tokens by a range? Also, the position can indicate transposition?
+        #    )
+        #    tokenCount += 1
+        #    token_work2.save()
+        #    lineTokens.append(token_work2)
+
+        # Punctuation token
+        #assert(lineMatches.group('kethivPunc') == lineMatches.group('qerePunc'))
+        if lineMatches[QERE_PUNC]:
+            importer.create_punct_token(lineMatches[QERE_PUNC])
+
+        # Close UNCERTAIN1 bracket
+        #assert(lineMatches.group('kethivEndBracket') == lineMatches.group('qereEndBracket'))
+        if lineMatches[QERE_END_BRACKET]:
+            assert(importer.structs.has_key('doubted'))
+            importer.log(2, "### CLOSE BRACKET")
+
+            importer.structs['doubted'].end_position = importer.bookTokens[-1].position
+
+            # Make end_marker for UNCERTAIN1
+            importer.create_punct_token("]")
+            # Close the UNCERTAIN1 structure
+            importer.structs['doubted'].end_marker_position = importer.bookTokens[-1].position
+            importer.close_structure('doubted')
+        
+
+    importer.close_book()
+
+
+# The stages of the import pipeline (see OpenScripturesImport.import_pipeline),
+# run on a book task of (book code, work ID, book codes, check_parser, verbosity)
+
+def read_book(task):
+    "Read the lines of a book's file out of the ZIP"
+    _zip = zipfile.ZipFile(os.path.basename(SOURCE_URL))
+    yield task, StringIO.StringIO(_zip.read("Tischendorf-2.6/Unicode/" + BOOK_FILENAME_LOOKUP[task[0]])).readlines()
+
+
+def normalize_book(item):
+    "Decode the lines of a book and normalize them to NFC"
+    task, lines = item
+    yield task, [unicodedata.normalize("NFC", unicode(line, 'utf-8')) for line in lines]
+
+
+def parse_book(item):
+    "Tokenize the lines of a book with a parse_only importer"
+    (book_code, work_id, book_codes, check_parser, verbosity), lines = item
+    importer = OpenScripturesImport(parse_only=True, verbosity=verbosity)
+    importer.work1 = Work(id = work_id)
+    importer.book_codes = book_codes
+    import_book(importer, lines, book_code, check_parser)
+    return importer.parsedBooks
+
+
+IMPORT_STAGES = (read_book, normalize_book, parse_book)
+
 
 class Command(BaseCommand):
     args = '<Jude John ...>'
@@ -144,25 +360,23 @@ class Command(BaseCommand):
             dest='force',
             default=False,
             help='Force load despite it already being loaded'),
-        )
-
-
-    def handle(self, *args, **options):
-        importer = OpenScripturesImport()
-        
-        # Abort if MS has already been added (or --force not supplied)
-        importer.abort_if_imported("Tischendorf", options["force"])
+        make_option('--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=1,
+            help='Number of threads or processes to parse books with (see --pipeline)'),
+        make_option('--check-parser',
+            action='store_true',
+            dest='check_parser',
+            default=False,
+            help='Parse every line with both the fast parser and LINE_PARSER and stop if they disagree'),
+        ) + IMPORT_OPTIONS
 
-        # Download the source file
-        importer.download_resource(SOURCE_URL)
 
-        # Create Works
-        # Delete existing works
-        if len(Work.objects.filter(osis_slug="Tischendorf")) > 0:
-            importer.delete_work(Work.objects.get(osis_slug="Tischendorf"))
-        
+    def create_work(self):
         # Work for Qere edition (Kethiv is base text)
-        importer.work1 = Work(
+        work = Work(
             title        = "Tischendorf 8th ed. v2.6 Qere (Corrected)",
             language     = Language('grc'),
             type         = 'Bible',
@@ -175,12 +389,16 @@ class Command(BaseCommand):
             source_url   = SOURCE_URL,
             license      = License.objects.get(url="http://creativecommons.org/licenses/publicdomain/")
         )
-        importer.work1.save()
+        work.save()
         WorkServer.objects.create(
-            work = importer.work1,
+            work = work,
             server = Server.objects.get(is_self = True)
         )
+        return work
+
 
+    def import_books(self, importer, args, options):
+        "Parse the books listed on the command line, or all of them"
         # Get the subset of OSIS book codes provided on command line
         limited_book_codes = []
         for arg in args:
@@ -192,126 +410,64 @@ class Command(BaseCommand):
             importer.book_codes = limited_book_codes
 
         # Read each of the Book files
-        _zip = zipfile.ZipFile(os.path.basename(SOURCE_URL))
+        book_codes = []
         for book_code in importer.book_codes:
             if not BOOK_FILENAME_LOOKUP.has_key(book_code):
                 continue
+            if importer.is_book_imported(book_code):
+                continue
+            book_codes.append(book_code)
+        importer.bookTotal = len(book_codes)
 
-            importer.current_book = book_code
-            importer.create_book_struct()
-            
-            lineNumber = -1
+        tasks = [(book_code, importer.work1.id, importer.book_codes, options["check_parser"], importer.verbosity) for book_code in book_codes]
+        importer.import_pipeline(tasks, IMPORT_STAGES, options["workers"], options["pipeline"])
 
-            importer.create_paragraph()
 
-            for line in StringIO.StringIO(_zip.read("Tischendorf-2.6/Unicode/" + BOOK_FILENAME_LOOKUP[book_code])):
-                in_paragraph = 0
-                lineNumber += 1
-                lineMatches = LINE_PARSER.match(unicodedata.normalize("NFC", unicode(line, 'utf-8')))
-                if lineMatches is None:
-                    print(" -- Warning: Unable to parse line: %s" % line) 
-                    continue
-
-                # Skip verses we're not importing right now
-                #verse_osisid = book_code + "." + lineMatches.group('chapter') + "." + lineMatches.group('verse')
-                #if len(limited_osis_ids) and len(grep(verse_osisid, limited_osis_ids)) != 0:
-                #    continue
-
-                # New Chapter start
-                if lineMatches.group('chapter') != importer.current_chapter:
-                    # End the previous chapter
-                    importer.close_structure('chapter')
-
-                    # Start the next chapter
-                    importer.current_chapter = lineMatches.group('chapter')
-                    importer.create_chapter_struct()
-                    
-                # New Verse start
-                if lineMatches.group('verse') != importer.current_verse:
-                    # End the previous verse
-                    importer.close_structure('verse')
-
-                    # Start the next verse
-                    importer.current_verse = lineMatches.group('verse')
-                    importer.create_verse_struct()
-
-                # End paragraph
-                if lineMatches.group('break') == 'P':
-                    importer.create_paragraph()
-                    in_paragraph = 1
-
-                if not in_paragraph and len(importer.bookTokens) > 0:
-                    importer.create_whitespace_token()
-
-
-                #assert(lineMatches.group('kethivPunc') == lineMatches.group('qerePunc'))
-                #assert(lineMatches.group('kethivStartBracket') == lineMatches.group('qereStartBracket'))
-                #assert(lineMatches.group('kethivEndBracket') == lineMatches.group('qereEndBracket'))
-
-                #if string.find(line, '[') != -1 or string.find(line, ']') != -1 or lineMatches.group('kethiv') != lineMatches.group('qere'):
-                #    print line
-                #continue
-
-
-                # Open UNCERTAIN1 bracket
-                if lineMatches.group("qereStartBracket"):
-                    importer.create_uncertain()
-
-                importer.create_token(lineMatches.group('qere'))
-                # Make sure that structures only start on words
-                importer.link_start_tokens()
-
-
-
-                # Make this token the start of the UNCERTAIN structure
-                if lineMatches.group('qereStartBracket'):
-                    importer.structs['doubted'].start_token = importer.bookTokens[-1]
-
-                # Qere token
-                #if lineMatches.group('kethiv') != lineMatches.group('qere'):
-                #    print("%s != %s" % (lineMatches.group('kethiv'), lineMatches.group('qere')))
-                #    token_work2 = Token(
-                #        id       = str(tokenCount),
-                #        data     = lineMatches.group('qere'),
-                #        type     = Token.WORD,
-                #        work     = work,
-                #        position = tokenCount,   #token_work1.position #should this be the same!?
-                #        variant_bits = WORK2_VARIANT_BIT,
-                #        relative_source_url = "#line(%d)" % lineNumber
-                #        # What will happen with range?? end_token = work1, but then work2?
-                #        # Having two tokens at the same position could mean that they are
-                #        #  co-variants at that one spot. But then we can't reliably get
-                #        #  tokens by a range? Also, the position can indicate transposition?
-                #    )
-                #    tokenCount += 1
-                #    token_work2.save()
-                #    lineTokens.append(token_work2)
-
-                # Punctuation token
-                #assert(lineMatches.group('kethivPunc') == lineMatches.group('qerePunc'))
-                if lineMatches.group('qerePunc'):
-                    importer.create_punct_token(lineMatches.group('qerePunc'))
-
-                # Close UNCERTAIN1 bracket
-                #assert(lineMatches.group('kethivEndBracket') == lineMatches.group('qereEndBracket'))
-                if lineMatches.group('qereEndBracket'):
-                    assert(importer.structs.has_key('doubted'))
-                    print("### CLOSE BRACKET")
-
-                    importer.structs['doubted'].end_token = importer.bookTokens[-1]
-
-                    # Make end_marker for UNCERTAIN1
-                    importer.create_punct_token("]")
-                    # Close the UNCERTAIN1 structure
-                    importer.structs['doubted'].end_marker = importer.bookTokens[-1]
-                    importer.close_structure('doubted')
-                
-
-            for structElement in importer.structs.keys():
-                importer.close_structure(structElement)
-
-            importer.bookTokens = []
-            
+    def handle(self, *args, **options):
+        if options["parse_to"] and options["load_from"]:
+            raise CommandError("--parse-to and --load-from cannot be combined")
 
-        print("structCount: %s" % str(importer.structCount))
-        print("tokenCount:  %s" % str(importer.tokenCount))
+        importer = OpenScripturesImport(batch_size=options["batch_size"], verbosity=int(options["verbosity"]), parse_only=bool(options["parse_to"]), copy=options["copy"])
+
+        # Only parse the source, for loading later with --load-from
+        if options["parse_to"]:
+            importer.work1 = Work(osis_slug="Tischendorf")
+            importer.open_intermediate(options["parse_to"], "Tischendorf")
+            importer.download_resource(SOURCE_URL)
+            self.import_books(importer, args, options)
+            importer.close_intermediate()
+            return
+
+        importer.begin_import()
+
+        # Continue from the last committed book of an interrupted import
+        resuming = options["resume"] and importer.resume_work("Tischendorf")
+
+        # Update the existing work with only the rows which changed
+        updating = options["delta"] and importer.delta_work("Tischendorf")
+
+        # Abort if MS has already been added (or --force not supplied)
+        if not resuming and not updating:
+            importer.abort_if_imported("Tischendorf", options["force"])
+
+        # Download the source file
+        if not options["load_from"]:
+            importer.download_resource(SOURCE_URL)
+
+        # Create Works
+        if not resuming and not updating:
+            # Delete existing works
+            if len(Work.objects.filter(osis_slug="Tischendorf")) > 0:
+                importer.delete_work(Work.objects.get(osis_slug="Tischendorf"))
+            importer.work1 = self.create_work()
+
+        if options["load_from"]:
+            importer.book_codes = osis.BOOK_ORDERS["Bible"]["KJV"]
+            importer.load_intermediate(options["load_from"])
+        else:
+            self.import_books(importer, args, options)
+
+        importer.end_import()
+
+        importer.log(1, "structCount: %s" % str(importer.structCount))
+        importer.log(1, "tokenCount:  %s" % str(importer.tokenCount))
@@ -0,0 +1,23 @@
+# coding: utf8 #
+
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+from texts.models import Work
+
+
+class ImportCheckpoint(models.Model):
+    """
+    Records the last book of a work which was completely imported, along with
+    the token and structure counts at that point, so that an interrupted
+    import can be resumed from the following book.
+    """
+
+    work = models.ForeignKey(Work, unique=True)
+    book = models.CharField(_("OSIS code of the last book committed"), max_length=16)
+    token_count = models.PositiveIntegerField(_("Number of tokens imported through the end of the book"))
+    struct_count = models.PositiveIntegerField(_("Number of structures imported through the end of the book"))
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.work, self.book)
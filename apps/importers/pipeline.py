@@ -0,0 +1,222 @@
+# encoding: utf-8
+#
+# A streaming pipeline for the load_* importers, so that reading and parsing
+# the source overlaps with writing what has already been parsed to the
+# database.
+#
+# A Pipeline is configured with a source, an iterable of items (e.g. the
+# books to import), and a chain of stages. Each stage is a function which
+# takes an item and returns or yields the items passed on to the next stage:
+# a reader of ZIP members or lines, a normalizer, a tokenizer which parses
+# its input into books with a parse_only OpenScripturesImport, and so on.
+#
+# The source is read on a feeder thread and the stages are run on worker
+# threads or processes, connected to the feeder and to the caller by bounded
+# queues. Iterating over the Pipeline yields the output of the last stage in
+# the order of the source, on the calling thread, which is where the batched
+# database writes happen (see OpenScripturesImport.import_pipeline). The
+# feeder only runs a limited number of items ahead of the item being yielded,
+# so that the outputs of the later items held back meanwhile stay bounded.
+
+# Standard library imports
+import multiprocessing
+import Queue
+import threading
+import traceback
+
+# Django imports
+from django.core.management.base import CommandError
+
+
+# Number of items each of a pipeline's queues holds before the stages which
+# feed it wait for them to be taken
+PIPELINE_QUEUE_SIZE = 4
+
+# How a pipeline runs its stages: on the calling thread (which is the same as
+# not having a pipeline at all, and easiest to debug), on worker threads
+# (which overlap parsing with the database writes, which release the GIL), or
+# on worker processes (which also parse on several CPUs at once)
+PIPELINE_MODES = ("inline", "thread", "process")
+
+# Seconds between the checks of whether a pipeline has been stopped while one
+# of its threads waits on a queue
+PIPELINE_POLL_INTERVAL = 0.1
+
+# Kinds of the messages put on a pipeline's results queue, which are
+# (index of the source item, kind, value) triples
+RESULT = "result"
+ITEM_DONE = "done"
+ITEM_FAILED = "failed"
+SOURCE_DONE = "source done"
+
+
+def run_stages(stages, item):
+    "Pass an item through the chain of stages, yielding what comes out of the last one"
+    if not stages:
+        yield item
+        return
+    for result in stages[0](item):
+        for output in run_stages(stages[1:], result):
+            yield output
+
+
+def put(queue, message, stopped):
+    "Put a message on a queue, waiting for room unless the pipeline is stopped; returns whether it was put"
+    while not stopped.is_set():
+        try:
+            queue.put(message, True, PIPELINE_POLL_INTERVAL)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def get(queue, stopped):
+    "Take a message off a queue, waiting for one unless the pipeline is stopped (when None is returned)"
+    while not stopped.is_set():
+        try:
+            return queue.get(True, PIPELINE_POLL_INTERVAL)
+        except Queue.Empty:
+            pass
+    return None
+
+
+def feed(source, tasks, results, ahead, workers, stopped):
+    """
+    Put the (index, item) pairs of the source on the tasks queue, followed by
+    a None for each worker, and then the number of items on the results
+    queue. Each item is first put on the ahead queue, which the caller takes
+    them off of as they are done, so that the feeder waits while it is full.
+    If reading the source fails, the failure is put on the results queue in
+    place of the next item.
+    """
+    index = 0
+    try:
+        for item in source:
+            if not put(ahead, index, stopped) or not put(tasks, (index, item), stopped):
+                return
+            index += 1
+    except Exception:
+        put(results, (index, ITEM_FAILED, traceback.format_exc()), stopped)
+        return
+    for i in range(workers):
+        put(tasks, None, stopped)
+    put(results, (index, SOURCE_DONE, None), stopped)
+
+
+def work(stages, tasks, results, stopped):
+    """
+    Run the stages on each item taken from the tasks queue until a None is
+    taken, putting the outputs on the results queue followed by a message
+    that the item is done, or the traceback if it failed.
+    """
+    while True:
+        task = get(tasks, stopped)
+        if task is None:
+            return
+        index, item = task
+        try:
+            for output in run_stages(stages, item):
+                if not put(results, (index, RESULT, output), stopped):
+                    return
+        except Exception:
+            put(results, (index, ITEM_FAILED, traceback.format_exc()), stopped)
+            continue
+        put(results, (index, ITEM_DONE, None), stopped)
+
+
+class Pipeline():
+    """
+    Runs a chain of stages over the items of a source on worker threads or
+    processes (see PIPELINE_MODES) and yields the outputs in the order of the
+    source when iterated over.
+
+    Items are handed to the workers one at a time, so the outputs of later
+    items are held back until all of those of the earlier ones have been
+    yielded. At most workers + queue_size items are taken from the source
+    ahead of the one being yielded, so only the outputs of those are held.
+    In process mode the stages must be module-level functions and the items
+    and outputs must be picklable. A failure in the source or in a stage
+    raises a CommandError with the traceback once the items before it have
+    been yielded, as does a worker process dying, and stops the workers.
+    """
+
+    def __init__(self, source, stages, workers=1, mode="thread", queue_size=PIPELINE_QUEUE_SIZE):
+        if mode not in PIPELINE_MODES:
+            raise CommandError("Unknown pipeline mode %s; use one of %s" % (mode, ", ".join(PIPELINE_MODES)))
+        self.source = source
+        self.stages = list(stages)
+        self.workers = max(workers, 1)
+        self.mode = mode
+        self.queue_size = queue_size
+
+    def __iter__(self):
+        if self.mode == "inline":
+            for item in self.source:
+                for output in run_stages(self.stages, item):
+                    yield output
+            return
+
+        if self.mode == "process":
+            tasks = multiprocessing.Queue(self.queue_size)
+            results = multiprocessing.Queue(self.queue_size)
+            stopped = multiprocessing.Event()
+            workers = [multiprocessing.Process(target=work, args=(self.stages, tasks, results, stopped)) for i in range(self.workers)]
+        else:
+            tasks = Queue.Queue(self.queue_size)
+            results = Queue.Queue(self.queue_size)
+            stopped = threading.Event()
+            workers = [threading.Thread(target=work, args=(self.stages, tasks, results, stopped)) for i in range(self.workers)]
+        # The feeder is always a thread: it reads the source in this process
+        ahead = Queue.Queue(self.workers + self.queue_size)
+        workers.append(threading.Thread(target=feed, args=(self.source, tasks, results, ahead, self.workers, stopped)))
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        try:
+            for output in self.collect(results, ahead, workers):
+                yield output
+        finally:
+            stopped.set()
+            for worker in workers:
+                if isinstance(worker, multiprocessing.Process) and worker.is_alive():
+                    worker.terminate()
+                worker.join()
+
+    def collect(self, results, ahead, workers):
+        """
+        Yield the outputs on the results queue in the order of their source
+        items, holding back those of items later than the one being yielded,
+        and taking each item off the ahead queue once it is done. Raises a
+        CommandError if a worker process exits without finishing its item.
+        """
+        held = {}
+        index = 0
+        count = None
+        while count is None or index < count:
+            if held.get(index):
+                message = held[index].pop(0)
+            else:
+                try:
+                    message = results.get(True, PIPELINE_POLL_INTERVAL)
+                except Queue.Empty:
+                    for worker in workers:
+                        if isinstance(worker, multiprocessing.Process) and worker.exitcode:
+                            raise CommandError("Import pipeline worker process exited with code %d before item %d was done" % (worker.exitcode, index))
+                    continue
+                if message[1] == SOURCE_DONE:
+                    count = message[0]
+                    continue
+                if message[0] != index:
+                    held.setdefault(message[0], []).append(message)
+                    continue
+            kind, value = message[1:]
+            if kind == RESULT:
+                yield value
+            elif kind == ITEM_DONE:
+                held.pop(index, None)
+                ahead.get_nowait()
+                index += 1
+            else:
+                raise CommandError("Import pipeline failed on item %d:\n%s" % (index, value))
@@ -0,0 +1,61 @@
+# encoding: utf-8
+#
+# A base for the tests of the importers and of what they import, which runs
+# the importers on synthetic source files (see benchmark_importers) written
+# to a scratch working directory, where the importers read their sources.
+
+# Standard library imports
+import os
+import shutil
+import tempfile
+import zipfile
+
+# Django imports
+from django.core.management import call_command
+from django.test import TestCase
+
+# Project imports
+from importers.management.commands import load_tischendorf
+from importers.management.commands.benchmark_importers import write_tischendorf
+from texts.models import Structure, Token, Work
+
+
+class ImportTestCase(TestCase):
+    "Runs the importers in a scratch working directory, where they read their source files"
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def import_tischendorf(self, books, chapters, verses, words, **options):
+        "Write a Tischendorf source file of the provided size and import its books"
+        write_tischendorf(books, chapters, verses, words)
+        call_command("load_tischendorf", verbosity = 0, *books, **options)
+
+    def edit_tischendorf(self, book_code, edit):
+        "Replace the lines of a book of the Tischendorf source file with what edit returns for them"
+        path = os.path.basename(load_tischendorf.SOURCE_URL)
+        name = "Tischendorf-2.6/Unicode/" + load_tischendorf.BOOK_FILENAME_LOOKUP[book_code]
+        source = zipfile.ZipFile(path)
+        members = [(info.filename, source.read(info.filename)) for info in source.infolist()]
+        source.close()
+        _zip = zipfile.ZipFile(path, "w")
+        for filename, data in members:
+            if filename == name:
+                lines = data.decode("utf-8").splitlines()
+                data = (u"\n".join(edit(lines)) + u"\n").encode("utf-8")
+            _zip.writestr(filename, data)
+        _zip.close()
+
+    def snapshot(self, slug):
+        "The tokens and structures of a work, for comparing imports"
+        work = Work.objects.get(osis_slug = slug)
+        tokens = list(Token.objects.filter(work = work).order_by("position").values_list("id", "position", "type", "form__data", "relative_source_url"))
+        fields = ("element", "osis_id", "position", "start_position", "end_position", "start_marker_position", "end_marker_position")
+        structures = sorted(Structure.objects.filter(work = work).values_list(*fields))
+        return tokens, structures
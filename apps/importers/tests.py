@@ -0,0 +1,429 @@
+# encoding: utf-8
+
+import cPickle
+import hashlib
+import os
+import random
+import time
+import unicodedata
+import zipfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase
+
+from importers import byzantine_conversion
+from importers.byzantine_conversion import cct_to_unicode
+from importers.import_helpers import OpenScripturesImport, TOKEN_ID_LOOKBEHIND, TOKEN_ID_MAX_LOOKBEHIND
+from importers.management.commands import load_tischendorf
+from importers.pipeline import Pipeline, PIPELINE_QUEUE_SIZE
+from importers.testcases import ImportTestCase
+from texts.models import LexiconEntry, Token, Work
+
+
+def original_normalize_token(data):
+    """
+    normalize_token as it was before it was made table-driven, to compare it
+    with (except that it joins the characters as unicode, as the original
+    failed on data which is nothing but combining marks)
+    """
+    data = unicodedata.normalize('NFC', u''.join((c for c in unicodedata.normalize('NFD', data) if unicodedata.category(c) != 'Mn')).lower())
+    data = data.replace(u"'", '')
+    data = data.replace(u"’", '')
+    return data
+
+
+def token_ids(words, book = "Gen"):
+    "The IDs identify_token assigns to tokens of the provided words at the start of a book"
+    importer = OpenScripturesImport(verbosity = 0)
+    importer.work1 = Work(type = "Bible", osis_slug = "Test")
+    importer.current_book = book
+    ids = []
+    for word in words:
+        token = Token(data = word, type = Token.WORD)
+        importer.identify_token(token)
+        ids.append(token.id)
+    return ids
+
+
+def token_id(words, lookbehind, index = None, book = "Gen"):
+    "The ID of the last of the words hashed with the provided look-behind (and index in the book)"
+    key = [u"Bible.Test", book] + words[:-1][-lookbehind:] + words[-1:]
+    if index is not None:
+        key.append(unicode(index))
+    return hashlib.sha1(u"\x00".join(key).encode('utf-8')).hexdigest()
+
+
+# Stages for the pipeline tests, which are module-level functions so that
+# process workers can run them
+def square(item):
+    "Take longer over some items than others, so that the workers finish them out of order"
+    time.sleep(0.01 * (item % 3))
+    yield item * item
+    yield -item
+
+def slow_first(item):
+    if item == 0:
+        time.sleep(0.5)
+    yield item
+
+def fail_on_three(item):
+    if item == 3:
+        raise ValueError("item %d" % item)
+    yield item
+
+def exit_on_one(item):
+    if item == 1:
+        os._exit(1)
+    yield item
+
+
+class IdentifyTokenTest(TestCase):
+    def test_stable(self):
+        """
+        The IDs depend on the work, book and text only, and an edit only
+        changes the IDs of the tokens within the look-behind after it
+        """
+        words = [u"In", u"the", u"beginning", u"God", u"created", u"the", u"heaven", u"and", u"the", u"earth"]
+        ids = token_ids(words)
+        self.failUnlessEqual(ids, token_ids(words))
+        self.failUnlessEqual(len(set(ids)), len(ids))
+        self.failIfEqual(ids, token_ids(words, book = "Exod"))
+        self.failUnlessEqual(ids[3], token_id(words[:4], TOKEN_ID_LOOKBEHIND))
+
+        edited = words[:]
+        edited[2] = u"start"
+        edited_ids = token_ids(edited)
+        self.failUnlessEqual(edited_ids[:2], ids[:2])
+        for i in range(2, 3 + TOKEN_ID_LOOKBEHIND):
+            self.failIfEqual(edited_ids[i], ids[i])
+        self.failUnlessEqual(edited_ids[3 + TOKEN_ID_LOOKBEHIND:], ids[3 + TOKEN_ID_LOOKBEHIND:])
+
+    def test_collision(self):
+        "The look-behind is doubled for a token whose ID is already used in the book"
+        words = [u"a", u"b", u"c", u"d", u"e", u"x", u"a", u"b", u"c", u"d", u"e"]
+        ids = token_ids(words)
+        self.failUnlessEqual(len(set(ids)), len(ids))
+        self.failUnlessEqual(ids[-2], token_id(words[:-1], TOKEN_ID_LOOKBEHIND))
+        self.failUnlessEqual(ids[-1], token_id(words, TOKEN_ID_LOOKBEHIND * 2))
+
+    def test_max_lookbehind(self):
+        "The look-behind stops doubling at TOKEN_ID_MAX_LOOKBEHIND in text which repeats itself"
+        period = [u"holy", u"holy", u"holy", u"is", u"the", u"Lord"]
+        words = period * (TOKEN_ID_MAX_LOOKBEHIND // len(period) * 4)
+        ids = token_ids(words)
+        self.failUnlessEqual(len(set(ids)), len(ids))
+        index = len(words) - 1
+        self.failUnlessEqual(ids[index], token_id(words, TOKEN_ID_MAX_LOOKBEHIND, index))
+
+
+class NormalizeTokenTest(TestCase):
+    words = [
+        u"Ἰούδας", u"Ἰησοῦ", u"Χριστοῦ", u"δοῦλος", u"ἀδελφὸς", u"Ἰακώβου", u"ᾧ", u"ῥήματα",
+        u"Ῥώμῃ", u"διϋλίζοντες", u"ἀπ'", u"κατ’", u"בְּרֵאשִׁית", u"יְהוָה", u"Café", u"NAÏVE",
+        u"a\u0301\u0323", u"e\u0323\u0301", u"", u"God's",
+    ]
+
+    def test_words(self):
+        importer = OpenScripturesImport(verbosity = 0)
+        for word in self.words:
+            self.failUnlessEqual(importer.normalize_token(word), original_normalize_token(word))
+        self.failUnlessEqual(importer.normalize_tokens(self.words), [original_normalize_token(word) for word in self.words])
+
+    def test_characters(self):
+        "Every character of the Basic Multilingual Plane, alone and after a letter, is normalized as before"
+        importer = OpenScripturesImport(verbosity = 0)
+        data_list = []
+        for c in xrange(0x10000):
+            if 0xd800 <= c < 0xe000:
+                continue
+            data_list.append(unichr(c))
+            data_list.append(u"α" + unichr(c))
+        expected = [original_normalize_token(data) for data in data_list]
+        self.failUnlessEqual(importer.normalize_tokens(data_list), expected)
+        # And again from the cache of normalized forms
+        self.failUnlessEqual(importer.normalize_tokens(data_list), expected)
+
+
+def write_byzantine(books):
+    "Write the BP5 and CCT ZIP files of the Byzantine text with the provided {book: (BP5 text, CCT text)}"
+    for path, extension, i in ((byzantine_conversion.BP5_FILE, ".BP5", 0), (byzantine_conversion.CCT_FILE, ".CCT", 1)):
+        _zip = zipfile.ZipFile(path, "w")
+        for book, texts in books.items():
+            _zip.writestr(book + extension, texts[i])
+        _zip.close()
+
+
+class CctToUnicodeTest(TestCase):
+    def test_words(self):
+        "Words are converted with precomposed characters where Unicode has them, along with their plain form"
+        for word, expected in (
+            ("h)^n", (u"ἦν", u"ην")),
+            ("w(^|", (u"ᾧ", u"ω")),
+            ("lo/gos", (u"λ\u03ccγος", u"λογος")),
+            (")Ihsou^", (u"Ἰησοῦ", u"ιησου")),
+            (")/Anqrwpos", (u"Ἄνθρωπος", u"ανθρωπος")),
+            ("a)/|dontes", (u"ᾄδοντες", u"αδοντες")),
+            ("dii+sxuri/zeto", (u"διϊσχυρ\u03afζετο", u"διισχυριζετο")),
+            ("(Rw/mh|", (u"Ῥ\u03ceμῃ", u"ρωμη")),
+            ("kai\\", (u"καὶ", u"και")),
+            # Capitals with an iota subscript and an accent have no precomposed character
+            ("A/|", (u"\u0386\u0345", u"α")),
+            ("O(^|", (u"\u1f49\u0342\u0345", u"ο")),
+        ):
+            self.failUnlessEqual(cct_to_unicode(word), expected, word)
+            # And again from the memo of converted words
+            self.failUnlessEqual(cct_to_unicode(word), expected, word)
+
+    def test_invalid(self):
+        "Characters the CCT files do not use, and contradictory annotations, are errors"
+        for word in ("lo!gos", "lo/gos#", "a)(", "a/\\", "b/", "\x80"):
+            self.failUnlessRaises(ValueError, cct_to_unicode, word)
+
+
+class InsertRowsTest(TestCase):
+    def test_copy_file(self):
+        "Rows are written for COPY with NULLs, booleans and the characters COPY treats specially escaped"
+        importer = OpenScripturesImport(verbosity = 0)
+        rows = [
+            [1, None, True, False, u"λόγος"],
+            ["a\\b", "tab\there", "new\nline", "carriage\rreturn", "\\N"],
+        ]
+        self.failUnlessEqual(importer.copy_file(rows).read(), "\t".join(["1", "\\N", "t", "f", u"λόγος".encode("utf-8")]) + "\n" +
+            "\t".join(["a\\\\b", "tab\\there", "new\\nline", "carriage\\rreturn", "\\\\N"]) + "\n")
+
+    def test_copy_option(self):
+        "Rows are only written with COPY when the importer is asked to, which needs PostgreSQL"
+        OpenScripturesImport(verbosity = 0).insert_rows(LexiconEntry, [LexiconEntry(data = u"λόγος")])
+        self.failUnless(LexiconEntry.objects.filter(data = u"λόγος").exists())
+        if hasattr(connection.cursor(), "copy_from"):
+            return
+        importer = OpenScripturesImport(verbosity = 0, copy = True)
+        self.failUnlessRaises(CommandError, importer.insert_rows, LexiconEntry, [LexiconEntry(data = u"ἦν")])
+
+
+class ParseLineTest(TestCase):
+    lines = [
+        u"JUDE 1:1.1 . Ἰούδας Ἰούδας N-NSM 2455 Ἰούδας ! Ἰούδας\n",
+        u"JUDE 1:1.5 . ἀδελφὸς, ἀδελφὸς, N-NSM 80 ἀδελφός ! ἀδελφός\n",
+        u"MT 5:3.1 P Μακάριοι Μακάριοι A-NPM 3107 μακάριος ! μακάριος\r\n",
+        u"MT 1:1.8 . Δαυεὶδ Δαυίδ N-PRI 1138 Δαβίδ ! Δαυίδ",
+        u"RO 16:27.12 . ἀμήν. ἀμήν. HEB 281 ἀμήν ! ἀμήν  ",
+        u"AC 2:1.1 C Καὶ Καὶ CONJ 2532 καί ! καί\n",
+        u"1CO 1:2.5 . οὔσῃ· οὔσῃ· V-PAP-DSF 5607 ὤν ! εἰμί\n",
+        u"JOH 1:1.3 . ἦν ἦν V-IAI-3S 2258 ἦν ! εἰμί\n",
+        u"LU 2:14.1 . δόξα δόξα N-NSF 1391 δόξα ! δόξα\n",
+        u"MR 1:2.6 . ἀπ' ἀπ' PREP 575 ἀπό ! ἀπό\n",
+    ]
+
+    def check(self, line):
+        fast = load_tischendorf.parse_line_fast(line)
+        if fast is not None:
+            self.failUnlessEqual(fast, load_tischendorf.parse_line_regex(line), line)
+        return fast
+
+    def test_lines(self):
+        "Lines in the format of the source files are split the same way LINE_PARSER matches them"
+        for line in self.lines:
+            self.failIf(self.check(line) is None, line)
+
+    def test_fallback(self):
+        "Lines the split cannot parse like LINE_PARSER are left to it"
+        for line in (
+            u"JUDE 1:1.2 . [Ἰησοῦ Ἰησοῦ N-NSM 2424 Ἰησοῦς ! Ἰησοῦς\n",
+            u"JUDE 1:1.3 . Χριστοῦ] Χριστοῦ] N-GSM 5547 Χριστός ! Χριστός\n",
+            u"JUDE 1:1.1  . Ἰούδας Ἰούδας N-NSM 2455 Ἰούδας ! Ἰούδας\n",
+            u"JUDE\t1:1.1 . Ἰούδας Ἰούδας N-NSM 2455 Ἰούδας ! Ἰούδας\n",
+        ):
+            self.failUnless(self.check(line) is None, line)
+        self.failIf(load_tischendorf.parse_line(u"JUDE 1:1.2 . [Ἰησοῦ Ἰησοῦ N-NSM 2424 Ἰησοῦς ! Ἰησοῦς\n") is None)
+
+    def test_random_lines(self):
+        "Lines put together from valid and invalid columns never parse differently from LINE_PARSER"
+        columns = [
+            [u"JUDE", u"1CO", u"", u"!"],
+            [u"1:1.1", u"12:3.45", u"1:1", u"a:1.1", u"1:1.1x", u"1.1:1", u":."],
+            [u".", u"P", u"C", u"PP", u"!"],
+            [u"λόγος", u"λόγος,", u"λόγος.", u"ἀπ'", u"[λόγος", u"λόγος]", u",", u"λόγος·", u"\"", u"λόγος!", u"λ,ό"],
+            [u"λόγος", u"λόγος;", u"ἀπ'", u"[λόγος]", u".", u"λόγος?"],
+            [u"N-NSM", u"V-PAI-3S", u"!"],
+            [u"3056", u"30a", u"", u"3056 2532"],
+            [u"λόγος ! λόγος", u"ἀπό ! ἀπό", u"a b ! c d", u"λόγος", u"λόγος !  λόγος", u"! λόγος", u"x ! ", u"a ! b ! c", u" ! "],
+        ]
+        separators = [u" ", u"  ", u"\t", u""]
+        endings = [u"\n", u"", u" \n", u"\r\n", u"  ", u"\t"]
+        r = random.Random(0)
+        # The first choice of each column is valid; favour it so a fair share of lines parse
+        choose = lambda choices: choices[0] if r.random() < 0.8 else r.choice(choices)
+        parsed = 0
+        for i in range(20000):
+            line = choose(columns[0])
+            for column in columns[1:]:
+                line += choose(separators) + choose(column)
+            line += choose(endings)
+            if self.check(line) is not None:
+                parsed += 1
+        self.failUnless(parsed > 1000)
+
+
+class ApplyBookDeltaTest(ImportTestCase):
+    def test_round_trip(self):
+        "Updating a work with --delta gives the same rows as importing the edited text afresh"
+        books = ["Jude", "Phlm"]
+        self.import_tischendorf(books, 2, 6, 5)
+        unchanged = self.snapshot("Tischendorf")
+
+        def edit(lines):
+            # Add a word, drop one and change one, in different verses and
+            # outside of the doubted (bracketed) words
+            plain = [i for i, line in enumerate(lines) if u"[" not in line and u"]" not in line]
+            lines.insert(plain[40], lines[plain[40]])
+            del lines[plain[20]]
+            columns = lines[plain[3]].split(u" ")
+            columns[3] = columns[4] = columns[5] = u"λόγος"
+            lines[plain[3]] = u" ".join(columns)
+            return lines
+        self.edit_tischendorf("Jude", edit)
+
+        call_command("load_tischendorf", verbosity = 0, delta = True, *books)
+        updated = self.snapshot("Tischendorf")
+        self.failIfEqual(updated, unchanged)
+
+        call_command("load_tischendorf", verbosity = 0, force = True, *books)
+        self.failUnlessEqual(updated, self.snapshot("Tischendorf"))
+
+
+class PipelineTest(TestCase):
+    def test_order(self):
+        "The outputs are yielded in the order of the source, whichever worker finishes first"
+        expected = []
+        for item in range(20):
+            expected.extend([item * item, -item])
+        for mode in ("inline", "thread", "process"):
+            self.failUnlessEqual(list(Pipeline(range(20), [square], 3, mode)), expected, mode)
+
+    def test_failed_stage(self):
+        "A stage raising an exception raises a CommandError, after the outputs of the items before it"
+        for mode in ("thread", "process"):
+            outputs = []
+            try:
+                for output in Pipeline(range(10), [fail_on_three], 2, mode):
+                    outputs.append(output)
+            except CommandError, e:
+                self.failUnless("ValueError: item 3" in str(e), mode)
+            else:
+                self.fail("No CommandError in %s mode" % mode)
+            self.failUnlessEqual(outputs, [0, 1, 2])
+
+    def test_dead_worker(self):
+        "A worker process dying raises a CommandError instead of waiting for its item forever"
+        outputs = []
+        try:
+            for output in Pipeline(range(10), [exit_on_one], 2, "process"):
+                outputs.append(output)
+        except CommandError, e:
+            self.failUnless("exited with code 1" in str(e))
+        else:
+            self.fail("No CommandError")
+        self.failUnlessEqual(outputs, [0])
+
+    def test_bounded(self):
+        "The source is only read a limited number of items ahead of the one whose outputs are awaited"
+        taken = []
+        def source():
+            for item in range(100):
+                taken.append(item)
+                yield item
+        workers = 2
+        pipeline = iter(Pipeline(source(), [slow_first], workers, "thread"))
+        # While the first item is slow, the other worker runs out of items
+        self.failUnlessEqual(pipeline.next(), 0)
+        self.failUnless(len(taken) <= workers + PIPELINE_QUEUE_SIZE + 1, len(taken))
+        self.failUnlessEqual(list(pipeline), range(1, 100))
+
+
+class ByzantineConversionTest(ImportTestCase):
+    def test_scan_bp5_file(self):
+        "Words are yielded with their Strong's numbers and parsings, whichever lines those are on, without the variants"
+        bp5 = "\r\n".join([
+            "   1:1 biblov 976 {N-NSF} (1:2) | genesewv 1078 {N-GSF}",
+            "  ihsou 2424 {N-GSM} | cristou 5547",
+            "  {N-GSM} | uiou 5207 {N-GSM} dauid",
+            "  1138 {N-PRI}",
+            "   1:2 kai 2532 {CONJ}",
+        ]) + "\r\n"
+        write_byzantine({"MT": (bp5, "")})
+        self.failUnlessEqual(list(byzantine_conversion.scan_bp5_file("MT")), [
+            (1, 1, (u"βιβλος", "G976", "N-NSF")),
+            (1, 1, (u"γενεσεως", "G1078", "N-GSF")),
+            (1, 1, (u"ιησου", "G2424", "N-GSM")),
+            (1, 1, (u"υιου", "G5207", "N-GSM")),
+            (1, 1, (u"δαυιδ", "G1138", "N-PRI")),
+            (1, 2, (u"και", "G2532", "CONJ")),
+        ])
+
+    def test_rev_17_8(self):
+        "Revelation 17:8 starts at the alternative verse number in 17:7, as it does in the CCT file"
+        lines = ["   %d:1 kai 2532 {CONJ}" % chapter for chapter in range(1, 17)]
+        lines += ["   17:%d kai 2532 {CONJ}" % verse for verse in range(1, 7)]
+        lines += [
+            "   17:7 eipen 2036 5627 {V-2AAI-3S} (17:8) to 3588 {T-ASN}",
+            "   17:8 yhrion 2342 {N-ASN}",
+            "   17:9 wde 5602 {ADV}",
+        ]
+        write_byzantine({"RE": ("\r\n".join(lines) + "\r\n", "")})
+        words = [(chapter, verse, word[0]) for chapter, verse, word in byzantine_conversion.scan_bp5_file("RE")]
+        self.failUnlessEqual(words[-4:], [(17, 7, u"ειπεν"), (17, 8, u"το"), (17, 8, u"θηριον"), (17, 9, u"ωδε")])
+
+    def test_read_cct_file(self):
+        "Verses are converted word by word, and a word which cannot be is reported with its verse"
+        write_byzantine({"JUDE": ("", "# JUDE\n 1:1 )Iou/das, {VAR1: x} lo/gos.\n 1:2 kai\\ - h)^n\n")})
+        self.failUnlessEqual(byzantine_conversion.read_cct_file("JUDE"), [[
+            [(u"Ἰο\u03cdδας", u"ιουδας"), (u",", u","), (u"λ\u03ccγος", u"λογος"), (u".", u".")],
+            [(u"καὶ", u"και"), (u"ἦν", u"ην")],
+        ]])
+        write_byzantine({"JUDE": ("", " 1:1 lo/gos\n 1:2 lo!gos\n")})
+        try:
+            byzantine_conversion.read_cct_file("JUDE")
+        except byzantine_conversion.ConversionError, e:
+            self.failUnless(str(e).startswith("JUDE 1:2: "), str(e))
+            self.failUnless(str(e).endswith(" in the word lo!gos"), str(e))
+        else:
+            self.fail("No ConversionError")
+
+    def test_cache(self):
+        "Only the books whose BP5 or CCT member changed, or all of them for a new CACHE_VERSION, are converted again"
+        books = {
+            "JUDE": ("   1:1 ioudav 2455 {N-NSM}\r\n", " 1:1 )Iou/das.\n"),
+            "PHM": ("   1:1 paulov 3972 {N-NSM}\r\n", " 1:1 Pau^los.\n"),
+        }
+        write_byzantine(books)
+        converted = byzantine_conversion.convert_books(["JUDE", "PHM"], 2, "cache")
+        self.failUnlessEqual(converted[0], ([[[(u"ιουδας", "G2455", "N-NSM")]]], [[[(u"Ἰο\u03cdδας", u"ιουδας"), (u".", u".")]]]))
+        self.failUnlessEqual(byzantine_conversion.convert_books(["JUDE", "PHM"], 1, "cache"), converted)
+        self.failUnlessEqual(len(os.listdir("cache")), 2)
+
+        # Mark the cached conversions, to tell which books are converted again
+        for name in os.listdir("cache"):
+            cache_file = open(os.path.join("cache", name), "wb")
+            cPickle.dump(name, cache_file)
+            cache_file.close()
+        cached = sorted(os.listdir("cache"))
+
+        books["PHM"] = (books["PHM"][0], " 1:1 Pau^los,\n")
+        write_byzantine(books)
+        jude, phm = byzantine_conversion.convert_books(["JUDE", "PHM"], 1, "cache")
+        self.failUnlessEqual(jude, cached[0])
+        self.failUnlessEqual(phm[1], [[[(u"Παῦλος", u"παυλος"), (u",", u",")]]])
+        self.failUnlessEqual(len(os.listdir("cache")), 2)
+        self.failIf(cached[1] in os.listdir("cache"))
+
+        cache_version = byzantine_conversion.CACHE_VERSION
+        byzantine_conversion.CACHE_VERSION += 1
+        try:
+            jude, phm = byzantine_conversion.convert_books(["JUDE", "PHM"], 1, "cache")
+        finally:
+            byzantine_conversion.CACHE_VERSION = cache_version
+        self.failUnlessEqual(jude, converted[0])
+        self.failUnlessEqual(len(os.listdir("cache")), 2)
@@ -1,10 +1,39 @@
 # coding: utf8 #
 
+import bisect
+import heapq
+import operator
+import os
+
+from django.conf import settings
 from django.db import models
 from django.db.models import Q
 from django.utils.translation import ugettext_lazy as _
 
 from core.models import Language, License, Server
+from texts.structure_index import StructureIndex
+from texts.token_store import open_token_store, token_store_path
+
+
+# The StructureIndex of each work in STRUCTURE_INDEX_WORKS that has been
+# used by this process, by work ID, along with the work's import_generation
+# when it was built
+structure_indexes = {}
+
+# The TokenStore of each work that has been opened by this process, by work
+# ID, along with the work's import_generation it was written at
+token_stores = {}
+
+
+def union_ranges(ranges):
+    "Merge the overlapping or adjacent (start, end) ranges of positions (inclusive) in a list, returning them in order"
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
 
 
 
@@ -65,6 +94,7 @@ class Work(models.Model):
     #      date tlements: edition, eversion, imprint, original
     publish_date = models.DateField(_("When the work was published"), null=True, db_index=True)
     import_date = models.DateField(_("When the work was imported into the models."), null=True)
+    import_generation = models.PositiveIntegerField(_("Incremented each time the importers write the work's tokens and structures, so that copies of them held in memory can be discarded."), default=0)
 
     #TODO: pub_date instead?
     #edition
@@ -92,9 +122,119 @@ class Work(models.Model):
     servers = models.ManyToManyField(Server, through=WorkServer)
 
 
-    def lookup_osis_ref(self, start_osis_id, end_osis_id = None, variant_bits = None):
-        if not end_osis_id:
-            end_osis_id = start_osis_id
+    def get_structure_index(self):
+        """
+        The in-memory StructureIndex of the work's structures if the work is
+        listed in the STRUCTURE_INDEX_WORKS setting, or else None. It is
+        built on first use and again once the work has been re-imported.
+        """
+        if self.osis_slug not in getattr(settings, "STRUCTURE_INDEX_WORKS", ()):
+            return None
+        generation, index = structure_indexes.get(self.id, (None, None))
+        if generation != self.import_generation:
+            rows = Structure.objects.filter(
+                work = self,
+                start_position__isnull = False,
+                end_position__isnull = False
+            ).values_list(*[field.name for field in Structure._meta.fields])
+            index = StructureIndex(Structure, rows)
+            structure_indexes[self.id] = (self.import_generation, index)
+        return index
+
+
+    def resolve_source_urls(self, tokens):
+        """
+        Set the base_source_url of each of the provided tokens of the work
+        which have a relative_source_url: that of the innermost structure
+        containing the token which has one, or else the work's.
+
+        The structures are queried once for the range of the tokens, and
+        assigned in one sweep over the tokens in order of position, keeping
+        the structures which have started in a heap by start position.
+        """
+        tokens = sorted([token for token in tokens if token.relative_source_url], key = lambda token: token.position)
+        if not tokens:
+            return
+        structures = list(Structure.objects.filter(
+            work = self,
+            start_position__lte = tokens[-1].position,
+            end_position__gte = tokens[0].position
+        ).exclude(source_url = "").order_by("start_position").values_list("start_position", "end_position", "source_url"))
+
+        started = []
+        i = 0
+        for token in tokens:
+            while i < len(structures) and structures[i][0] <= token.position:
+                start_position, end_position, source_url = structures[i]
+                heapq.heappush(started, (-start_position, end_position, source_url))
+                i += 1
+            # Structures which have ended before this token have ended before
+            # all of the following ones too
+            while started and started[0][1] < token.position:
+                heapq.heappop(started)
+            if started:
+                token.base_source_url = started[0][2]
+            else:
+                token.base_source_url = self.source_url
+
+
+    def get_token_store(self):
+        """
+        The memory-mapped TokenStore of the work if the TOKEN_STORE_DIR
+        setting is set and has a store written at the work's current
+        import_generation, or else None.
+        """
+        directory = getattr(settings, "TOKEN_STORE_DIR", None)
+        if not directory:
+            return None
+        generation, store = token_stores.get(self.id, (None, None))
+        if generation != self.import_generation:
+            store = open_token_store(token_store_path(directory, self.id), self.import_generation)
+            if store is not None:
+                token_stores[self.id] = (self.import_generation, store)
+        return store
+
+
+    def get_token_records(self, start_position, end_position, iterator = False):
+        """
+        The work's tokens between two positions (inclusive) as TokenRecords
+        rather than Token instances, in order of position; read from the
+        work's TokenStore if it has one. With iterator, they are yielded as
+        they are read rather than returned in a list.
+        """
+        store = self.get_token_store()
+        if store is not None:
+            rows = store.rows(start_position, end_position)
+        else:
+            rows = Token.objects.filter(
+                work = self,
+                position__gte = start_position,
+                position__lte = end_position
+            ).values_list(*TokenRecord.FIELDS) #.extra(where=['variant_bits & %s != 0'], params=[variant_bits])
+            if iterator:
+                rows = rows.iterator()
+        records = (TokenRecord(self, *row) for row in rows)
+        if iterator:
+            return records
+        return list(records)
+
+
+    def lookup_osis_ref(self, start_osis_id, end_osis_id = None, variant_bits = None, token_records = False):
+        return self.lookup_osis_refs([(start_osis_id, end_osis_id)], variant_bits, token_records)[0]
+
+
+    def lookup_osis_refs(self, osis_refs, variant_bits = None, token_records = False):
+        """
+        Look up passages of the work, which are given as a list of
+        (start_osis_id, end_osis_id) pairs (the end may be None for a single
+        osisID), and return the start and end structures and positions, the
+        tokens and the concurrent structures of each, in the same order.
+
+        Passages are looked up together so that the bounds of all of them are
+        read with one query, and their structures and tokens with one query
+        each over the union of their ranges of positions.
+        """
+        osis_refs = [(start_osis_id, end_osis_id or start_osis_id) for start_osis_id, end_osis_id in osis_refs]
 
         # Token and Structure objects are only associated with non-diff
         #   works, that is where variants_for_work is None
@@ -107,88 +247,123 @@ class Work(models.Model):
         #if variant_bits is None:
         #    variant_bits = self.variant_bit
 
-        # Get the structure for the start
-        structures = Structure.objects.select_related(depth=1).filter(
+        # Get the structures for the starts and the ends, along with the
+        #  positions of the tokens they start and end at, from the verse index
+        #  in one query
+        osis_ids = set()
+        for start_osis_id, end_osis_id in osis_refs:
+            osis_ids.update([start_osis_id, end_osis_id])
+        entries = dict((entry.osis_id, entry) for entry in VerseIndex.objects.select_related('structure').filter(
             work = main_work,
-            start_token__isnull = False,
-            osis_id = start_osis_id
-        ) #.extra(where=["variant_bits & %s != 0"], params=[variant_bits])
-        if len(structures) == 0:
-            raise Exception("Start structure with osisID %s not found" % start_osis_id)
-        start_structure = structures[0]
-
-        # Get the structure for the end
-        if start_osis_id != end_osis_id:
-            structures = Structure.objects.select_related(depth=1).filter(
-                work = main_work,
-                end_token__isnull = False,
-                osis_id = end_osis_id
-            ) #.extra(where=["variant_bits & %s != 0"], params=[variant_bits])
-            if len(structures) == 0:
-                raise Exception("End structure with osisID %s not found" % end_osis_id)
-            end_structure = structures[0]
-        else:
-            end_structure = start_structure
-
-        # Now grab all structures from the work which have start/end_token or
-        #  start/end_marker whose positions are less 
-        concurrent_structures = Structure.objects.select_related(depth=1).filter(work = main_work).filter(
-            # Structures that are contained within start_structure and end_structure
-            (
-                Q(start_token__position__lte = start_structure.start_token.position)
-                &
-                Q(end_token__position__gte = end_structure.end_token.position)
-            )
-            |
-            # Structures that only start inside of the selected range
-            Q(
-                start_token__position__gte = start_structure.start_token.position,
-                start_token__position__lte = end_structure.end_token.position
-            )
-            |
-            # Structures that only end inside of the selected range (excluding markers)
-            Q(
-                end_token__position__gte = start_structure.start_token.position,
-                end_token__position__lte = end_structure.end_token.position
-            )
-        ) #.extra(where=["%s.variant_bits & %%s != 0" % Structure._meta.db_table], params=[variant_bits])
-
-        # Now indicate if the structures are shadowed (virtual)
-        for struct in concurrent_structures:
-            if struct.start_token.position < start_structure.start_token.position:
-                struct.shadow = struct.shadow | Structure.SHADOW_START
-            if struct.end_token.position > end_structure.end_token.position:
-                struct.shadow = struct.shadow | Structure.SHADOW_END
-
-        # Now get all tokens that exist between the beginning of start_structure
-        # and the end of end_structure
-
-        # Get all of the tokens between the start and end and who have variant
-        # bits that match the requested variant bits
-        tokens = Token.objects.filter(
-            work = main_work,
-            position__gte = start_structure.start_token.position,
-            position__lte = end_structure.end_token.position
-        ) #.extra(where=['variant_bits & %s != 0'], params=[variant_bits])
-
-        # Indicate which of the beginning queried tokens are markers (should be none since verse)
-        for token in tokens:
-            if token.position >= start_structure.start_token.position:
-                break
-            token.is_structure_marker = True
-
-        # Indicate which of the ending queried tokens are markers (should be none since verse)
-        for token in reversed(tokens):
-            if token.position <= end_structure.end_token.position:
-                break
-            token.is_structure_marker = True
-
-        return {
-            'start_structure': start_structure,
-            'end_structure': end_structure,
-            'tokens': tokens,
-            'concurrent_structures': concurrent_structures
-        }
+            osis_id__in = osis_ids
+        ))
+
+        bounds = []
+        for start_osis_id, end_osis_id in osis_refs:
+            # Get the structure for the start (from the structures themselves
+            #  if the osisID is not indexed, e.g. when the work was imported
+            #  before the index was)
+            if start_osis_id in entries:
+                start_structure = entries[start_osis_id].structure
+                start_position = entries[start_osis_id].start_position
+            else:
+                structures = Structure.objects.filter(
+                    work = main_work,
+                    start_position__isnull = False,
+                    osis_id = start_osis_id
+                ) #.extra(where=["variant_bits & %s != 0"], params=[variant_bits])
+                if len(structures) == 0:
+                    raise Exception("Start structure with osisID %s not found" % start_osis_id)
+                start_structure = structures[0]
+                start_position = start_structure.start_position
+
+            # Get the structure for the end
+            if end_osis_id in entries:
+                end_structure = entries[end_osis_id].structure
+                end_position = entries[end_osis_id].end_position
+            elif start_osis_id != end_osis_id:
+                structures = Structure.objects.filter(
+                    work = main_work,
+                    end_position__isnull = False,
+                    osis_id = end_osis_id
+                ) #.extra(where=["variant_bits & %s != 0"], params=[variant_bits])
+                if len(structures) == 0:
+                    raise Exception("End structure with osisID %s not found" % end_osis_id)
+                end_structure = structures[0]
+                end_position = end_structure.end_position
+            else:
+                end_structure = start_structure
+                end_position = end_structure.end_position
+
+            bounds.append((start_structure, end_structure, start_position, end_position))
+
+        # The ranges of token positions covered by the passages, with those
+        #  that overlap merged
+        ranges = union_ranges([(start_position, end_position) for start_structure, end_structure, start_position, end_position in bounds])
+
+        # Now grab all structures from the work whose tokens overlap the
+        #  selected ranges: those which contain one, and those which only
+        #  start or only end inside of one (excluding markers); from memory if
+        #  the work's structures are indexed there. They are indexed by their
+        #  positions in either case, so each passage gets its own instances.
+        structure_index = main_work.get_structure_index()
+        if structure_index is None:
+            structure_index = StructureIndex(Structure, Structure.objects.filter(work = main_work).filter(
+                reduce(operator.or_, [Q(start_position__lte = end_position, end_position__gte = start_position) for start_position, end_position in ranges])
+            ).values_list(*[field.name for field in Structure._meta.fields])) #.extra(where=["%s.variant_bits & %%s != 0" % Structure._meta.db_table], params=[variant_bits])
+
+        # Get all of the tokens in the ranges and who have variant bits that
+        # match the requested variant bits (as TokenRecords if the caller
+        # only needs their fields, which are sliced from the work's token
+        # store if it has one)
+        all_tokens = None
+        if not token_records or main_work.get_token_store() is None:
+            token_ranges = reduce(operator.or_, [Q(position__gte = start_position, position__lte = end_position) for start_position, end_position in ranges])
+            if token_records:
+                all_tokens = [TokenRecord(main_work, *row) for row in Token.objects.filter(work = main_work).filter(token_ranges).values_list(*TokenRecord.FIELDS)]
+            else:
+                all_tokens = list(Token.objects.filter(work = main_work).filter(token_ranges).select_related('form')) #.extra(where=['variant_bits & %s != 0'], params=[variant_bits])
+            token_positions = [token.position for token in all_tokens]
+
+        results = []
+        for start_structure, end_structure, start_position, end_position in bounds:
+            concurrent_structures = structure_index.overlapping(start_position, end_position)
+
+            # Now indicate if the structures are shadowed (virtual)
+            for struct in concurrent_structures:
+                if struct.start_position < start_position:
+                    struct.shadow = struct.shadow | Structure.SHADOW_START
+                if struct.end_position > end_position:
+                    struct.shadow = struct.shadow | Structure.SHADOW_END
+
+            # Now get all tokens that exist between the beginning of
+            # start_structure and the end of end_structure
+            if all_tokens is None:
+                tokens = main_work.get_token_records(start_position, end_position)
+            else:
+                tokens = all_tokens[bisect.bisect_left(token_positions, start_position):bisect.bisect_right(token_positions, end_position)]
+
+            # Indicate which of the beginning queried tokens are markers (should be none since verse)
+            for token in tokens:
+                if token.position >= start_position:
+                    break
+                token.is_structure_marker = True
+
+            # Indicate which of the ending queried tokens are markers (should be none since verse)
+            for token in reversed(tokens):
+                if token.position <= end_position:
+                    break
+                token.is_structure_marker = True
+
+            results.append({
+                'start_structure': start_structure,
+                'end_structure': end_structure,
+                'start_position': start_position,
+                'end_position': end_position,
+                'tokens': tokens,
+                'concurrent_structures': concurrent_structures
+            })
+        return results
 
     def __unicode__(self):
         return self.title
@@ -199,6 +374,21 @@ class Work(models.Model):
         )
 
 
+class LexiconEntry(models.Model):
+    """
+    A distinct form of token data, such as a word, punctuation mark or
+    whitespace, which is stored once for all of the tokens of all works that
+    have it; so the Token table and its index hold integers rather than the
+    same strings over and over, and tokens with the same form are found by
+    comparing integers. Entries are added by the importers.
+    """
+
+    data = models.CharField(_("Unicode data in Normalization Form C (NFC)"), max_length=255, unique=True)
+
+    def __unicode__(self):
+        return self.data
+
+
 class Token(models.Model):
     """
     An atomic unit of text, such as a word, punctuation mark, or whitespace
@@ -216,8 +406,30 @@ class Token(models.Model):
     It wasn't even the token that changed in the first place.
     """
     
-    id = models.CharField(_("uuid.uuid4() for random unique ID generation"), max_length=52, primary_key=True)
-    data = models.CharField(_("Unicode data in Normalization Form C (NFC)"), max_length=255, db_index=True)
+    id = models.CharField(_("SHA-1 of the work, book and token n-gram (see OpenScripturesImport.identify_token)"), max_length=52, primary_key=True)
+    form = models.ForeignKey(LexiconEntry, help_text=_("The entry of the token's data in the lexicon"))
+
+    # The token's data: that of its form, or what it was created with until
+    # the importers add the form to the lexicon
+    _data = None
+
+    def get_data(self):
+        if self._data is None:
+            self._data = self.form.data
+        return self._data
+
+    def set_data(self, data):
+        self._data = data
+        self.form_id = None
+        self.__dict__.pop(Token._meta.get_field('form').get_cache_name(), None)
+    data = property(get_data, set_data)
+
+    def save(self, *args, **kwargs):
+        # Tokens whose data was set outside the importers, which add the forms
+        # of many tokens at once (see OpenScripturesImport.add_forms)
+        if self.form_id is None and self._data is not None:
+            self.form = LexiconEntry.objects.get_or_create(data = self._data)[0]
+        super(Token, self).save(*args, **kwargs)
 
     WORD = 1
     PUNCTUATION = 2
@@ -253,28 +465,17 @@ class Token(models.Model):
     #TODO: How do you query for isblank=False? Whe not say null=True?
     relative_source_url = models.CharField(_("Relative URL for where this token came from (e.g. including XPointer); %base% refers to work.src_url"), max_length=255, blank=True)
 
+    base_source_url = None #This is set by Work.resolve_source_urls, which resolves those of many tokens at once
+
     def get_source_url(self):
         if not self.relative_source_url:
             return None
 
-        structures = Structure.objects.filter(
-            Q(start_token__position__lte = self.position),
-            Q(end_token__position__gte = self.position),
-            source_url__isnull = False,
-            #source_url__ne = "",
-            #source_url__isblank = False,
-            work = self.work
-        ) #.extra(where=["%s.variant_bits & %%s != 0" % Structure._meta.db_table], params=[self.variant_bits])
-
-
-        if not len(structures):
-            base = self.work.source_url
-        else:
-            #TODO: If multiple structures have source_urls?
-            base = structures[0].source_url
+        if self.base_source_url is None:
+            self.work.resolve_source_urls([self])
         #TODO: What if the base isn't desired?
 
-        return base + self.relative_source_url
+        return self.base_source_url + self.relative_source_url
     source_url = property(get_source_url)
 
     class Meta:
@@ -287,6 +488,35 @@ class Token(models.Model):
         return self.data
 
 
+class TokenRecord(object):
+    """
+    The fields of a Token needed to render it, read with values_list() rather
+    than as a model instance, for when whole chapters or books of tokens are
+    fetched (see Work.get_token_records and Structure.get_token_records).
+    """
+
+    # The Token fields which are read, in the order they are passed in
+    FIELDS = ('id', 'position', 'type', 'form__data', 'relative_source_url')
+
+    __slots__ = ('work', 'id', 'position', 'type', 'data', 'relative_source_url', 'is_structure_marker', 'base_source_url')
+
+    def __init__(self, work, id, position, type, data, relative_source_url):
+        self.work = work
+        self.id = id
+        self.position = position
+        self.type = type
+        self.data = data
+        self.relative_source_url = relative_source_url
+        self.is_structure_marker = None
+        self.base_source_url = None
+
+    type_name = property(lambda self: Token.TYPE_NAMES[self.type])
+    source_url = property(Token.get_source_url.im_func)
+
+    def __unicode__(self):
+        return self.data
+
+
 #class StructureType(models.Model):
 #    pass
 
@@ -437,6 +667,16 @@ class Structure(models.Model):
     start_marker = models.ForeignKey(Token, null=True, related_name='start_marker_structure_set', help_text=_("The optional token that marks the start of the structure; this marker may be included (inside) in the start_token/end_token range as in the example of quotation marks, or it may excluded (outside) as in the case of paragraph markers which are double linebreaks. Outside markers may overlap (be shared) among multiple paragraphs' start/end_markers, whereas inside markers may not."))
     end_marker   = models.ForeignKey(Token, null=True, related_name='end_marker_structure_set',   help_text=_("Same as start_marker, but for the end."))
 
+    # The positions of the start/end_token and start/end_marker, denormalized
+    # so that the structures spanning a range of tokens can be found with an
+    # indexed interval query rather than by joining the tokens; they are
+    # written by the importers along with the foreign keys (and filled in for
+    # works imported before they existed by the index_work command).
+    start_position        = models.PositiveIntegerField(null=True, db_index=True, help_text=_("The position of the start_token"))
+    end_position          = models.PositiveIntegerField(null=True, db_index=True, help_text=_("The position of the end_token"))
+    start_marker_position = models.PositiveIntegerField(null=True, help_text=_("The position of the start_marker"))
+    end_marker_position   = models.PositiveIntegerField(null=True, help_text=_("The position of the end_marker"))
+
     @property
     def tokens(self, include_outside_markers = False, variant_bits = None):
         if include_outside_markers:
@@ -450,12 +690,16 @@ class Structure(models.Model):
         # and who have variant bits that match the requested variant bits
         tokens = Token.objects.filter(
             work = self.work,
-            position__gte = self.start_token.position,
-            position__lte = self.end_token.position
-        ) #.extra(where=['variant_bits & %s != 0'], params=[variant_bits])
+            position__gte = self.start_position,
+            position__lte = self.end_position
+        ).select_related('form') #.extra(where=['variant_bits & %s != 0'], params=[variant_bits])
         
         return tokens
 
+    def get_token_records(self, iterator = False):
+        "The structure's tokens as TokenRecords (see Work.get_token_records)"
+        return self.work.get_token_records(self.start_position, self.end_position, iterator)
+
     # Get rid of the bitwise stuff here? Just use the string identifiers?
     SHADOW_NONE  = 0b0000
     SHADOW_START = 0b0001
@@ -508,6 +752,34 @@ class Structure(models.Model):
             return self.element
 
 
+class VerseIndex(models.Model):
+    """
+    Materialized index of the book, chapter and verse structures of a work by
+    osisID, along with the positions of the tokens they start and end at.
+
+    It is rebuilt by the importers at the end of each import, so that
+    Work.lookup_osis_ref can find the bounds of a passage with one indexed
+    query rather than by querying the structures and then their tokens.
+    """
+
+    # The elements of the structures which are indexed
+    ELEMENTS = ('book', 'chapter', 'verse')
+
+    work = models.ForeignKey(Work)
+    osis_id = models.CharField(max_length=32)
+    structure = models.ForeignKey(Structure, help_text=_("The first structure in the work with the osisID"))
+    start_position = models.PositiveIntegerField(help_text=_("The position of the structure's start_token"))
+    end_position = models.PositiveIntegerField(help_text=_("The position of the structure's end_token"))
+
+    class Meta:
+        unique_together = (
+            ('work', 'osis_id'),
+        )
+
+    def __unicode__(self):
+        return self.osis_id
+
+
 class StructureAttribute(models.Model):
     """
     Basically an OSIS XML attribute for an associated structure which is an OSIS XML element.
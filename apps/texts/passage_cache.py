@@ -0,0 +1,104 @@
+# coding: utf8 #
+#
+# A process-local cache of rendered passages, so that frequently requested
+# passages are not looked up and rendered again for every request.
+#
+# Entries are keyed by the work, the passage and the parameters which change
+# how it is rendered (see texts.views.passage). Each records the work's
+# import_generation when it was rendered and is discarded when it is next
+# requested after the work has been imported again. The cache holds at most
+# PASSAGE_CACHE_SIZE bytes of rendered passages and evicts the least recently
+# used ones to make room.
+
+# Standard library imports
+import threading
+
+
+# The fields of the links of the list of entries in order of use
+PREVIOUS, NEXT, KEY, ENTRY = range(4)
+
+
+class PassageCache(object):
+    """
+    A least recently used cache of rendered passages bounded by their total
+    size in bytes, which counts its hits, misses, evictions and the entries
+    invalidated by a re-import (see stats).
+
+    The entries are held in a dict of the links of a circular doubly linked
+    list, from the least to the most recently used, so that each of them can
+    be moved to the end of it or evicted from the start in constant time.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.links = {}
+        self.root = [None, None, None, None]
+        self.root[PREVIOUS] = self.root[NEXT] = self.root
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def unlink(self, key):
+        "Remove the entry of the key from the cache and return it, or None if there is none"
+        link = self.links.pop(key, None)
+        if link is None:
+            return None
+        link[PREVIOUS][NEXT] = link[NEXT]
+        link[NEXT][PREVIOUS] = link[PREVIOUS]
+        self.size -= len(link[ENTRY][1])
+        return link[ENTRY]
+
+    def append(self, key, entry):
+        "Add the entry for the key to the cache as the most recently used"
+        last = self.root[PREVIOUS]
+        link = [last, self.root, key, entry]
+        last[NEXT] = self.root[PREVIOUS] = self.links[key] = link
+        self.size += len(entry[1])
+
+    def get(self, key, generation):
+        "The (body, mimetype) cached for the key if it was rendered at the provided generation, or else None"
+        with self.lock:
+            entry = self.unlink(key)
+            if entry is not None and entry[0] != generation:
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # Re-inserting the entry makes it the most recently used
+            self.append(key, entry)
+            self.hits += 1
+            return entry[1:]
+
+    def set(self, key, generation, body, mimetype):
+        "Cache a rendered passage, evicting the least recently used ones to make room for it"
+        if len(body) > self.max_size:
+            return
+        with self.lock:
+            self.unlink(key)
+            while self.links and self.size + len(body) > self.max_size:
+                self.unlink(self.root[NEXT][KEY])
+                self.evictions += 1
+            self.append(key, (generation, body, mimetype))
+
+    def clear(self):
+        with self.lock:
+            self.links.clear()
+            self.root[PREVIOUS] = self.root[NEXT] = self.root
+            self.size = 0
+
+    def stats(self):
+        "The counters and the current size of the cache, for monitoring"
+        with self.lock:
+            return {
+                "entries": len(self.links),
+                "size": self.size,
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
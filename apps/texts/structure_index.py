@@ -0,0 +1,83 @@
+# coding: utf8 #
+#
+# An in-memory index of the structures of a work, so that the structures
+# overlapping a range of tokens can be found without querying the database.
+#
+# The structures are held as rows of their field values sorted by the
+# position of their start_token, over which an implicit interval tree is
+# laid: the middle row of each range of rows is the root of the subtree over
+# that range, and records the greatest end_token position within it. Finding
+# the structures which overlap [start, end] then only descends into the
+# subtrees which can contain one, in O(log n) time per structure found.
+#
+# Indexes are built lazily for the works listed in the STRUCTURE_INDEX_WORKS
+# setting (see Work.get_structure_index), and kept for as long as the work's
+# import_generation is unchanged, i.e. until the work is imported again.
+
+# Standard library imports
+import bisect
+
+
+class StructureIndex(object):
+    """
+    The structures of a work which have a start and end position, answering
+    which of them overlap a range of token positions.
+
+    The structures are built from rows of the values of the fields of the
+    model, in the order of model._meta.fields, so each structure returned is
+    a new instance which the caller is free to modify.
+    """
+
+    def __init__(self, model, rows):
+        names = [field.name for field in model._meta.fields]
+        start_index = names.index("start_position")
+        end_index = names.index("end_position")
+        position_index = names.index("position")
+
+        self.model = model
+        self.rows = sorted(rows, key = lambda row: (row[start_index], row[position_index]))
+        self.starts = [row[start_index] for row in self.rows]
+        self.ends = [row[end_index] for row in self.rows]
+        self.positions = [row[position_index] for row in self.rows]
+        self.max_ends = [None] * len(self.rows)
+        if self.rows:
+            self.build(0, len(self.rows))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def build(self, lo, hi):
+        "Record the greatest end position in the subtree over rows[lo:hi] on its root, and return it"
+        mid = (lo + hi) // 2
+        max_end = self.ends[mid]
+        if lo < mid:
+            max_end = max(max_end, self.build(lo, mid))
+        if mid + 1 < hi:
+            max_end = max(max_end, self.build(mid + 1, hi))
+        self.max_ends[mid] = max_end
+        return max_end
+
+    def overlapping_rows(self, start, end):
+        "The indexes of the rows of the structures whose positions overlap [start, end], in order of start position"
+        # Only the structures which start no later than the end can overlap
+        stop = bisect.bisect_right(self.starts, end)
+        found = []
+        subtrees = [(0, len(self.rows))]
+        while subtrees:
+            lo, hi = subtrees.pop()
+            if lo >= hi or lo >= stop:
+                continue
+            mid = (lo + hi) // 2
+            if self.max_ends[mid] < start:
+                continue
+            subtrees.append((mid + 1, hi))
+            if mid < stop and self.ends[mid] >= start:
+                found.append(mid)
+            subtrees.append((lo, mid))
+        found.sort()
+        return found
+
+    def overlapping(self, start, end):
+        "New instances of the structures whose positions overlap [start, end], in order of position"
+        found = sorted(self.overlapping_rows(start, end), key = lambda i: self.positions[i])
+        return [self.model(*self.rows[i]) for i in found]
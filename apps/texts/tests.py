@@ -0,0 +1,389 @@
+# encoding: utf-8
+
+import bisect
+import os
+import random
+import re
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, reset_queries
+from django.http import Http404, HttpRequest
+from django.test import TestCase
+
+from importers.testcases import ImportTestCase
+from texts import models, views
+from texts.models import Structure, Token, Work, union_ranges
+from texts.passage_cache import PassageCache
+from texts.structure_index import StructureIndex
+from texts import token_store
+
+
+def structure_row(id, position, start_position, end_position):
+    "The values of the fields of a structure, in the order of Structure._meta.fields"
+    values = {
+        "id": id,
+        "position": position,
+        "start_position": start_position,
+        "end_position": end_position,
+    }
+    return tuple(values.get(field.name) for field in Structure._meta.fields)
+
+
+class StructureIndexTest(TestCase):
+    def test_overlapping(self):
+        "The structures found are those a scan of all of them finds, in order of position"
+        r = random.Random(0)
+        for count in (0, 1, 2, 3, 10, 100, 500):
+            positions = range(count)
+            r.shuffle(positions)
+            rows = []
+            for id, position in enumerate(positions):
+                start = r.randrange(200)
+                # Mostly short structures like verses, with some long ones like books
+                length = r.randrange(5) if r.random() < 0.8 else r.randrange(200)
+                rows.append(structure_row(id + 1, position, start, start + length))
+            structures = [Structure(*row) for row in rows]
+            index = StructureIndex(Structure, rows)
+            self.failUnlessEqual(len(index), count)
+
+            for i in range(200):
+                start = r.randrange(-5, 205)
+                end = start + (r.randrange(3) if r.random() < 0.5 else r.randrange(100))
+                expected = sorted(
+                    [structure for structure in structures if structure.start_position <= end and structure.end_position >= start],
+                    key = lambda structure: structure.position
+                )
+                found = index.overlapping(start, end)
+                self.failUnlessEqual(
+                    [(structure.id, structure.position, structure.start_position, structure.end_position) for structure in found],
+                    [(structure.id, structure.position, structure.start_position, structure.end_position) for structure in expected]
+                )
+
+    def test_new_instances(self):
+        "Each structure found is a new instance, so changing it does not change the index"
+        index = StructureIndex(Structure, [structure_row(1, 0, 0, 10)])
+        structure = index.overlapping(5, 5)[0]
+        structure.start_position = 20
+        self.failIf(structure is index.overlapping(5, 5)[0])
+        self.failUnlessEqual(index.overlapping(5, 5)[0].start_position, 0)
+
+
+class PassageCacheTest(TestCase):
+    def test_hit(self):
+        "A passage is cached with its mimetype until the work is imported again"
+        cache = PassageCache(100)
+        self.failUnless(cache.get("a", 0) is None)
+        cache.set("a", 0, "body", "application/xml")
+        self.failUnlessEqual(cache.get("a", 0), ("body", "application/xml"))
+        self.failUnlessEqual(cache.get("a", 0), ("body", "application/xml"))
+        stats = cache.stats()
+        self.failUnlessEqual((stats["entries"], stats["size"], stats["hits"], stats["misses"]), (1, 4, 2, 1))
+
+    def test_invalidation(self):
+        "A passage rendered at an earlier import_generation is discarded when it is requested"
+        cache = PassageCache(100)
+        cache.set("a", 0, "body", "application/xml")
+        self.failUnless(cache.get("a", 1) is None)
+        stats = cache.stats()
+        self.failUnlessEqual((stats["entries"], stats["size"], stats["invalidations"], stats["misses"]), (0, 0, 1, 1))
+        # The passage rendered again is cached at the new generation
+        cache.set("a", 1, "new body", "application/xml")
+        self.failUnlessEqual(cache.get("a", 1), ("new body", "application/xml"))
+        self.failUnlessEqual(cache.stats()["invalidations"], 1)
+
+    def test_eviction(self):
+        "The least recently used passages are evicted to keep the total size within max_size"
+        cache = PassageCache(10)
+        for key in "abc":
+            cache.set(key, 0, "123", "application/xml")
+        self.failIf(cache.get("a", 0) is None)
+        cache.set("d", 0, "1234", "application/xml")
+        # b was the least recently used, as a was requested after c was cached
+        self.failUnless(cache.get("b", 0) is None)
+        for key in "acd":
+            self.failIf(cache.get(key, 0) is None)
+        stats = cache.stats()
+        self.failUnlessEqual((stats["entries"], stats["size"], stats["evictions"]), (3, 10, 1))
+
+        # Replacing a passage does not count it twice
+        cache.set("d", 0, "1", "application/xml")
+        self.failUnlessEqual(cache.stats()["size"], 7)
+        # As many passages are evicted as it takes to make room
+        cache.set("e", 0, "123456789", "application/xml")
+        stats = cache.stats()
+        self.failUnlessEqual((stats["entries"], stats["size"], stats["evictions"]), (2, 10, 3))
+        self.failUnless(cache.get("a", 0) is None)
+        self.failUnless(cache.get("c", 0) is None)
+        self.failUnlessEqual(cache.get("d", 0), ("1", "application/xml"))
+        self.failUnlessEqual(cache.get("e", 0), ("123456789", "application/xml"))
+
+    def test_too_large(self):
+        "A passage larger than the whole cache is not cached, and does not evict the others"
+        cache = PassageCache(10)
+        cache.set("a", 0, "123", "application/xml")
+        cache.set("b", 0, "12345678901", "application/xml")
+        self.failUnless(cache.get("b", 0) is None)
+        self.failIf(cache.get("a", 0) is None)
+        self.failUnlessEqual(cache.stats()["evictions"], 0)
+        # Nor is anything cached when the cache is disabled
+        cache = PassageCache(0)
+        cache.set("a", 0, "123", "application/xml")
+        self.failUnless(cache.get("a", 0) is None)
+
+    def test_clear(self):
+        "Clearing the cache drops every passage, and passages can be cached again afterwards"
+        cache = PassageCache(10)
+        for key in "abc":
+            cache.set(key, 0, "123", "application/xml")
+        cache.clear()
+        stats = cache.stats()
+        self.failUnlessEqual((stats["entries"], stats["size"]), (0, 0))
+        for key in "abc":
+            self.failUnless(cache.get(key, 0) is None)
+        for key in "defg":
+            cache.set(key, 0, "123", "application/xml")
+        self.failUnless(cache.get("d", 0) is None)
+        self.failUnlessEqual(cache.get("g", 0), ("123", "application/xml"))
+        self.failUnlessEqual(cache.stats()["size"], 9)
+
+
+class TokenStoreTest(ImportTestCase):
+    def rows(self):
+        "Rows of tokens with gaps between their positions, and data and source URLs used more than once"
+        r = random.Random(0)
+        rows = []
+        position = 0
+        for i in range(500):
+            position += r.choice((1, 1, 1, 2, 5))
+            data = r.choice([u"λόγος", u"καὶ", u" ", u"ἦν", u"", u"θεόν"])
+            relative_source_url = r.choice([u"#line(%d)" % (i // 3 + 1), u"", u"λόγος"])
+            rows.append((u"%040x" % i, position, r.randrange(3), data, relative_source_url))
+        return rows
+
+    def test_round_trip(self):
+        "The tokens written are read back as they were, from a file of the documented layout"
+        rows = self.rows()
+        path = token_store.token_store_path("stores", 7)
+        token_store.write_token_store(path, 3, iter(rows))
+        # Only the store is left, as its temporary file has been renamed to it
+        self.failUnlessEqual(os.listdir("stores"), ["7.tokens"])
+
+        strings = set([row[3] for row in rows] + [row[4] for row in rows])
+        data = open(path, "rb").read()
+        self.failUnlessEqual(token_store.HEADER.unpack_from(data, 0), (token_store.MAGIC, token_store.VERSION, len(rows), len(rows) + len(strings), 3))
+        self.failUnlessEqual(len(data), token_store.HEADER.size + len(rows) * token_store.RECORD.size +
+            (len(rows) + len(strings) + 1) * token_store.OFFSET.size + sum([len(s.encode("utf-8")) for s in [row[0] for row in rows] + list(strings)]))
+
+        store = token_store.open_token_store(path, 3)
+        self.failUnlessEqual(len(store), len(rows))
+        self.failUnlessEqual(list(store.rows(0, rows[-1][1])), rows)
+        positions = [row[1] for row in rows]
+        for position in range(-1, positions[-1] + 3):
+            self.failUnlessEqual(store.find(position), bisect.bisect_left(positions, position))
+        r = random.Random(1)
+        for i in range(200):
+            start = r.randrange(positions[-1] + 2)
+            end = start + r.randrange(30)
+            self.failUnlessEqual(list(store.rows(start, end)), [row for row in rows if start <= row[1] <= end])
+        store.close()
+
+    def test_empty(self):
+        "A work without tokens has an empty store"
+        path = token_store.token_store_path("stores", 1)
+        token_store.write_token_store(path, 0, [])
+        store = token_store.open_token_store(path, 0)
+        self.failUnlessEqual(len(store), 0)
+        self.failUnlessEqual(store.find(5), 0)
+        self.failUnlessEqual(list(store.rows(0, 100)), [])
+        store.close()
+
+    def test_generation(self):
+        "A store is only opened at the generation it was written at, and a rewrite does not disturb one open"
+        path = token_store.token_store_path("stores", 1)
+        self.failUnless(token_store.open_token_store(path, 0) is None)
+        rows = self.rows()
+        token_store.write_token_store(path, 1, rows)
+        self.failUnless(token_store.open_token_store(path, 0) is None)
+        self.failUnless(token_store.open_token_store(path, 2) is None)
+        store = token_store.open_token_store(path, 1)
+
+        token_store.write_token_store(path, 2, rows[:10])
+        self.failUnlessEqual(list(store.rows(0, rows[-1][1])), rows)
+        store.close()
+        store = token_store.open_token_store(path, 2)
+        self.failUnlessEqual(list(store.rows(0, rows[-1][1])), rows[:10])
+        store.close()
+
+        # A failed write leaves the store as it was, and no temporary file
+        def failing_rows():
+            yield rows[0]
+            raise ValueError
+        self.failUnlessRaises(ValueError, token_store.write_token_store, path, 3, failing_rows())
+        self.failUnlessEqual(os.listdir("stores"), ["1.tokens"])
+        self.failIf(token_store.open_token_store(path, 2) is None)
+
+        open(path, "wb").write("XXXX" + "\0" * token_store.HEADER.size)
+        self.failUnlessRaises(IOError, token_store.open_token_store, path, 2)
+
+
+class ResolveSourceUrlsTest(ImportTestCase):
+    def test_resolve_source_urls(self):
+        "Tokens take the source URL of the innermost structure around them which has one, or else the work's"
+        self.import_tischendorf(["Jude", "Phlm"], 2, 4, 3)
+        work = Work.objects.get(osis_slug = "Tischendorf")
+        work.source_url = "http://example.com/tischendorf/"
+        work.save()
+        # The importers do not record where the tokens came from, so give
+        # the words a relative URL and leave the other tokens without one
+        Token.objects.filter(work = work, type = Token.WORD).update(relative_source_url = "#word")
+        # Nested structures, one of which starts where the one around it
+        # does, and a verse without a URL of its own
+        for osis_id, source_url in (("Jude", "jude/"), ("Jude.1", "jude/1/"), ("Jude.1.1", "jude/1/1/"), ("Jude.1.3", ""), ("Jude.2.2", "jude/2/2/")):
+            self.failUnlessEqual(Structure.objects.filter(work = work, osis_id = osis_id).update(source_url = source_url), 1)
+        self.failUnlessEqual(Structure.objects.get(work = work, osis_id = "Jude.1").start_position, Structure.objects.get(work = work, osis_id = "Jude.1.1").start_position)
+
+        structures = Structure.objects.filter(work = work).exclude(source_url = "")
+        tokens = list(Token.objects.filter(work = work).exclude(relative_source_url = ""))
+        expected = {}
+        for token in tokens:
+            around = [structure for structure in structures if structure.start_position <= token.position <= structure.end_position]
+            if around:
+                innermost = min(around, key = lambda structure: (-structure.start_position, structure.end_position))
+                expected[token.position] = innermost.source_url
+            else:
+                expected[token.position] = work.source_url
+        # Each of the URLs is used, including the work's for Philemon
+        self.failUnlessEqual(set(expected.values()), set(["jude/", "jude/1/", "jude/1/1/", "jude/2/2/", work.source_url]))
+
+        work.resolve_source_urls(tokens)
+        self.failUnlessEqual(dict((token.position, token.base_source_url) for token in tokens), expected)
+        records = work.get_token_records(0, tokens[-1].position)
+        work.resolve_source_urls(records)
+        for record in records:
+            if record.relative_source_url:
+                self.failUnlessEqual(record.source_url, expected[record.position] + record.relative_source_url)
+            else:
+                self.failUnless(record.source_url is None)
+        # As for a token on its own
+        token = Token.objects.get(work = work, position = tokens[0].position)
+        self.failUnlessEqual(token.source_url, expected[token.position] + token.relative_source_url)
+
+
+class UnionRangesTest(TestCase):
+    def test_union_ranges(self):
+        "Overlapping and adjacent ranges are merged, and separate ones kept, in order"
+        self.failUnlessEqual(union_ranges([]), [])
+        self.failUnlessEqual(union_ranges([(5, 9)]), [(5, 9)])
+        self.failUnlessEqual(union_ranges([(5, 9), (1, 3)]), [(1, 3), (5, 9)])
+        self.failUnlessEqual(union_ranges([(1, 3), (4, 9)]), [(1, 9)])
+        self.failUnlessEqual(union_ranges([(1, 5), (3, 9), (20, 20), (2, 4), (21, 22)]), [(1, 9), (20, 22)])
+        self.failUnlessEqual(union_ranges([(1, 9), (1, 9), (9, 9)]), [(1, 9)])
+
+    def test_random_ranges(self):
+        "The merged ranges cover the same positions as the ranges given, and neither overlap nor touch"
+        r = random.Random(0)
+        for i in range(500):
+            ranges = []
+            for j in range(r.randrange(8)):
+                start = r.randrange(50)
+                ranges.append((start, start + r.randrange(6)))
+            merged = union_ranges(ranges)
+            positions = set()
+            for start, end in ranges:
+                positions.update(range(start, end + 1))
+            merged_positions = set()
+            for start, end in merged:
+                self.failUnless(start <= end)
+                merged_positions.update(range(start, end + 1))
+            self.failUnlessEqual(merged_positions, positions)
+            for previous, next in zip(merged, merged[1:]):
+                self.failUnless(previous[1] + 1 < next[0])
+
+
+class PassagesViewTest(ImportTestCase):
+    urls = "texts.urls"
+
+    refs = ["Bible.Tischendorf:Jude.1.2", "Jude.1.1-Jude.1.3", "Phlm.1", "Phlm.2.3-Phlm.2.5", "Jude", "Jude.2.6-Phlm.1.1", "Jude.1.2"]
+
+    def setUp(self):
+        super(PassagesViewTest, self).setUp()
+        self.import_tischendorf(["Jude", "Phlm"], 2, 6, 4)
+        views.passage_cache.clear()
+
+    def split(self, body):
+        "The passages rendered in a response"
+        return re.findall(r"<(?:passage|article) .*?</(?:passage|article)>", body, re.S)
+
+    def test_passages(self):
+        "The passages are rendered as the passage view renders each of them, whether in the URL or POSTed"
+        for query in ("", "?hierarchy=standoff", "?hierarchy=bsp", "?include=source", "?output=xhtml"):
+            expected = []
+            for ref in self.refs:
+                if ":" not in ref:
+                    ref = "Bible.Tischendorf:" + ref
+                response = self.client.get("/passage/" + ref + query)
+                self.failUnlessEqual(response.status_code, 200)
+                expected.extend(self.split(response.content))
+            self.failUnlessEqual(len(expected), len(self.refs))
+
+            response = self.client.get("/passages/" + ",".join(self.refs) + query)
+            self.failUnlessEqual(response.status_code, 200)
+            self.failUnlessEqual(self.split(response.content), expected)
+
+            posted = self.client.post("/passages" + query, {"osis_ref": self.refs[:2] + [",".join(self.refs[2:])]})
+            self.failUnlessEqual(posted.status_code, 200)
+            self.failUnlessEqual(posted.content, response.content)
+
+            # Passages can be given both in the URL and POSTed, those in the URL coming first
+            both = self.client.post("/passages/" + ",".join(self.refs[:3]) + query, {"osis_ref": ",".join(self.refs[3:])})
+            self.failUnlessEqual(both.content, response.content)
+
+    def test_token_store(self):
+        "Passages are rendered from a token store built by build_token_store as they are from the database"
+        queries = ("", "?hierarchy=standoff", "?include=source", "?output=xhtml")
+        url = "/passages/" + ",".join(self.refs)
+        token_store_dir = getattr(settings, "TOKEN_STORE_DIR", None)
+        try:
+            settings.TOKEN_STORE_DIR = None
+            expected = [self.client.get(url + query).content for query in queries]
+            settings.TOKEN_STORE_DIR = os.path.join(self.directory, "stores")
+            call_command("build_token_store", "Tischendorf", verbosity = 0)
+            models.token_stores.clear()
+            views.passage_cache.clear()
+            self.failIf(Work.objects.get(osis_slug = "Tischendorf").get_token_store() is None)
+            self.failUnlessEqual([self.client.get(url + query).content for query in queries], expected)
+        finally:
+            settings.TOKEN_STORE_DIR = token_store_dir
+            for store in models.token_stores.values():
+                store[1].close()
+            models.token_stores.clear()
+
+    def test_queries(self):
+        "The passages of a work are looked up with as many queries as one of them"
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            counts = []
+            for refs in (self.refs[:1], self.refs):
+                reset_queries()
+                response = self.client.get("/passages/" + ",".join(refs))
+                self.failUnlessEqual(response.status_code, 200)
+                counts.append(len(connection.queries))
+        finally:
+            settings.DEBUG = debug
+        self.failUnlessEqual(counts[0], counts[1])
+
+    def test_errors(self):
+        "Requests without passages, with too many of them or an unknown output are bad, and unknown works not found"
+        self.failUnlessEqual(self.client.get("/passages").status_code, 400)
+        self.failUnlessEqual(self.client.post("/passages", {"osis_ref": " , "}).status_code, 400)
+        refs = ["Bible.Tischendorf:Jude.1.1"] + ["Jude.1.1"] * (views.MAX_PASSAGES - 1)
+        self.failUnlessEqual(self.client.get("/passages/" + ",".join(refs)).status_code, 200)
+        self.failUnlessEqual(self.client.get("/passages/" + ",".join(refs + ["Jude.1.1"])).status_code, 400)
+        self.failUnlessEqual(self.client.post("/passages/" + ",".join(refs), {"osis_ref": "Jude.1.1"}).status_code, 400)
+        self.failUnlessEqual(self.client.get("/passages/Bible.Tischendorf:Jude.1.1?output=foo").status_code, 400)
+        # texts.urls has no handler404 to render the 404 with, so call the view
+        request = HttpRequest()
+        request.method = "GET"
+        self.failUnlessRaises(Http404, views.passages, request, "Bible.Tischendorf:Jude.1.1,Bible.Nope:Jude.1.1")
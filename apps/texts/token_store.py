@@ -0,0 +1,166 @@
+# coding: utf8 #
+#
+# A compact, read-only file of the tokens of a work, which is memory-mapped
+# so that the processes serving passages read token ranges from one shared
+# copy in the page cache rather than querying them from the database.
+#
+# The file starts with a header (see HEADER) recording the work's
+# import_generation when it was written, followed by a fixed-size record for
+# each token in order of position (see RECORD), the offsets of the strings
+# the records refer to by index, and the strings themselves in UTF-8. The
+# data and relative_source_url of the tokens are deduplicated in the string
+# table; their IDs are unique anyway.
+#
+# The database remains the source of truth: a store is written at the end of
+# each import when the TOKEN_STORE_DIR setting is set (or with the
+# build_token_store command), and is only used while its generation is the
+# work's import_generation (see Work.get_token_store).
+
+# Standard library imports
+import array
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+
+# Magic string, format version, number of tokens, number of strings and the
+# work's import_generation
+HEADER = struct.Struct("<4sIIIQ")
+MAGIC = "OSTS"
+VERSION = 1
+
+# Position, type and the indexes of the ID, data and relative_source_url
+# strings of a token
+RECORD = struct.Struct("<IBIII")
+
+# An offset into the string data, of which there is one per string plus the
+# end of the last one
+OFFSET = struct.Struct("<I")
+
+
+def token_store_path(directory, work_id):
+    "The path of the token store of a work in the provided directory"
+    return os.path.join(directory, "%d.tokens" % work_id)
+
+
+def write_token_store(path, generation, rows):
+    """
+    Write a token store from rows of the ID, position, type, data and
+    relative_source_url of each token, in order of position.
+
+    The file is written alongside the path and then renamed over it, so
+    processes which have the previous store mapped keep reading it intact.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    output = tempfile.NamedTemporaryFile(dir = directory, prefix = ".tokens", delete = False)
+    strings = tempfile.TemporaryFile()
+    try:
+        offsets = array.array("I", [0])
+        indexes = {}
+
+        def add_string(value):
+            data = value.encode("utf-8")
+            strings.write(data)
+            offsets.append(offsets[-1] + len(data))
+            return len(offsets) - 2
+
+        def intern(value):
+            index = indexes.get(value)
+            if index is None:
+                index = indexes[value] = add_string(value)
+            return index
+
+        output.write(HEADER.pack(MAGIC, VERSION, 0, 0, generation))
+        count = 0
+        for id, position, type, data, relative_source_url in rows:
+            output.write(RECORD.pack(position, type, add_string(id), intern(data), intern(relative_source_url)))
+            count += 1
+
+        if sys.byteorder == "big":
+            offsets.byteswap()
+        output.write(offsets.tostring())
+        strings.seek(0)
+        shutil.copyfileobj(strings, output)
+        output.seek(0)
+        output.write(HEADER.pack(MAGIC, VERSION, count, len(offsets) - 1, generation))
+        output.close()
+        # Readable by the processes serving passages, like the files they
+        # would otherwise read from the database
+        os.chmod(output.name, 0644)
+        os.rename(output.name, path)
+    except:
+        output.close()
+        os.remove(output.name)
+        raise
+    finally:
+        strings.close()
+
+
+def open_token_store(path, generation):
+    "The TokenStore at the path if there is one written at the provided generation, or else None"
+    if not os.path.exists(path):
+        return None
+    store = TokenStore(path)
+    if store.generation != generation:
+        store.close()
+        return None
+    return store
+
+
+class TokenStore(object):
+    "A memory-mapped token store, from which ranges of tokens are read by position"
+
+    def __init__(self, path):
+        _file = open(path, "rb")
+        try:
+            self.map = mmap.mmap(_file.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            _file.close()
+        magic, version, self.count, string_count, self.generation = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise IOError("%s is not a version %d token store" % (path, VERSION))
+        self.records_start = HEADER.size
+        self.offsets_start = self.records_start + self.count * RECORD.size
+        self.strings_start = self.offsets_start + (string_count + 1) * OFFSET.size
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.map.close()
+
+    def position(self, i):
+        "The position of the ith token"
+        return RECORD.unpack_from(self.map, self.records_start + i * RECORD.size)[0]
+
+    def string(self, i):
+        "The ith string"
+        start, end = struct.unpack_from("<II", self.map, self.offsets_start + i * OFFSET.size)
+        return self.map[self.strings_start + start:self.strings_start + end].decode("utf-8")
+
+    def find(self, position):
+        "The index of the first token at or after the position"
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.position(mid) < position:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def rows(self, start_position, end_position):
+        "Yield the ID, position, type, data and relative_source_url of the tokens between two positions (inclusive)"
+        string = self.string
+        for i in xrange(self.find(start_position), self.count):
+            position, type, id, data, relative_source_url = RECORD.unpack_from(self.map, self.records_start + i * RECORD.size)
+            if position > end_position:
+                break
+            yield (string(id), position, type, string(data), string(relative_source_url))
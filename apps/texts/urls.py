@@ -5,6 +5,9 @@ from django.conf.urls.defaults import patterns
 
 urlpatterns = patterns('',
     (r'^passage/(?P<osis_ref>.+)$', 'texts.views.passage'),
+    (r'^passages/(?P<osis_refs>.+)$', 'texts.views.passages'),
+    (r'^passages$', 'texts.views.passages'),
+    (r'^passage-cache$', 'texts.views.passage_cache_stats'),
 )
 
 
@@ -1,16 +1,45 @@
 # coding: utf8 #
 
-from django.http import Http404, HttpResponseBadRequest
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
 from django.shortcuts import render_to_response
+from django.utils import simplejson
+from django.utils.datastructures import SortedDict
+from django.views.decorators.csrf import csrf_exempt
 
 from texts.models import Work, Structure
+from texts.passage_cache import PassageCache
 from core.osis import OsisRef
 
 
+# The passages rendered by this process
+passage_cache = PassageCache(getattr(settings, "PASSAGE_CACHE_SIZE", 0))
 
-def passage(request, osis_ref):
-    osis_ref = OsisRef(osis_ref)
-    
+# Most passages which can be requested at once from the passages view
+MAX_PASSAGES = 100
+
+# Define the output formats and their templates
+OUTPUT_FORMATS = {
+    #'debug':{
+    #    'template_name':'passage_debug.html',
+    #    'mimetype': 'text/html'
+    #},
+    'xml':{
+        'template_name':'passage.xml',
+        'mimetype': 'application/xml',
+        'standoff_allowed': True
+    },
+    'xhtml':{
+        'template_name':'passage.xhtml',
+        'mimetype': 'application/xhtml+xml',
+        'standoff_allowed': False
+    }
+}
+
+
+
+def get_work(osis_ref):
+    "The Work an OsisRef refers to; raises Http404 if there is none"
     #TODO: We should be able to query non-main works as well (i.e. where variants_for_work != None)
     
     try:
@@ -30,39 +59,35 @@ def passage(request, osis_ref):
         #    main_work = work.variants_for_work
     except Exception as (e):
         raise Http404(e)
-    
-    # TODO: This is too simplistic; we have more complex passage slugs that we want to support
-    data = work.lookup_osis_ref(
-        str(osis_ref.start),
-        str(osis_ref.end),
-    )
-    
-    # Define the output formats and their templates
-    output_formats = {
-        #'debug':{
-        #    'template_name':'passage_debug.html',
-        #    'mimetype': 'text/html'
-        #},
-        'xml':{
-            'template_name':'passage.xml',
-            'mimetype': 'application/xml',
-            'standoff_allowed': True
-        },
-        'xhtml':{
-            'template_name':'passage.xhtml',
-            'mimetype': 'application/xhtml+xml',
-            'standoff_allowed': False
-        }
-    }
-    
-    # Get the output format
+    return work
+
+
+def get_output_format(request):
+    "The requested output format, or None if it is not one of OUTPUT_FORMATS"
     output_format = "xml" #default
     if request.GET.has_key("output"):
-        if not output_formats.has_key(request.GET["output"]):
-            return HttpResponseBadRequest("Unexpected output type '%s' provided for hierarchy" % request.GET["output"], mimetype = "text/plain")
+        if not OUTPUT_FORMATS.has_key(request.GET["output"]):
+            return None
         output_format = request.GET["output"]
-    
-    # Get the desired hierarchy (serialization order) for Structures
+    return output_format
+
+
+def get_includes(request):
+    """
+    The optional data requested to be included for each token, e.g.
+    include=source for the URL of where it came from
+    """
+    if request.GET.has_key("include"):
+        return request.GET["include"].split(",")
+    return []
+
+
+def get_hierarchy(request, output_format):
+    """
+    Whether the structures are requested standoff, and if not, the desired
+    hierarchy (serialization order) of their elements and which elements
+    are always milestoned
+    """
     structure_elements = []
     structure_elements_always_milestoned = {}
     #STRUCTURE_TYPE_CODES = {}
@@ -76,7 +101,7 @@ def passage(request, osis_ref):
     if request.GET.has_key("hierarchy"):
         if request.GET["hierarchy"] == 'standoff':
             is_standoff = True
-            assert(output_formats[output_format]['standoff_allowed'])
+            assert(OUTPUT_FORMATS[output_format]['standoff_allowed'])
         else:
             is_standoff = False
             
@@ -138,7 +163,15 @@ def passage(request, osis_ref):
     # TODO: If a text has structure element type that is not listed in structure_element_hierarchy
     # exception will result. Therefore, this structure_element_hierarchy list should be filled out
     # with all of the remaining structure element types that exist within a text.
-    
+    return is_standoff, structure_element_hierarchy, structure_elements_always_milestoned
+
+
+def build_passage(work, osis_ref, data, include_source, is_standoff, structure_element_hierarchy, structure_elements_always_milestoned):
+    """
+    Turn what Work.lookup_osis_ref returned for a passage into the passage
+    the templates render: its tokens, and unless the structures are standoff,
+    the tokens and the structures which start and end at them as “chunks”
+    """
     passage_start_token_position = data['tokens'][0].position
     passage_end_token_position = data['tokens'][len(data['tokens'])-1].position
     
@@ -150,24 +183,24 @@ def passage(request, osis_ref):
     final_shadow_structures = []
     for struct in data['concurrent_structures']:
         # Structure is start shadow
-        if struct.start_token.position < data['start_structure'].start_token.position:
+        if struct.start_position < data['start_position']:
             struct.shadow = struct.shadow | Structure.SHADOW_START
             initial_shadow_structures.append(struct)
             struct.shadow_start_token_position = passage_start_token_position
         
-        if not structures_by_token_start_position.has_key(struct.start_token.position):
-            structures_by_token_start_position[struct.start_token.position] = []
-        structures_by_token_start_position[struct.start_token.position].append(struct)
+        if not structures_by_token_start_position.has_key(struct.start_position):
+            structures_by_token_start_position[struct.start_position] = []
+        structures_by_token_start_position[struct.start_position].append(struct)
         
         # Structure is end shadow
-        if struct.end_token.position > data['end_structure'].end_token.position:
+        if struct.end_position > data['end_position']:
             struct.shadow = struct.shadow | Structure.SHADOW_END
             final_shadow_structures.append(struct)
             struct.shadow_end_token_position = passage_end_token_position
         
-        if not structures_by_token_end_position.has_key(struct.end_token.position):
-            structures_by_token_end_position[struct.end_token.position] = []
-        structures_by_token_end_position[struct.end_token.position].append(struct)
+        if not structures_by_token_end_position.has_key(struct.end_position):
+            structures_by_token_end_position[struct.end_position] = []
+        structures_by_token_end_position[struct.end_position].append(struct)
     
     # Stick initial_shadow_structures and final_shadow_structures onto the first
     # token and last token's respective structure lists
@@ -202,25 +235,25 @@ def passage(request, osis_ref):
                     structs.sort(sorter)
                     
                     # Detect overlapping hierarchies (and need for milestones)
-                    max_start_position = max(structs[0].start_token.position, passage_start_token_position)
-                    min_end_position = min(structs[0].end_token.position, passage_end_token_position)
+                    max_start_position = max(structs[0].start_position, passage_start_token_position)
+                    min_end_position = min(structs[0].end_position, passage_end_token_position)
                     for i in range(0, len(structs)):
                         # Always milestone
                         if structure_elements_always_milestoned.has_key(structs[i].element):
                             structs[i].is_milestoned = True
                             continue
                         
-                        start_position = max(structs[i].start_token.position, max_start_position)
-                        end_position = min(structs[i].end_token.position, min_end_position)
+                        start_position = max(structs[i].start_position, max_start_position)
+                        end_position = min(structs[i].end_position, min_end_position)
                         
                         # Check for needing start milestone
-                        if max(structs[i].start_token.position, passage_start_token_position) < start_position:
+                        if max(structs[i].start_position, passage_start_token_position) < start_position:
                             structs[i].is_milestoned = True
                         else:
                             max_start_position = start_position
                         
                         # Check for needing end milestone
-                        if min(structs[i].end_token.position, passage_end_token_position) > end_position:
+                        if min(structs[i].end_position, passage_end_token_position) > end_position:
                             structs[i].is_milestoned = True
                         else:
                             min_end_position = end_position
@@ -246,15 +279,10 @@ def passage(request, osis_ref):
                         'structure': struct
                     })
     
-    
-    template_vars = {
-        'passages':[]
-    }
-    
-    #TODO: Allow multiple passages to be queried at once
-    passage = {
+    return {
         'work': work,
         'is_standoff':is_standoff,
+        'include_source':include_source,
         'osis_ref': osis_ref,
         #'osis_ref_parsed': osis_ref_parsed,
         'start_structure': data['start_structure'],
@@ -263,16 +291,116 @@ def passage(request, osis_ref):
         'structures': data['concurrent_structures'],
         'chunks':passage_chunks
     }
-    
-    template_vars['passages'].append(passage)
-    
-    
+
+
+def render_passages(passages, output_format):
     # TODO: We need to select the template based on the requested outout
     return render_to_response(
-        output_formats[output_format]['template_name'],
-        template_vars,
-        mimetype=output_formats[output_format]['mimetype']
+        OUTPUT_FORMATS[output_format]['template_name'],
+        {
+            'passages': passages
+        },
+        mimetype=OUTPUT_FORMATS[output_format]['mimetype']
     )
     
     #context_instance=RequestContext(request) ???
+
+
+def passage(request, osis_ref):
+    osis_ref = OsisRef(osis_ref)
+    work = get_work(osis_ref)
+    
+    # Get the output format
+    output_format = get_output_format(request)
+    if output_format is None:
+        return HttpResponseBadRequest("Unexpected output type '%s' provided for hierarchy" % request.GET["output"], mimetype = "text/plain")
+    
+    # Return the passage as it was last rendered unless the work has been
+    # imported again since
+    cache_key = (work.id, str(osis_ref.start), str(osis_ref.end), output_format, request.GET.get("hierarchy"), request.GET.get("include"))
+    cached = passage_cache.get(cache_key, work.import_generation)
+    if cached is not None:
+        body, mimetype = cached
+        return HttpResponse(body, mimetype=mimetype)
+    
+    # TODO: This is too simplistic; we have more complex passage slugs that we want to support
+    data = work.lookup_osis_ref(
+        str(osis_ref.start),
+        str(osis_ref.end),
+        token_records = True,
+    )
+    
+    # Get the optional data to include for each token
+    include_source = "source" in get_includes(request)
+    if include_source:
+        work.resolve_source_urls(data['tokens'])
+    
+    passage = build_passage(work, osis_ref, data, include_source, *get_hierarchy(request, output_format))
+    response = render_passages([passage], output_format)
+    passage_cache.set(cache_key, work.import_generation, response.content, OUTPUT_FORMATS[output_format]['mimetype'])
+    return response
+
+
+@csrf_exempt
+def passages(request, osis_refs = None):
+    """
+    Render several passages at once, which are given comma-separated in the
+    URL and/or as osis_ref values POSTed (which may be comma-separated too).
+    A passage without a work is from the work of the one before it, e.g.
+    Bible.KJV:John.3.16,Rom.5.8
+
+    The passages of each work are looked up together, so their bounds,
+    structures and tokens are read with a query each for all of them.
+    """
+    refs = []
+    if osis_refs:
+        refs.extend(osis_refs.split(","))
+    if request.method == "POST":
+        for value in request.POST.getlist("osis_ref"):
+            refs.extend(value.split(","))
+    refs = [ref.strip() for ref in refs if ref.strip()]
+    if not refs:
+        return HttpResponseBadRequest("No passages provided", mimetype = "text/plain")
+    if len(refs) > MAX_PASSAGES:
+        return HttpResponseBadRequest("At most %d passages can be requested at once" % MAX_PASSAGES, mimetype = "text/plain")
+    
+    output_format = get_output_format(request)
+    if output_format is None:
+        return HttpResponseBadRequest("Unexpected output type '%s' provided for hierarchy" % request.GET["output"], mimetype = "text/plain")
+    include_source = "source" in get_includes(request)
+    hierarchy = get_hierarchy(request, output_format)
+    
+    # Resolve each of the works once, and group the passages by work
+    osis_refs = []
+    works = {}
+    work_passages = SortedDict()
+    osis_work = None
+    for ref in refs:
+        osis_ref = OsisRef(ref)
+        if not osis_ref.work:
+            osis_ref.work = osis_work
+        osis_work = osis_ref.work
+        if not works.has_key(str(osis_ref.work)):
+            works[str(osis_ref.work)] = get_work(osis_ref)
+        work = works[str(osis_ref.work)]
+        work_passages.setdefault(work.id, (work, []))[1].append(len(osis_refs))
+        osis_refs.append(osis_ref)
+    
+    passages = [None] * len(osis_refs)
+    for work, indexes in work_passages.values():
+        datas = work.lookup_osis_refs(
+            [(str(osis_refs[i].start), str(osis_refs[i].end)) for i in indexes],
+            token_records = True,
+        )
+        if include_source:
+            work.resolve_source_urls([token for data in datas for token in data['tokens']])
+        for i, data in zip(indexes, datas):
+            passages[i] = build_passage(work, osis_refs[i], data, include_source, *hierarchy)
+    
+    return render_passages(passages, output_format)
+
+
+def passage_cache_stats(request):
+    "The hit, miss and eviction counters of this process's passage cache, as JSON"
+    return HttpResponse(simplejson.dumps(passage_cache.stats()), mimetype="application/json")
     
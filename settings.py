@@ -158,6 +158,19 @@ DEBUG_TOOLBAR_CONFIG = {
     "INTERCEPT_REDIRECTS": False,
 }
 
+# Works (by osis_slug) whose structures each process holds in memory to look
+# up passages with, rather than querying them for every passage; e.g. the
+# most requested works, such as ["KJV", "SBLGNT"]
+STRUCTURE_INDEX_WORKS = []
+
+# Bytes of rendered passages each process keeps to answer repeated requests
+# for them with; 0 disables the cache
+PASSAGE_CACHE_SIZE = 16 * 1024 * 1024
+
+# Directory the importers write a memory-mapped store of each work's tokens
+# to, which passages are then read from; None to read them from the database
+TOKEN_STORE_DIR = None
+
 # local_settings.py can be used to override environment-specific settings
 # like database and email that differ between development and production.
 try: